@@ -4,6 +4,40 @@ import { reservationService } from '../../services/reservationService';
 import { format, addDays } from 'date-fns';
 import { es } from 'date-fns/locale';
 
+const CELL_MINUTES = 15;
+
+// Convierte el bitstring de celdas libres ('1' libre) en slots de una hora
+const slotsFromCells = ({ free, first_cell: firstCell }) => {
+    if (!free) {
+        return [];
+    }
+    const cellsPerSlot = 60 / CELL_MINUTES;
+    const label = (cell) => {
+        const minutes = cell * CELL_MINUTES;
+        const hours = String(Math.floor(minutes / 60)).padStart(2, '0');
+        return `${hours}:${String(minutes % 60).padStart(2, '0')}`;
+    };
+
+    const slots = [];
+    for (let i = 0; i + cellsPerSlot <= free.length; i += cellsPerSlot) {
+        if (!free.slice(i, i + cellsPerSlot).includes('0')) {
+            slots.push({
+                start_time: label(firstCell + i),
+                end_time: label(firstCell + i + cellsPerSlot)
+            });
+        }
+    }
+    return slots;
+};
+
+// Slots libres de la respuesta de /courts/<id>/availability
+const slotsFromAvailability = (slots) => slots
+    .filter((slot) => slot.available)
+    .map((slot) => ({
+        start_time: slot.time,
+        end_time: `${String(slot.hour + 1).padStart(2, '0')}:${slot.time.slice(3)}`
+    }));
+
 const TimeSelection = ({ courtId, onSelect }) => {
     const [selectedDate, setSelectedDate] = useState(new Date());
     const [availableSlots, setAvailableSlots] = useState([]);
@@ -14,23 +48,60 @@ const TimeSelection = ({ courtId, onSelect }) => {
     const nextDays = Array.from({ length: 7 }, (_, i) => addDays(new Date(), i));
 
     useEffect(() => {
-        const fetchAvailability = async () => {
-            setLoading(true);
-            try {
-                const formattedDate = format(selectedDate, 'yyyy-MM-dd');
-                const response = await reservationService.checkAvailability(
-                    courtId, 
-                    formattedDate
-                );
-                setAvailableSlots(response.data.available_slots);
-            } catch (err) {
-                setError('Error al cargar los horarios disponibles');
-            } finally {
+        // El estado inicial llega por una petición normal; el stream (SSE, solo
+        // con ASGI) trae los cambios posteriores sin sondear
+        let active = true;
+        let loaded = false;
+        let live = false;
+        setLoading(true);
+        setError(null);
+        const formattedDate = format(selectedDate, 'yyyy-MM-dd');
+
+        reservationService.checkAvailability(courtId, formattedDate)
+            .then((response) => {
+                // Si el stream ya respondió, su estado es más reciente
+                if (active && !live) {
+                    setAvailableSlots(slotsFromAvailability(response.data));
+                }
+                loaded = true;
+                if (active) {
+                    setError(null);
+                }
+            })
+            .catch(() => {
+                if (active && !live) {
+                    setError('Error al cargar los horarios disponibles');
+                }
+            })
+            .finally(() => {
+                if (active) {
+                    setLoading(false);
+                }
+            });
+
+        const unsubscribe = reservationService.subscribeAvailability(
+            [{ courtId, date: formattedDate }],
+            (state) => {
+                if (!active) {
+                    return;
+                }
+                live = loaded = true;
+                setAvailableSlots(slotsFromCells(state));
+                setError(null);
                 setLoading(false);
+            },
+            () => {
+                // EventSource reconecta solo; con datos ya cargados basta con seguir mostrándolos
+                if (active && !loaded) {
+                    setError('Error al cargar los horarios disponibles');
+                }
             }
-        };
+        );
 
-        fetchAvailability();
+        return () => {
+            active = false;
+            unsubscribe();
+        };
     }, [courtId, selectedDate]);
 
     return (
@@ -5,6 +5,25 @@ export const reservationService = {
     
     checkAvailability: (courtId, date) => 
         api.get(`/courts/${courtId}/availability`, { params: { date } }),
+
+    // Disponibilidad de varias canchas y días en una sola petición
+    getAvailabilityMatrix: (courtIds, start, days = 7) =>
+        api.get('/courts/availability/matrix/', {
+            params: { courts: courtIds.join(','), start, days }
+        }),
     
+    // Estado en vivo de los días suscritos (SSE). Devuelve una función para cerrar.
+    subscribeAvailability: (pairs, onChange, onError) => {
+        const subscribe = pairs.map(({ courtId, date }) => `${courtId}:${date}`).join(',');
+        const source = new EventSource(
+            `${api.defaults.baseURL}/courts/availability/stream/?subscribe=${subscribe}`
+        );
+        source.addEventListener('slots', (event) => onChange(JSON.parse(event.data)));
+        if (onError) {
+            source.onerror = onError;
+        }
+        return () => source.close();
+    },
+
     createReservation: (data) => api.post('/reservations', data)
 }; 
\ No newline at end of file
@@ -3,6 +3,17 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Production serves it with gunicorn's uvicorn worker so the async streaming
+views (e.g. /api/courts/availability/stream/) hold idle SSE connections
+without tying up a thread each:
+
+    gunicorn -k uvicorn.workers.UvicornWorker config.asgi:application
+
+The stream only works under ASGI: WSGI servers, including manage.py
+runserver, get a 501 from it. In development, use
+
+    uvicorn config.asgi:application --reload
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
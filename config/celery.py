@@ -19,10 +19,28 @@ app.autodiscover_tasks()
 def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(
         crontab(hour=9, minute=0),  # Todos los días a las 9:00 AM
-        'core.tasks.send_reservation_reminders'
+        sender.signature('core.tasks.send_reservation_reminders')
     )
     
     sender.add_periodic_task(
         crontab(hour='*/4'),  # Cada 4 horas
-        'core.tasks.send_payment_reminder'
-    )
\ No newline at end of file
+        sender.signature('core.tasks.send_payment_reminder')
+    )
+
+    # Red de seguridad de la bandeja de salida: recoge reintentos y filas cuyo
+    # aviso a Celery se perdió
+    sender.add_periodic_task(
+        60.0,
+        sender.signature('core.tasks.dispatch_notification_outbox')
+    )
+
+    sender.add_periodic_task(
+        crontab(hour=3, minute=30),  # Retención de notificaciones, de madrugada
+        sender.signature('core.tasks.prune_notifications')
+    )
+
+    # Red de seguridad de los eventos de Stripe, igual que la bandeja de salida
+    sender.add_periodic_task(
+        60.0,
+        sender.signature('core.tasks.process_stripe_events')
+    )
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third party apps
     'rest_framework',
@@ -155,6 +156,19 @@ CACHES = {
     }
 }
 
+# Tiempo de vida (segundos) de la ocupación cacheada por cancha y día. Es lo
+# más que puede durar un día desactualizado si Redis falla al invalidar y
+# tampoco se puede reintentar; recalcular es una lectura por clave primaria
+AVAILABILITY_CACHE_TIMEOUT = int(os.environ.get('AVAILABILITY_CACHE_TIMEOUT', 5 * 60))
+# Reintentos (Celery) de una invalidación que falló tras el commit
+AVAILABILITY_INVALIDATION_MAX_RETRIES = int(os.environ.get('AVAILABILITY_INVALIDATION_MAX_RETRIES', 8))
+
+# Segundos que se retiene un slot mientras el usuario confirma la reserva
+SLOT_HOLD_TTL = int(os.environ.get('SLOT_HOLD_TTL', 300))
+# Duración máxima de una retención y retenciones simultáneas por usuario
+SLOT_HOLD_MAX_MINUTES = int(os.environ.get('SLOT_HOLD_MAX_MINUTES', 180))
+SLOT_HOLD_MAX_PER_USER = int(os.environ.get('SLOT_HOLD_MAX_PER_USER', 3))
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -176,6 +190,57 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Caracas'
 
+# Bandeja de salida de notificaciones: filas por lote, reintentos de WhatsApp
+# y segundos que se espera para agrupar eventos en un mismo envío a Celery
+NOTIFICATION_OUTBOX_BATCH_SIZE = int(os.environ.get('NOTIFICATION_OUTBOX_BATCH_SIZE', 200))
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('NOTIFICATION_OUTBOX_MAX_ATTEMPTS', 5))
+NOTIFICATION_OUTBOX_DELAY = int(os.environ.get('NOTIFICATION_OUTBOX_DELAY', 2))
+# Segundos que un worker se reserva las filas mientras envía por WhatsApp,
+# fuera de transacción; pasado ese tiempo otro worker puede reintentarlas
+NOTIFICATION_OUTBOX_CLAIM_SECONDS = int(os.environ.get('NOTIFICATION_OUTBOX_CLAIM_SECONDS', 600))
+# Las notificaciones de un mismo usuario se retienen hasta que pasa esta
+# ventana (segundos) desde la primera pendiente y se entregan como un único
+# resumen; 0 las entrega sin esperar
+NOTIFICATION_DIGEST_WINDOW = int(os.environ.get('NOTIFICATION_DIGEST_WINDOW', 60))
+NOTIFICATION_DIGEST_MAX_ITEMS = int(os.environ.get('NOTIFICATION_DIGEST_MAX_ITEMS', 10))
+
+# Retención de notificaciones en días por tipo ('default' para el resto). La
+# tarea prune_notifications las retira en bloques y, si el archivo está
+# activo, las mueve a NotificationArchive
+NOTIFICATION_RETENTION_DAYS = {
+    'default': 365,
+    'RESERVATION_REMINDER': 30,
+    'PAYMENT_REMINDER': 14,
+    'PAYMENT_PENDING': 90,
+}
+NOTIFICATION_RETENTION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_RETENTION_BATCH_SIZE', 1000))
+NOTIFICATION_ARCHIVE_ENABLED = os.environ.get('NOTIFICATION_ARCHIVE_ENABLED', 'True') == 'True'
+# Solo se lee al migrar: crea el archivo particionado por mes en PostgreSQL.
+# core_notification no se particiona (ver core/retention.py)
+NOTIFICATION_ARCHIVE_PARTITIONED = os.environ.get('NOTIFICATION_ARCHIVE_PARTITIONED', 'False') == 'True'
+NOTIFICATION_ARCHIVE_MONTHS = int(os.environ.get('NOTIFICATION_ARCHIVE_MONTHS', 12))
+NOTIFICATION_OUTBOX_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_OUTBOX_RETENTION_DAYS', 7))
+
+# Cola de validación de pagos: tamaño de página por defecto y máximo, y
+# segundos que un administrador retiene los pagos que toma
+PAYMENT_QUEUE_PAGE_SIZE = int(os.environ.get('PAYMENT_QUEUE_PAGE_SIZE', 50))
+PAYMENT_QUEUE_MAX_PAGE_SIZE = int(os.environ.get('PAYMENT_QUEUE_MAX_PAGE_SIZE', 200))
+PAYMENT_CLAIM_TTL = int(os.environ.get('PAYMENT_CLAIM_TTL', 300))
+# Pagos por petición en la validación por lote
+PAYMENT_BATCH_MAX_ITEMS = int(os.environ.get('PAYMENT_BATCH_MAX_ITEMS', 500))
+# Conciliación de estados de cuenta: días de diferencia admitidos entre el
+# movimiento y el registro del pago, y líneas huérfanas que se devuelven
+RECONCILIATION_DATE_WINDOW_DAYS = int(os.environ.get('RECONCILIATION_DATE_WINDOW_DAYS', 3))
+RECONCILIATION_ORPHAN_LIMIT = int(os.environ.get('RECONCILIATION_ORPHAN_LIMIT', 1000))
+
+# Tamaño de bloque de las tareas de recordatorios (filas leídas e insertadas por vez)
+REMINDER_CHUNK_SIZE = int(os.environ.get('REMINDER_CHUNK_SIZE', 500))
+# Ventana en horas de cada tipo de recordatorio: una reserva recibe como mucho
+# uno por ventana aunque la tarea corra más a menudo (ReminderLedger)
+RESERVATION_REMINDER_WINDOW_HOURS = int(os.environ.get('RESERVATION_REMINDER_WINDOW_HOURS', 24))
+PAYMENT_REMINDER_WINDOW_HOURS = int(os.environ.get('PAYMENT_REMINDER_WINDOW_HOURS', 24))
+REMINDER_LEDGER_RETENTION_DAYS = int(os.environ.get('REMINDER_LEDGER_RETENTION_DAYS', 30))
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -204,9 +269,30 @@ CORS_ALLOW_CREDENTIALS = True
 
 # WhatsApp Cloud API Settings
 WHATSAPP_API_VERSION = 'v17.0'  # Versión actual de la API
-WHATSAPP_API_URL = f'https://graph.facebook.com/{WHATSAPP_API_VERSION}'
+# Se puede apuntar a un servidor simulado: python manage.py whatsapp_stub
+WHATSAPP_API_URL = os.environ.get('WHATSAPP_API_URL', f'https://graph.facebook.com/{WHATSAPP_API_VERSION}')
 WHATSAPP_ACCESS_TOKEN = os.environ.get('WHATSAPP_ACCESS_TOKEN')
 WHATSAPP_PHONE_NUMBER_ID = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
+WHATSAPP_CONNECT_TIMEOUT = float(os.environ.get('WHATSAPP_CONNECT_TIMEOUT', 3))
+WHATSAPP_READ_TIMEOUT = float(os.environ.get('WHATSAPP_READ_TIMEOUT', 10))
+# Reintentos ante 429/5xx con backoff exponencial (segundos) acotado a WHATSAPP_BACKOFF_MAX
+WHATSAPP_MAX_RETRIES = int(os.environ.get('WHATSAPP_MAX_RETRIES', 3))
+WHATSAPP_BACKOFF_BASE = float(os.environ.get('WHATSAPP_BACKOFF_BASE', 0.5))
+WHATSAPP_BACKOFF_MAX = float(os.environ.get('WHATSAPP_BACKOFF_MAX', 8))
+# Envíos simultáneos en send_messages (y tamaño del pool de conexiones)
+WHATSAPP_CONCURRENCY = int(os.environ.get('WHATSAPP_CONCURRENCY', 8))
+# Token buckets compartidos en Redis: mensajes por segundo y ráfaga por número
+# emisor y por destinatario. Si hay que esperar más de WHATSAPP_RATE_MAX_WAIT
+# segundos el envío se reprograma en lugar de bloquear el worker
+WHATSAPP_NUMBER_RATE = float(os.environ.get('WHATSAPP_NUMBER_RATE', 20))
+WHATSAPP_NUMBER_BURST = float(os.environ.get('WHATSAPP_NUMBER_BURST', 20))
+WHATSAPP_DESTINATION_RATE = float(os.environ.get('WHATSAPP_DESTINATION_RATE', 1 / 6))
+WHATSAPP_DESTINATION_BURST = float(os.environ.get('WHATSAPP_DESTINATION_BURST', 2))
+WHATSAPP_RATE_MAX_WAIT = float(os.environ.get('WHATSAPP_RATE_MAX_WAIT', 5))
+
+# Token del scraper de Prometheus para /api/metrics/ (Authorization: Bearer);
+# vacío deja el endpoint cerrado
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 LOGGING = {
     'version': 1,
@@ -240,6 +326,16 @@ LOGGING = {
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Cliente compartido (core.services.get_stripe_client); STRIPE_API_BASE permite
+# apuntar a un servidor local (manage.py stripe_stub)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3))
+STRIPE_READ_TIMEOUT = float(os.getenv('STRIPE_READ_TIMEOUT', 20))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+STRIPE_INTENT_CACHE_TIMEOUT = int(os.getenv('STRIPE_INTENT_CACHE_TIMEOUT', 60 * 60 * 24))
+# Eventos de webhook aplicados por lote y reintentos antes de marcarlos fallidos
+STRIPE_EVENT_BATCH_SIZE = int(os.environ.get('STRIPE_EVENT_BATCH_SIZE', 100))
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.environ.get('STRIPE_EVENT_MAX_ATTEMPTS', 8))
 
 # Debug stripe keys
 print(f"Stripe keys loaded: {STRIPE_PUBLIC_KEY[:6]}...{STRIPE_PUBLIC_KEY[-4:] if STRIPE_PUBLIC_KEY else 'Not found'}")
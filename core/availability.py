@@ -0,0 +1,396 @@
+import logging
+import time as time_module
+from datetime import time, timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Cada día se representa como un bitmap de ancho fijo: el bit i corresponde a la
+# celda que empieza en i * CELL_MINUTES minutos desde la medianoche.
+CELL_MINUTES = 15
+CELLS_PER_DAY = 24 * 60 // CELL_MINUTES
+FULL_DAY_MASK = (1 << CELLS_PER_DAY) - 1
+
+ACTIVE_STATUSES = ('PENDING', 'CONFIRMED')
+
+
+def time_to_cell(value, round_up=False):
+    """Convierte una hora en el índice de celda (hacia abajo, o hacia arriba para fines)"""
+    seconds = value.hour * 3600 + value.minute * 60 + value.second
+    cell, remainder = divmod(seconds, CELL_MINUTES * 60)
+    if round_up and (remainder or value.microsecond):
+        cell += 1
+    return min(cell, CELLS_PER_DAY)
+
+
+def cell_to_time(cell):
+    minutes = cell * CELL_MINUTES
+    if minutes >= 24 * 60:
+        return time.max
+    return time(minutes // 60, minutes % 60)
+
+
+def cell_label(cell):
+    """Formatea una celda como HH:MM (la última frontera del día es 24:00)"""
+    minutes = cell * CELL_MINUTES
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def cells_mask(start_cell, end_cell):
+    if end_cell <= start_cell:
+        return 0
+    return ((1 << (end_cell - start_cell)) - 1) << start_cell
+
+
+def span_mask(start_time, end_time):
+    """Máscara de las celdas que toca el intervalo [start_time, end_time)"""
+    return cells_mask(time_to_cell(start_time), time_to_cell(end_time, round_up=True))
+
+
+def run_starts(free, length):
+    """
+    Devuelve una máscara donde el bit i está activo si las celdas i..i+length-1
+    están todas libres. Usa duplicación de desplazamientos: O(log length) operaciones.
+    """
+    if length <= 0:
+        return free
+    runs = free
+    span = 1
+    while span < length:
+        shift = min(span, length - span)
+        runs &= runs >> shift
+        span += shift
+    return runs
+
+
+@lru_cache(maxsize=None)
+def aligned_mask(first_cell, step):
+    """Máscara con un bit cada `step` celdas a partir de first_cell"""
+    mask = 0
+    for cell in range(first_cell, CELLS_PER_DAY, step):
+        mask |= 1 << cell
+    return mask
+
+
+def iter_bits(mask):
+    """Itera los índices de los bits activos, de menor a mayor"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class DayOccupancy:
+    """Ocupación de una cancha en un día, como bitmap de celdas de CELL_MINUTES"""
+
+    __slots__ = ('mask',)
+
+    def __init__(self, mask=0):
+        self.mask = mask
+
+    def __repr__(self):
+        return f"DayOccupancy({self.mask:#x})"
+
+    def add(self, start_time, end_time):
+        self.mask |= span_mask(start_time, end_time)
+
+    def conflicts(self, start_time, end_time):
+        return bool(self.mask & span_mask(start_time, end_time))
+
+    def free_mask(self, opening_time, closing_time):
+        window = cells_mask(time_to_cell(opening_time), time_to_cell(closing_time))
+        return window & ~self.mask
+
+    def free_slots(self, opening_time, closing_time, slot_minutes=60, step_minutes=None):
+        """
+        Devuelve los pares (inicio, fin) en celdas de los slots libres dentro del
+        horario de operación, empezando en la apertura y avanzando cada step_minutes.
+        """
+        length = max(1, slot_minutes // CELL_MINUTES)
+        step = max(1, (step_minutes or slot_minutes) // CELL_MINUTES)
+        opening_cell = time_to_cell(opening_time)
+        starts = run_starts(self.free_mask(opening_time, closing_time), length)
+
+        # Solo interesan los inicios alineados al paso desde la apertura
+        aligned = starts & aligned_mask(opening_cell, step)
+        return [(cell, cell + length) for cell in iter_bits(aligned)]
+
+
+def build_occupancy(rows):
+    """
+    Construye en una sola pasada la ocupación por (court_id, date) a partir de
+    filas con court_id, date, start_time y end_time (dicts de .values()).
+    """
+    occupancy = {}
+    for row in rows:
+        key = (row['court_id'], row['date'])
+        day = occupancy.get(key)
+        if day is None:
+            day = occupancy[key] = DayOccupancy()
+        day.add(row['start_time'], row['end_time'])
+    return occupancy
+
+
+def range_occupancy(court_ids, start_date, end_date):
+    """
+    Ocupación de varias canchas en un rango de fechas [start_date, end_date],
+    construida con una sola consulta de rango sobre Reservation.
+    """
+    from .models import Reservation
+
+    rows = Reservation.objects.filter(
+        court_id__in=court_ids,
+        date__range=(start_date, end_date),
+        status__in=ACTIVE_STATUSES
+    ).values('court_id', 'date', 'start_time', 'end_time')
+    return build_occupancy(rows)
+
+
+# Caché en Redis
+#
+# La ocupación de cada (cancha, día) se guarda bajo una clave que incluye dos
+# versiones: la del día (sube con cada cambio de reservas) y la de la cancha
+# (sube cuando cambia su horario). Invalidar es subir la versión: los lectores
+# pasan a la clave nueva y la antigua simplemente expira.
+#
+# Las versiones son el instante del último cambio en milisegundos (o el
+# anterior + 1 si el reloj no avanzó), así que sirven también de Last-Modified.
+
+CACHE_TIMEOUT = getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 5 * 60)
+STATS_KEYS = {
+    'hits': 'availability:stats:hits',
+    'misses': 'availability:stats:misses',
+}
+
+
+def _day_version_key(court_id, date):
+    return f'availability:version:{court_id}:{date}'
+
+
+def _court_version_key(court_id):
+    return f'availability:court-version:{court_id}'
+
+
+def _data_key(court_id, date, court_version, day_version):
+    return f'availability:grid:{court_id}:{date}:{court_version}:{day_version}'
+
+
+def _version_seed():
+    # Las versiones arrancan en un valor basado en el reloj para que no se
+    # repitan si Redis se vacía y los contadores vuelven a empezar
+    return int(time_module.time() * 1000)
+
+
+def get_versions(keys):
+    """Lee (y siembra si faltan) varias claves de versión con un solo GET múltiple"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _version_seed(), timeout=None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+BUMP_VERSION_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0') or 0
+local version = math.max(current + 1, tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], string.format('%d', version))
+return version
+"""
+
+
+def bump_version(key):
+    connection = get_redis_connection('default')
+    return connection.eval(BUMP_VERSION_SCRIPT, 1, cache.make_key(key), _version_seed())
+
+
+def _count(stat, amount):
+    if amount:
+        try:
+            cache.incr(STATS_KEYS[stat], amount, ignore_key_check=True)
+        except Exception as e:
+            logger.warning(f"No se pudo actualizar el contador {stat}: {str(e)}")
+
+
+def day_versions(pairs):
+    """Devuelve {(court_id, date): (court_version, day_version)}"""
+    court_keys = {court_id: _court_version_key(court_id) for court_id, _ in pairs}
+    day_keys = {pair: _day_version_key(*pair) for pair in pairs}
+    versions = get_versions(list(court_keys.values()) + list(day_keys.values()))
+    return {
+        pair: (versions[court_keys[pair[0]]], versions[day_keys[pair]])
+        for pair in pairs
+    }
+
+
+def load_occupancy(pairs):
+    """
+    Ocupación para varios (court_id, date) leyendo primero de Redis; los que
+    faltan se leen de la tabla materializada CourtSlotGrid y se guardan.
+    """
+    pairs = list(dict.fromkeys(pairs))
+    if not pairs:
+        return {}
+
+    try:
+        versions = day_versions(pairs)
+        data_keys = {pair: _data_key(*pair, *versions[pair]) for pair in pairs}
+        cached = cache.get_many(list(data_keys.values()))
+    except Exception as e:
+        # Sin Redis se sigue respondiendo desde la base de datos
+        logger.warning(f"Caché de disponibilidad no disponible: {str(e)}")
+        return _query_pairs(pairs)
+
+    result = {}
+    missing = []
+    for pair, key in data_keys.items():
+        if key in cached:
+            result[pair] = DayOccupancy(int(cached[key]))
+        else:
+            missing.append(pair)
+
+    _count('hits', len(pairs) - len(missing))
+    _count('misses', len(missing))
+
+    if missing:
+        computed = _query_pairs(missing)
+        result.update(computed)
+        try:
+            cache.set_many(
+                {data_keys[pair]: day.mask for pair, day in computed.items()},
+                CACHE_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo guardar la ocupación en caché: {str(e)}")
+
+    return result
+
+
+def _query_pairs(pairs):
+    from .models import CourtSlotGrid
+
+    return CourtSlotGrid.objects.load(pairs)
+
+
+def day_occupancy(court_id, date):
+    """Ocupación de una cancha para un día"""
+    pair = (int(court_id), date)
+    return load_occupancy([pair])[pair]
+
+
+def _invalidate(key):
+    # Corre tras el commit: un fallo de Redis no debe convertir en error una
+    # escritura ya confirmada. La invalidación se reintenta desde Celery y,
+    # si tampoco se puede, el dato viejo caduca a los CACHE_TIMEOUT segundos
+    try:
+        bump_version(key)
+    except Exception as e:
+        logger.warning(f"No se pudo invalidar la caché de disponibilidad ({key}): {str(e)}")
+        _retry_invalidation(key)
+
+
+def _retry_invalidation(key):
+    from .tasks import retry_availability_invalidation
+
+    try:
+        retry_availability_invalidation.delay(key)
+    except Exception as e:
+        logger.warning(f"No se pudo programar el reintento de invalidación ({key}): {str(e)}")
+
+
+def invalidate_days(pairs):
+    for court_id, date in set(pairs):
+        _invalidate(_day_version_key(court_id, date))
+
+
+def invalidate_court(court_id):
+    _invalidate(_court_version_key(court_id))
+
+
+def cache_stats():
+    values = cache.get_many(list(STATS_KEYS.values()))
+    return {stat: int(values.get(key, 0)) for stat, key in STATS_KEYS.items()}
+
+
+def encode_free_cells(occupancy, opening_time, closing_time):
+    """
+    Codifica las celdas del horario de operación como bitstring:
+    un carácter por celda desde la apertura, '1' libre y '0' ocupada.
+    """
+    first = time_to_cell(opening_time)
+    last = time_to_cell(closing_time)
+    if last <= first:
+        return ''
+    free = occupancy.free_mask(opening_time, closing_time) >> first
+    # bin() pone el bit más significativo primero; se invierte para leer en orden temporal
+    return format(free, f'0{last - first}b')[::-1]
+
+
+def find_next_slots(courts, start_date, days, slot_minutes, limit,
+                    after_time=None, step_minutes=30, not_before=None, occupancy_filter=None):
+    """
+    Busca los primeros `limit` slots libres de `slot_minutes` en las canchas
+    dadas (entradas de court_catalog), recorriendo los días en orden desde start_date. Por cada día y
+    cancha la búsqueda es un puñado de operaciones sobre el bitmap.
+
+    not_before es un datetime local: descarta los inicios ya pasados de ese día.
+    occupancy_filter permite sumar ocupación extra (p. ej. reservas temporales).
+    """
+    length = max(1, -(-slot_minutes // CELL_MINUTES))
+    step = max(1, step_minutes // CELL_MINUTES)
+    after_cell = time_to_cell(after_time, round_up=True) if after_time else 0
+
+    results = []
+    # Se cargan semanas completas para poder cortar en cuanto hay suficientes
+    for offset in range(0, days, 7):
+        dates = [start_date + timedelta(days=i) for i in range(offset, min(offset + 7, days))]
+        pairs = [
+            (court.id, date)
+            for date in dates
+            for court in courts
+            if court.opens_on(date)
+        ]
+        occupancy = load_occupancy(pairs)
+        if occupancy_filter:
+            occupancy = occupancy_filter(occupancy)
+
+        for date in dates:
+            min_cell = after_cell
+            if not_before and date == not_before.date():
+                min_cell = max(min_cell, time_to_cell(not_before.time(), round_up=True))
+            window = cells_mask(min_cell, CELLS_PER_DAY)
+
+            found = []
+            for court in courts:
+                day = occupancy.get((court.id, date))
+                if day is None:
+                    continue
+                opening_cell = time_to_cell(court.opening_time)
+                starts = (
+                    run_starts(day.free_mask(court.opening_time, court.closing_time), length)
+                    & aligned_mask(opening_cell, step)
+                    & window
+                )
+                # De cada cancha bastan sus `limit` primeros inicios
+                for count, cell in enumerate(iter_bits(starts), 1):
+                    found.append((cell, court))
+                    if count >= limit:
+                        break
+
+            found.sort(key=lambda item: (item[0], item[1].id))
+            for cell, court in found:
+                results.append({
+                    'court_id': court.id,
+                    'court_name': court.name,
+                    'date': date,
+                    'start_time': cell_label(cell),
+                    'end_time': cell_label(cell + length)
+                })
+                if len(results) >= limit:
+                    return results
+
+    return results
@@ -0,0 +1,163 @@
+import logging
+import time as time_module
+from collections import namedtuple
+from datetime import time
+from functools import lru_cache
+
+from rest_framework.renderers import JSONRenderer
+
+from .availability import bump_version, get_versions
+
+logger = logging.getLogger(__name__)
+
+# Las canchas casi nunca cambian: cada proceso guarda el catálogo ya procesado
+# y solo lo recarga cuando sube la versión en Redis (la sube cualquier save o
+# delete de Court, en cualquier worker).
+VERSION_KEY = 'courts:catalog-version'
+# Cada cuánto se consulta la versión en Redis; el worker que guarda la cancha
+# recarga al momento, los demás en como mucho este intervalo
+CHECK_INTERVAL = 1.0
+# Sin Redis se sigue con el catálogo cargado y se reintenta con espera
+# creciente hasta este máximo; pasado MAX_STALE se recarga de la base de datos
+MAX_CHECK_BACKOFF = 30.0
+MAX_STALE = 300.0
+
+
+class Schedule(namedtuple('Schedule', 'opening_time closing_time weekdays')):
+    """Horario de una cancha ya procesado: weekdays es un frozenset de 1 (lunes) a 7"""
+
+    __slots__ = ()
+
+    def opens_on(self, date):
+        return date.isoweekday() in self.weekdays
+
+    def is_available(self, date, start_time):
+        if not self.opens_on(date):
+            return False, "La cancha no está disponible este día"
+        if start_time < self.opening_time or start_time >= self.closing_time:
+            return False, "Horario fuera del horario de operación"
+        return True, "Disponible"
+
+
+def _as_time(value):
+    return time.fromisoformat(value) if isinstance(value, str) else value
+
+
+@lru_cache(maxsize=256)
+def parse_schedule(opening_time, closing_time, available_days):
+    return Schedule(
+        _as_time(opening_time),
+        _as_time(closing_time),
+        frozenset(int(day) for day in available_days or '' if day.isdigit())
+    )
+
+
+class CourtEntry(namedtuple('CourtEntry', 'id name is_active price_per_hour schedule data')):
+    """Cancha en el catálogo; data es su representación serializada (CourtSerializer)"""
+
+    __slots__ = ()
+
+    opening_time = property(lambda self: self.schedule.opening_time)
+    closing_time = property(lambda self: self.schedule.closing_time)
+
+    def opens_on(self, date):
+        return self.schedule.opens_on(date)
+
+    def is_available(self, date, start_time):
+        return self.schedule.is_available(date, start_time)
+
+
+class CourtCatalog:
+    def __init__(self):
+        # (versión, {id: CourtEntry}, JSON de todas las canchas); se reemplaza entero
+        self._state = None
+        self._loaded_at = 0.0
+        self._next_check = 0.0
+        self._failures = 0
+
+    def _remote_version(self):
+        try:
+            return get_versions([VERSION_KEY])[VERSION_KEY]
+        except Exception as e:
+            logger.warning(f"No se pudo leer la versión del catálogo de canchas: {str(e)}")
+            return None
+
+    def _load(self, version):
+        from .models import Court
+        from .serializers import CourtSerializer
+
+        courts = list(Court.objects.order_by('id'))
+        data = CourtSerializer(courts, many=True).data
+        entries = {
+            court.id: CourtEntry(
+                court.id,
+                court.name,
+                court.is_active,
+                court.price_per_hour,
+                parse_schedule(court.opening_time, court.closing_time, court.available_days),
+                item
+            )
+            for court, item in zip(courts, data)
+        }
+        return version, entries, JSONRenderer().render(data)
+
+    def _current(self):
+        now = time_module.monotonic()
+        state = self._state
+        if state is not None and now < self._next_check:
+            return state
+
+        version = self._remote_version()
+        if version is None:
+            self._failures += 1
+            self._next_check = now + min(CHECK_INTERVAL * 2 ** self._failures, MAX_CHECK_BACKOFF)
+            if state is not None and now - self._loaded_at < MAX_STALE:
+                return state
+        else:
+            self._failures = 0
+            self._next_check = now + CHECK_INTERVAL
+            if state is not None and version == state[0]:
+                return state
+
+        state = self._state = self._load(version)
+        self._loaded_at = now
+        return state
+
+    @property
+    def version(self):
+        return self._current()[0]
+
+    def get(self, court_id):
+        try:
+            return self._current()[1].get(int(court_id))
+        except (TypeError, ValueError):
+            return None
+
+    def all(self):
+        return list(self._current()[1].values())
+
+    def active(self, court_ids=None):
+        entries = [entry for entry in self.all() if entry.is_active]
+        if court_ids is not None:
+            court_ids = set(court_ids)
+            entries = [entry for entry in entries if entry.id in court_ids]
+        return entries
+
+    def json(self):
+        """Todas las canchas ya serializadas como JSON (bytes)"""
+        return self._current()[2]
+
+    def snapshot(self):
+        """(versión, JSON) de una misma lectura, para que el ETag corresponda al cuerpo"""
+        version, _, data = self._current()
+        return version, data
+
+    def invalidate(self):
+        self._state = None
+        try:
+            bump_version(VERSION_KEY)
+        except Exception as e:
+            logger.warning(f"No se pudo invalidar el catálogo de canchas: {str(e)}")
+
+
+court_catalog = CourtCatalog()
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from datetime import date as date_cls
+
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .availability import cell_label, day_occupancy, encode_free_cells, iter_bits, time_to_cell
+from .catalog import court_catalog
+
+logger = logging.getLogger(__name__)
+
+# Un único canal de Redis para todos los cambios de disponibilidad; cada
+# proceso ASGI mantiene una sola suscripción y reparte a sus conexiones SSE.
+CHANNEL = 'availability:events'
+
+
+def publish_availability_changes(pairs):
+    """Publica que cambió la disponibilidad de cada (court_id, date)"""
+    try:
+        connection = get_redis_connection('default')
+        pipe = connection.pipeline(transaction=False)
+        for court_id, date in pairs:
+            pipe.publish(CHANNEL, json.dumps({'court': court_id, 'date': str(date)}))
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"No se pudo publicar el cambio de disponibilidad: {str(e)}")
+
+
+def day_state(court_id, date):
+    """Estado actual de un día: bitstring de celdas libres desde la apertura ('1' libre)"""
+    from .services import SlotHoldService
+
+    court = court_catalog.get(court_id)
+    state = {'court': court_id, 'date': str(date), 'free': None}
+    if not court or not court.is_active or not court.opens_on(date):
+        return state
+
+    pair = (court_id, date)
+    occupancy = SlotHoldService().apply_to({pair: day_occupancy(court_id, date)})[pair]
+    state['first_cell'] = time_to_cell(court.opening_time)
+    state['free'] = encode_free_cells(occupancy, court.opening_time, court.closing_time)
+    return state
+
+
+def changed_ranges(first_cell, previous, current):
+    """Intervalos [HH:MM, HH:MM) cuyo estado cambió entre dos bitstrings"""
+    if previous is None or current is None or len(previous) != len(current):
+        return None
+    diff = int(previous[::-1], 2) ^ int(current[::-1], 2)
+    ranges = []
+    for cell in iter_bits(diff):
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1][1] = cell + 1
+        else:
+            ranges.append([cell, cell + 1])
+    return [[cell_label(first_cell + s), cell_label(first_cell + e)] for s, e in ranges]
+
+
+class AvailabilityBroadcaster:
+    """
+    Reparte los cambios publicados en Redis a las conexiones SSE del proceso.
+    El estado de cada día se calcula una vez por evento y proceso, no por conexión.
+    """
+
+    QUEUE_SIZE = 32
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.last_state = {}
+        self._listener = None
+
+    def subscribe(self, pairs):
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        for pair in pairs:
+            self.subscribers[pair].add(queue)
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.ensure_future(self._listen())
+        return queue
+
+    def unsubscribe(self, queue, pairs):
+        for pair in pairs:
+            queues = self.subscribers.get(pair)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[pair]
+                self.last_state.pop(pair, None)
+
+    async def snapshot(self, pair):
+        state = await sync_to_async(day_state)(*pair)
+        self.last_state.setdefault(pair, state['free'])
+        return state
+
+    async def _listen(self):
+        while self.subscribers:
+            client = aioredis.from_url(settings.CACHES['default']['LOCATION'])
+            pubsub = client.pubsub()
+            try:
+                await pubsub.subscribe(CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    event = json.loads(message['data'])
+                    pair = (event['court'], date_cls.fromisoformat(event['date']))
+                    if pair in self.subscribers:
+                        await self._dispatch(pair)
+                    if not self.subscribers:
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Suscripción de disponibilidad interrumpida: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+    async def _dispatch(self, pair):
+        state = await sync_to_async(day_state)(*pair)
+        previous = self.last_state.get(pair)
+        if previous == state['free']:
+            return
+        self.last_state[pair] = state['free']
+        if state['free'] is not None:
+            state['changed'] = changed_ranges(state['first_cell'], previous, state['free'])
+
+        for queue in list(self.subscribers.get(pair, ())):
+            if queue.full():
+                # Cada evento lleva el día completo: a un cliente lento se le
+                # descartan estados intermedios, nunca el último
+                queue.get_nowait()
+            queue.put_nowait(state)
+
+
+broadcaster = AvailabilityBroadcaster()
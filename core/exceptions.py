@@ -1,3 +1,15 @@
 class PaymentError(Exception):
     """Excepción para errores relacionados con pagos"""
-    pass 
\ No newline at end of file
+    pass
+
+class SlotHoldError(Exception):
+    """Excepción para conflictos con reservas temporales de slots"""
+    pass
+
+class SlotHoldUnavailable(SlotHoldError):
+    """Redis no responde: no se puede retener ni liberar el slot"""
+    pass
+
+class StatementError(Exception):
+    """Excepción para estados de cuenta que no se pueden leer"""
+    pass
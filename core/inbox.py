@@ -0,0 +1,65 @@
+import logging
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Contador de notificaciones no leídas por usuario en Redis. Se calcula con un
+# COUNT (cubierto por el índice user/read/created_at) solo cuando falta la
+# clave; después cada alta, lectura o borrado lo ajusta tras el commit. El TTL
+# acota cualquier desajuste por carreras entre un recálculo y un ajuste.
+UNREAD_TIMEOUT = 60 * 60
+
+
+def _unread_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def unread_count(user_id):
+    key = _unread_key(user_id)
+    try:
+        count = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Contador de no leídas no disponible: {str(e)}")
+        count = None
+    if count is not None:
+        return max(int(count), 0)
+
+    from .models import Notification
+
+    count = Notification.objects.filter(user_id=user_id, read=False).count()
+    try:
+        # add y no set: si otro proceso ya lo guardó, el suyo lleva sus ajustes
+        cache.add(key, count, UNREAD_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar el contador de no leídas: {str(e)}")
+    return count
+
+
+def adjust_unread(deltas):
+    """Suma {user_id: delta} a los contadores existentes al hacer commit"""
+    deltas = {user_id: delta for user_id, delta in Counter(deltas).items() if delta}
+    if deltas:
+        transaction.on_commit(lambda: _apply(deltas))
+
+
+def _apply(deltas):
+    for user_id, delta in deltas.items():
+        try:
+            # incr solo actúa si la clave existe; si no, el próximo lector recalcula
+            cache.incr(_unread_key(user_id), delta)
+        except ValueError:
+            pass
+        except Exception as e:
+            logger.warning(f"No se pudo ajustar el contador de no leídas: {str(e)}")
+
+
+def reset_unread(user_id):
+    def reset():
+        try:
+            cache.set(_unread_key(user_id), 0, UNREAD_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"No se pudo reiniciar el contador de no leídas: {str(e)}")
+    transaction.on_commit(reset)
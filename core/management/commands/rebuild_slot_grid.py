@@ -0,0 +1,50 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.models import Court, CourtSlotGrid
+from core.signals import send_occupancy_changed
+
+
+class Command(BaseCommand):
+    help = 'Reconstruye la ocupación materializada (CourtSlotGrid) para un rango de fechas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', required=True, help='Fecha inicial (YYYY-MM-DD)')
+        parser.add_argument('--end', help='Fecha final inclusive (YYYY-MM-DD); por defecto igual a --start')
+        parser.add_argument('--court', type=int, action='append', dest='courts',
+                            help='ID de cancha; se puede repetir. Por defecto todas')
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start'])
+            end = date.fromisoformat(options['end'] or options['start'])
+        except ValueError:
+            raise CommandError('Formato de fecha inválido, use YYYY-MM-DD')
+        if end < start:
+            raise CommandError('--end debe ser igual o posterior a --start')
+
+        courts = Court.objects.all()
+        if options['courts']:
+            courts = courts.filter(id__in=options['courts'])
+        court_ids = list(courts.values_list('id', flat=True))
+        if not court_ids:
+            raise CommandError('No hay canchas que reconstruir')
+
+        total_changed = 0
+        day = start
+        while day <= end:
+            # Una transacción corta por día: solo se bloquean las filas de ese
+            # día y las reservas en curso esperan a lo sumo esa reconstrucción
+            with transaction.atomic():
+                changed = CourtSlotGrid.objects.rebuild((court_id, day) for court_id in court_ids)
+                send_occupancy_changed(changed)
+            total_changed += len(changed)
+            if changed:
+                self.stdout.write(f"{day}: {len(changed)} cancha(s) corregida(s)")
+            day += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Ocupación reconstruida del {start} al {end}; {total_changed} fila(s) corregida(s)"
+        ))
@@ -0,0 +1,77 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core.exceptions import StatementError
+from core.reconciliation import apply_matches, cents_to_decimal, iter_statement, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Concilia un estado de cuenta (CSV u OFX) con los pagos Pago Móvil y Zelle '
+        'pendientes de validar. Con --apply aprueba los matches en nombre de --admin'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Archivo del estado de cuenta')
+        parser.add_argument('--format', choices=['csv', 'ofx'], help='Por defecto según la extensión')
+        parser.add_argument('--encoding', help='Codificación del archivo (por defecto UTF-8 o, si no lo es, cp1252)')
+        parser.add_argument('--date-format', help='Formato strptime de las fechas, p. ej. %%d/%%m/%%Y')
+        parser.add_argument('--window-days', type=int,
+                            help='Días de diferencia admitidos (RECONCILIATION_DATE_WINDOW_DAYS por defecto)')
+        parser.add_argument('--apply', action='store_true', help='Aprueba los pagos de los matches')
+        parser.add_argument('--admin', help='Usuario administrador que aprueba los pagos (requerido con --apply)')
+        parser.add_argument('--json', action='store_true', help='Escribe el resultado completo en JSON')
+
+    def handle(self, *args, **options):
+        admin = None
+        if options['apply']:
+            if not options['admin']:
+                raise CommandError('--apply requiere --admin')
+            admin = User.objects.filter(username=options['admin'], is_staff=True).first()
+            if admin is None:
+                raise CommandError(f"No existe el administrador {options['admin']}")
+
+        errors = []
+        try:
+            with open(options['path'], 'rb') as statement:
+                lines = iter_statement(
+                    statement, name=options['path'], format=options['format'],
+                    encoding=options['encoding'], date_format=options['date_format'], errors=errors
+                )
+                # Sin --json solo se cuentan las huérfanas
+                result = reconcile(
+                    lines, window_days=options['window_days'],
+                    orphan_limit=None if options['json'] else 0, errors=errors
+                )
+        except OSError as e:
+            raise CommandError(f'No se pudo leer el archivo: {e}')
+        except StatementError as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(result.as_dict(), indent=2, ensure_ascii=False))
+        else:
+            for line, payment_ids, reason in result.ambiguous:
+                self.stdout.write(
+                    f"Línea {line.line}: {line.date} {cents_to_decimal(line.amount)} ref. {line.reference or '-'} "
+                    f"→ pagos {', '.join(map(str, payment_ids))} ({reason})"
+                )
+            for number, error in errors[:20]:
+                self.stderr.write(f'Línea {number}: {error}')
+
+        summary = result.summary()
+        self.stdout.write(self.style.SUCCESS(
+            f"{summary['lines']} líneas en {summary['elapsed']}s: {summary['matched']} matches, "
+            f"{summary['ambiguous']} ambiguas, {summary['orphans']} huérfanas, "
+            f"{summary['skipped']} débitos, {summary['errors']} ilegibles"
+        ))
+
+        if admin is not None and result.matches:
+            applied = apply_matches(result, admin)
+            validated = sum(1 for item in applied if item['ok'])
+            for item in applied:
+                if not item['ok']:
+                    self.stderr.write(f"Pago {item['payment_id']}: {item['error']}")
+            self.stdout.write(self.style.SUCCESS(f'{validated} pago(s) aprobados'))
@@ -0,0 +1,173 @@
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import requests
+from django.core.management.base import BaseCommand
+
+INTENT_PATH = re.compile(r'^/v1/payment_intents(?:/(?P<intent_id>[^/]+))?(?:/(?P<action>confirm|cancel))?$')
+
+# Errores que devuelve la API de Stripe, con su cuerpo
+ERRORS = {
+    429: {'type': 'invalid_request_error', 'code': 'rate_limit', 'message': 'Too many requests'},
+    500: {'type': 'api_error', 'message': 'An unknown error occurred'},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Servidor que simula los PaymentIntents de la API de Stripe (crear, consultar, '
+        'confirmar y cancelar) con latencia y errores configurables. Use '
+        'STRIPE_API_BASE=http://127.0.0.1:<puerto>. Con --webhook-url envía los '
+        'eventos payment_intent.* firmados con --webhook-secret'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8098)
+        parser.add_argument('--latency-ms', type=int, default=200, help='Latencia media por petición')
+        parser.add_argument('--jitter-ms', type=int, default=50, help='Variación de la latencia (±)')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fracción de peticiones que fallan con 429/500 (0-1)')
+        parser.add_argument('--webhook-url', help='URL del webhook, p. ej. http://127.0.0.1:8000/api/payments/webhook/')
+        parser.add_argument('--webhook-secret', default='whsec_stub')
+
+    def handle(self, *args, **options):
+        command = self
+        intents = {}
+        lock = threading.Lock()
+
+        def send_event(event_type, intent):
+            if not options['webhook_url']:
+                return
+            payload = json.dumps({
+                'id': f'evt_{uuid.uuid4().hex[:24]}',
+                'object': 'event',
+                'type': event_type,
+                'created': int(time.time()),
+                'data': {'object': intent},
+            })
+            timestamp = int(time.time())
+            signature = hmac.new(
+                options['webhook_secret'].encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256
+            ).hexdigest()
+            try:
+                requests.post(options['webhook_url'], data=payload, timeout=5, headers={
+                    'Content-Type': 'application/json',
+                    'Stripe-Signature': f't={timestamp},v1={signature}',
+                })
+            except requests.RequestException as e:
+                command.stderr.write(f'No se pudo enviar {event_type}: {e}')
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def _handle(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                params = dict(parse_qsl(self.rfile.read(length).decode()))
+
+                delay = options['latency_ms'] + random.uniform(-options['jitter_ms'], options['jitter_ms'])
+                time.sleep(max(delay, 0) / 1000)
+
+                if not self.headers.get('Authorization', '').startswith('Bearer '):
+                    return self._error(401, {'type': 'invalid_request_error', 'message': 'Invalid API Key provided'})
+                if random.random() < options['error_rate']:
+                    status = random.choice(list(ERRORS))
+                    return self._error(status, ERRORS[status])
+
+                match = INTENT_PATH.match(self.path.split('?')[0])
+                if not match:
+                    return self._error(404, {'type': 'invalid_request_error', 'message': 'Unrecognized request URL'})
+                intent_id, action = match.group('intent_id'), match.group('action')
+
+                if intent_id is None:
+                    if method != 'POST':
+                        return self._error(404, {'type': 'invalid_request_error', 'message': 'Unrecognized request URL'})
+                    return self._create(params)
+
+                with lock:
+                    intent = intents.get(intent_id)
+                if intent is None:
+                    return self._error(404, {
+                        'type': 'invalid_request_error', 'code': 'resource_missing',
+                        'message': f"No such payment_intent: '{intent_id}'"
+                    })
+                if action == 'confirm':
+                    intent['status'] = 'succeeded'
+                    intent['amount_received'] = intent['amount']
+                    send_event('payment_intent.succeeded', intent)
+                elif action == 'cancel':
+                    intent['status'] = 'canceled'
+                    send_event('payment_intent.canceled', intent)
+                self._reply(200, intent)
+
+            def _create(self, params):
+                try:
+                    amount = int(params['amount'])
+                    currency = params['currency']
+                except (KeyError, ValueError):
+                    return self._error(400, {
+                        'type': 'invalid_request_error', 'message': 'Missing required param: amount or currency'
+                    })
+                intent_id = f'pi_{uuid.uuid4().hex[:24]}'
+                intent = {
+                    'id': intent_id,
+                    'object': 'payment_intent',
+                    'amount': amount,
+                    'amount_received': 0,
+                    'currency': currency,
+                    'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:24]}',
+                    'created': int(time.time()),
+                    'livemode': False,
+                    'metadata': {
+                        key[len('metadata['):-1]: value
+                        for key, value in params.items() if key.startswith('metadata[')
+                    },
+                    'status': 'requires_payment_method',
+                }
+                with lock:
+                    intents[intent_id] = intent
+                self._reply(200, intent)
+
+            def _error(self, status, error):
+                self._reply(status, {'error': error})
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                if command.verbosity > 1:
+                    command.stdout.write(format % args)
+
+        self.verbosity = options['verbosity']
+        # Accesible para detenerlo con server.shutdown() si corre en un hilo
+        self.server = server = ThreadingHTTPServer((options['host'], options['port']), Handler)
+        self.stdout.write(self.style.SUCCESS(
+            f"Stub de Stripe en http://{options['host']}:{options['port']} "
+            f"(latencia {options['latency_ms']}ms, errores {options['error_rate']:.0%})"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,96 @@
+import json
+import random
+import re
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+MESSAGES_PATH = re.compile(r'^/(?P<version>[^/]+)/(?P<phone_number_id>[^/]+)/messages$')
+
+# Errores que devuelve la Graph API, con su cuerpo
+ERRORS = {
+    429: {'message': '(#130429) Rate limit hit', 'type': 'OAuthException', 'code': 130429},
+    500: {'message': 'An unknown error occurred', 'type': 'OAuthException', 'code': 1},
+    503: {'message': 'Service temporarily unavailable', 'type': 'OAuthException', 'code': 2},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Servidor que simula la API de WhatsApp Cloud (POST /<versión>/<phone_id>/messages) '
+        'con latencia y errores configurables. Use WHATSAPP_API_URL=http://127.0.0.1:<puerto>/v17.0'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8099)
+        parser.add_argument('--latency-ms', type=int, default=150, help='Latencia media por petición')
+        parser.add_argument('--jitter-ms', type=int, default=50, help='Variación de la latencia (±)')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fracción de peticiones que fallan con 429/500/503 (0-1)')
+        parser.add_argument('--retry-after', type=int, default=1,
+                            help='Segundos de Retry-After en las respuestas 429')
+
+    def handle(self, *args, **options):
+        command = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+
+                delay = options['latency_ms'] + random.uniform(-options['jitter_ms'], options['jitter_ms'])
+                time.sleep(max(delay, 0) / 1000)
+
+                if not MESSAGES_PATH.match(self.path):
+                    return self._reply(404, {'error': {'message': 'Unknown path', 'code': 100}})
+                if not self.headers.get('Authorization', '').startswith('Bearer '):
+                    return self._reply(401, {'error': {'message': 'Invalid OAuth access token', 'code': 190}})
+
+                if random.random() < options['error_rate']:
+                    status = random.choice(list(ERRORS))
+                    headers = {'Retry-After': str(options['retry_after'])} if status == 429 else {}
+                    return self._reply(status, {'error': ERRORS[status]}, headers)
+
+                try:
+                    to_phone = json.loads(body)['to']
+                except (ValueError, KeyError):
+                    return self._reply(400, {'error': {'message': 'Invalid parameter', 'code': 100}})
+
+                self._reply(200, {
+                    'messaging_product': 'whatsapp',
+                    'contacts': [{'input': to_phone, 'wa_id': to_phone}],
+                    'messages': [{'id': f'wamid.{uuid.uuid4().hex}'}]
+                })
+
+            def _reply(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                if command.verbosity > 1:
+                    command.stdout.write(format % args)
+
+        self.verbosity = options['verbosity']
+        # Accesible para detenerlo con server.shutdown() si corre en un hilo
+        self.server = server = ThreadingHTTPServer((options['host'], options['port']), Handler)
+        self.stdout.write(self.style.SUCCESS(
+            f"Stub de WhatsApp en http://{options['host']}:{options['port']} "
+            f"(latencia {options['latency_ms']}ms, errores {options['error_rate']:.0%})"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
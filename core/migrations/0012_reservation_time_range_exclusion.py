@@ -0,0 +1,72 @@
+# Generated by Django 4.2 on 2026-10-18 07:27
+
+from django.conf import settings
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+
+OVERLAPS_SQL = """
+SELECT a.id, b.id, a.court_id, a.date, a.start_time, a.end_time, b.start_time, b.end_time
+FROM core_reservation a
+JOIN core_reservation b
+  ON b.court_id = a.court_id AND b.id > a.id AND b.time_range && a.time_range
+WHERE a.status IN ('PENDING', 'CONFIRMED') AND b.status IN ('PENDING', 'CONFIRMED')
+ORDER BY a.date, a.court_id, a.start_time
+"""
+
+
+def check_existing_overlaps(apps, schema_editor):
+    """
+    La restricción no se puede crear si ya hay reservas activas solapadas. No
+    se cancela ninguna automáticamente (pueden tener pagos): se listan para
+    que un administrador cancele una de cada par y se vuelva a migrar.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(OVERLAPS_SQL)
+        overlaps = cursor.fetchall()
+    if not overlaps:
+        return
+    lines = [
+        f"  reservas {first} y {second}: cancha {court}, {date} "
+        f"{first_start}-{first_end} / {second_start}-{second_end}"
+        for first, second, court, date, first_start, first_end, second_start, second_end in overlaps[:50]
+    ]
+    if len(overlaps) > 50:
+        lines.append(f"  ... y {len(overlaps) - 50} pares más")
+    raise RuntimeError(
+        f"Hay {len(overlaps)} pares de reservas PENDING/CONFIRMED solapadas y no se puede crear "
+        "reservation_no_overlap. Cancele una reserva de cada par y vuelva a ejecutar migrate:\n"
+        + "\n".join(lines)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_payment_zelle_email_payment_zelle_holder_and_more'),
+    ]
+
+    operations = [
+        # Necesaria para combinar igualdad de cancha con solapamiento de rangos en GiST
+        BtreeGistExtension(),
+        migrations.AddField(
+            model_name='reservation',
+            name='time_range',
+            field=django.contrib.postgres.fields.ranges.DateTimeRangeField(blank=True, editable=False, null=True, verbose_name='Rango horario'),
+        ),
+        migrations.RunSQL(
+            sql=[(
+                "UPDATE core_reservation SET time_range = tstzrange("
+                "(date + start_time) AT TIME ZONE %s, "
+                "(date + end_time) AT TIME ZONE %s, '[)')",
+                [settings.TIME_ZONE, settings.TIME_ZONE]
+            )],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(check_existing_overlaps, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='reservation',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('status__in', ['PENDING', 'CONFIRMED'])), expressions=[('court', '='), ('time_range', '&&')], name='reservation_no_overlap', violation_error_message='Ya existe una reserva para este horario'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_reservation_time_range_exclusion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='series_id',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True, verbose_name='Serie'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2 on 2026-10-18 07:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_reservation_series_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourtSlotGrid',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Fecha')),
+                ('occupancy', models.CharField(default='000000000000000000000000', max_length=24, verbose_name='Ocupación')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Fecha de actualización')),
+                ('court', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_grids', to='core.court', verbose_name='Cancha')),
+            ],
+            options={
+                'verbose_name': 'Ocupación diaria',
+                'verbose_name_plural': 'Ocupación diaria',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='courtslotgrid',
+            constraint=models.UniqueConstraint(fields=('court', 'date'), name='court_slot_grid_unique'),
+        ),
+    ]
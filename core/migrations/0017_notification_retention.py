@@ -0,0 +1,86 @@
+# Generated by Django 4.2 on 2026-10-18 07:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_archive_table(apps, schema_editor):
+    model = apps.get_model('core', 'NotificationArchive')
+    if not (settings.NOTIFICATION_ARCHIVE_PARTITIONED and schema_editor.connection.vendor == 'postgresql'):
+        schema_editor.create_model(model)
+        return
+
+    # Particionada por mes de archived_at: la clave primaria debe incluirla.
+    # Las particiones mensuales las crea core.retention antes de archivar;
+    # DEFAULT recoge cualquier fila fuera de ellas.
+    schema_editor.execute(
+        "CREATE TABLE core_notificationarchive ("
+        " id bigint NOT NULL,"
+        " user_id integer NOT NULL,"
+        " type varchar(20) NOT NULL,"
+        " title varchar(100) NOT NULL,"
+        " message text NOT NULL,"
+        " read boolean NOT NULL,"
+        " created_at timestamp with time zone NOT NULL,"
+        " archived_at timestamp with time zone NOT NULL,"
+        " PRIMARY KEY (id, archived_at)"
+        ") PARTITION BY RANGE (archived_at)"
+    )
+    schema_editor.execute(
+        "CREATE TABLE core_notificationarchive_default PARTITION OF core_notificationarchive DEFAULT"
+    )
+    schema_editor.execute(
+        "CREATE INDEX notification_archive_user_idx ON core_notificationarchive (user_id, created_at DESC)"
+    )
+    schema_editor.execute(
+        "CREATE INDEX notification_archive_at_idx ON core_notificationarchive (archived_at)"
+    )
+
+
+def drop_archive_table(apps, schema_editor):
+    schema_editor.execute("DROP TABLE IF EXISTS core_notificationarchive CASCADE")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_notification_inbox_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='NotificationArchive',
+                    fields=[
+                        ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                        ('user_id', models.IntegerField()),
+                        ('type', models.CharField(max_length=20)),
+                        ('title', models.CharField(max_length=100)),
+                        ('message', models.TextField()),
+                        ('read', models.BooleanField(default=False)),
+                        ('created_at', models.DateTimeField()),
+                        ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                    ],
+                    options={
+                        'verbose_name': 'Notificación archivada',
+                        'verbose_name_plural': 'Notificaciones archivadas',
+                    },
+                ),
+                migrations.AddIndex(
+                    model_name='notificationarchive',
+                    index=models.Index(fields=['user_id', '-created_at'], name='notification_archive_user_idx'),
+                ),
+                migrations.AddIndex(
+                    model_name='notificationarchive',
+                    index=models.Index(fields=['archived_at'], name='notification_archive_at_idx'),
+                ),
+            ],
+        ),
+        migrations.RunPython(create_archive_table, drop_archive_table),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['type', 'created_at'], name='notification_retention_idx'),
+        ),
+    ]
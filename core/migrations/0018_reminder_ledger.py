@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 07:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_notification_retention'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('RESERVATION', 'Recordatorio de reserva'), ('PAYMENT', 'Recordatorio de pago')], max_length=12)),
+                ('window_start', models.DateTimeField()),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='core.reservation')),
+            ],
+            options={
+                'verbose_name': 'Recordatorio enviado',
+                'verbose_name_plural': 'Recordatorios enviados',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='reminderledger',
+            index=models.Index(fields=['window_start'], name='reminder_ledger_window_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='reminderledger',
+            constraint=models.UniqueConstraint(fields=('reservation', 'kind', 'window_start'), name='reminder_ledger_unique'),
+        ),
+    ]
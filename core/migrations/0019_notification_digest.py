@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 07:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_reminder_ledger'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='type',
+            field=models.CharField(choices=[('PAYMENT_PENDING', 'Pago Pendiente'), ('PAYMENT_STATUS', 'Estado de Pago'), ('DIGEST', 'Resumen')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='notificationoutbox',
+            name='notification',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='outbox_entries', to='core.notification'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 07:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0020_stripe_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='claim_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='claimed_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_claims', to=settings.AUTH_USER_MODEL, verbose_name='Tomado por'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('payment_type__in', ['PAGOMOVIL', 'ZELLE']), ('status__in', ['PENDING', 'PENDING_VALIDATION'])), fields=['created_at', 'id'], name='payment_validation_queue_idx'),
+        ),
+    ]
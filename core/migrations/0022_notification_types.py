@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_payment_validation_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='type',
+            field=models.CharField(choices=[('PAYMENT_PENDING', 'Pago Pendiente'), ('PAYMENT_STATUS', 'Estado de Pago'), ('PAYMENT_REMINDER', 'Recordatorio de Pago'), ('RESERVATION_CREATED', 'Reserva Creada'), ('RESERVATION_REMINDER', 'Recordatorio de Reserva'), ('DIGEST', 'Resumen')], max_length=20),
+        ),
+    ]
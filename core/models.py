@@ -1,8 +1,19 @@
-from django.db import models
+from datetime import datetime, timezone as dt_timezone
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Q
 from django.contrib.auth.models import User
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateTimeRangeField, RangeOperators
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from psycopg2.errorcodes import EXCLUSION_VIOLATION
+from psycopg2.extras import DateTimeTZRange
+
+from .availability import (
+    ACTIVE_STATUSES, CELLS_PER_DAY, DayOccupancy, build_occupancy, span_mask, time_to_cell
+)
+from .catalog import court_catalog, parse_schedule
 
 class Court(models.Model):
     name = models.CharField('Nombre', max_length=50)
@@ -25,17 +36,28 @@ class Court(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Horario tal como se cargó, para detectar cambios al guardar
+        instance._loaded_schedule = instance.schedule_state()
+        return instance
+
+    def schedule_state(self):
+        return (
+            self.__dict__.get('opening_time'),
+            self.__dict__.get('closing_time'),
+            self.__dict__.get('available_days')
+        )
+
     def is_available(self, date, start_time):
-        # Validar día de la semana
-        weekday = str(date.isoweekday())  # 1-7 (Lunes-Domingo)
-        if weekday not in self.available_days:
-            return False, "La cancha no está disponible este día"
-            
-        # Validar horario
-        if start_time < self.opening_time or start_time >= self.closing_time:
-            return False, "Horario fuera del horario de operación"
-            
-        return True, "Disponible"
+        # Horario ya procesado del catálogo, salvo que la instancia tenga
+        # cambios sin guardar en su horario
+        entry = None
+        if getattr(self, '_loaded_schedule', None) == self.schedule_state():
+            entry = court_catalog.get(self.pk)
+        schedule = entry.schedule if entry else parse_schedule(*self.schedule_state())
+        return schedule.is_available(date, start_time)
 
 class Membership(models.Model):
     MEMBERSHIP_TYPES = [
@@ -79,15 +101,60 @@ class Reservation(models.Model):
         decimal_places=2,
         default=0.00
     )
+    # Intervalo [inicio, fin) derivado de date/start_time/end_time; lo usa la
+    # restricción de exclusión para impedir solapamientos en PostgreSQL
+    time_range = DateTimeRangeField('Rango horario', null=True, blank=True, editable=False)
+    # Reservas creadas juntas como serie recurrente (p. ej. todos los martes)
+    series_id = models.UUIDField('Serie', null=True, blank=True, db_index=True, editable=False)
+
+    # Campos que definen el horario; si un save() no toca ninguno no se revalida
+    SCHEDULE_FIELDS = frozenset({'court', 'court_id', 'date', 'start_time', 'end_time'})
     
     class Meta:
         verbose_name = 'Reserva'
         verbose_name_plural = 'Reservas'
         ordering = ['-date', '-start_time']
+        constraints = [
+            ExclusionConstraint(
+                name='reservation_no_overlap',
+                expressions=[
+                    ('court', RangeOperators.EQUAL),
+                    ('time_range', RangeOperators.OVERLAPS),
+                ],
+                condition=Q(status__in=['PENDING', 'CONFIRMED']),
+                violation_error_message='Ya existe una reserva para este horario',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.court} - {self.date} {self.start_time}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Ocupación tal como se cargó, para invalidar solo lo que cambia
+        instance._loaded_occupancy = instance.occupancy_state()
+        return instance
+
+    def occupancy_state(self):
+        """(court_id, date, start_time, end_time) si la reserva ocupa la cancha, si no None"""
+        if self.__dict__.get('status') not in ACTIVE_STATUSES:
+            return None
+        return (
+            self.__dict__.get('court_id'),
+            self.__dict__.get('date'),
+            self.__dict__.get('start_time'),
+            self.__dict__.get('end_time')
+        )
+
+    @staticmethod
+    def build_time_range(date, start_time, end_time):
+        return DateTimeTZRange(
+            timezone.make_aware(datetime.combine(date, start_time)),
+            timezone.make_aware(datetime.combine(date, end_time)),
+            '[)'
+        )
+
     def clean(self):
         # Validar que la fecha no sea en el pasado
         if self.date < timezone.now().date():
@@ -97,21 +164,165 @@ class Reservation(models.Model):
         if self.end_time <= self.start_time:
             raise ValidationError('La hora de fin debe ser posterior a la hora de inicio')
 
-        # Validar que no haya reservas superpuestas para la misma cancha
-        overlapping = Reservation.objects.filter(
-            court=self.court,
-            date=self.date,
-            status__in=['PENDING', 'CONFIRMED']
-        ).exclude(id=self.id)
+        # El solapamiento lo impide la restricción reservation_no_overlap
+        self.time_range = self.build_time_range(self.date, self.start_time, self.end_time)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.SCHEDULE_FIELDS & set(update_fields):
+            self.clean()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'time_range'}
 
-        for reservation in overlapping:
-            if (self.start_time < reservation.end_time and 
-                self.end_time > reservation.start_time):
+        try:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+        except IntegrityError as e:
+            if getattr(e.__cause__, 'pgcode', None) == EXCLUSION_VIOLATION:
                 raise ValidationError('Ya existe una reserva para este horario')
+            raise
 
-    def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
+class CourtSlotGridManager(models.Manager):
+    """
+    Mantiene la tabla materializada de ocupación. Toda escritura bloquea la
+    fila (court, date) con SELECT ... FOR UPDATE, en orden, dentro de la
+    transacción de la reserva: las actualizaciones incrementales y las
+    reconstrucciones se serializan por día y nunca se pisan.
+    """
+
+    def _locked(self, pairs):
+        """
+        Bloquea las filas de los pares dados y devuelve {pair: grid}. Las que no
+        existen se crean a partir de las reservas, de modo que una fila presente
+        siempre refleja el día completo.
+        """
+        pairs = sorted(set(pairs))
+        grids = self._select_for_update(pairs)
+        missing = [pair for pair in pairs if pair not in grids]
+        if missing:
+            computed = self._compute(missing)
+            # Si otra transacción la crea a la vez, su fila gana y aquí se bloquea
+            self.bulk_create(
+                [self.model(court_id=c, date=d, mask=computed[(c, d)].mask) for c, d in missing],
+                ignore_conflicts=True
+            )
+            grids.update(self._select_for_update(missing))
+        return grids
+
+    def _select_for_update(self, pairs):
+        court_ids = {court_id for court_id, _ in pairs}
+        dates = {date for _, date in pairs}
+        rows = self.select_for_update().filter(
+            court_id__in=court_ids, date__in=dates
+        ).order_by('court_id', 'date')
+        wanted = set(pairs)
+        return {(g.court_id, g.date): g for g in rows if (g.court_id, g.date) in wanted}
+
+    def _compute(self, pairs):
+        rows = Reservation.objects.filter(
+            court_id__in={court_id for court_id, _ in pairs},
+            date__in={date for _, date in pairs},
+            status__in=ACTIVE_STATUSES
+        ).values('court_id', 'date', 'start_time', 'end_time')
+        computed = build_occupancy(rows)
+        return {pair: computed.get(pair, DayOccupancy()) for pair in pairs}
+
+    def apply_change(self, previous, current):
+        """
+        Aplica el cambio de una reserva, de `previous` a `current` (estados de
+        Reservation.occupancy_state(), o None). Ocupar es un OR sobre la fila;
+        liberar borra los bits si el tramo está alineado a celdas y, si no,
+        recalcula el día porque otra reserva podría compartir la celda de borde.
+        """
+        occupy, release, recompute = {}, {}, set()
+        if previous:
+            pair, (start_time, end_time) = tuple(previous[:2]), previous[2:]
+            if time_to_cell(start_time) == time_to_cell(start_time, round_up=True) \
+                    and time_to_cell(end_time) == time_to_cell(end_time, round_up=True):
+                release[pair] = span_mask(start_time, end_time)
+            else:
+                recompute.add(pair)
+        if current:
+            pair = tuple(current[:2])
+            occupy[pair] = span_mask(*current[2:])
+
+        grids = self._locked(set(occupy) | set(release) | recompute)
+        computed = self._compute(sorted(recompute)) if recompute else {}
+        for pair, grid in grids.items():
+            mask = computed[pair].mask if pair in computed else grid.mask & ~release.get(pair, 0)
+            grid.mask = mask | occupy.get(pair, 0)
+            grid.save(update_fields=['occupancy', 'updated_at'])
+
+    def rebuild(self, pairs):
+        """Recalcula desde Reservation las filas de los pares dados"""
+        grids = self._locked(pairs)
+        computed = self._compute(list(grids))
+        changed = []
+        for pair, grid in grids.items():
+            if grid.mask != computed[pair].mask:
+                grid.mask = computed[pair].mask
+                grid.save(update_fields=['occupancy', 'updated_at'])
+                changed.append(pair)
+        return changed
+
+    def load(self, pairs):
+        """
+        Ocupación de varios (court_id, date) leyendo la tabla materializada con
+        una sola consulta; los días sin fila se calculan y se materializan.
+        """
+        pairs = list(pairs)
+        rows = self.filter(
+            court_id__in={court_id for court_id, _ in pairs},
+            date__in={date for _, date in pairs}
+        ).values_list('court_id', 'date', 'occupancy')
+        stored = {(court_id, date): occupancy for court_id, date, occupancy in rows}
+
+        result = {}
+        missing = []
+        for pair in pairs:
+            if pair in stored:
+                result[pair] = DayOccupancy(int(stored[pair], 16))
+            else:
+                missing.append(pair)
+
+        if missing:
+            computed = self._compute(missing)
+            # Si una reserva concurrente ya creó la fila, la suya prevalece
+            self.bulk_create(
+                [self.model(court_id=c, date=d, mask=computed[(c, d)].mask) for c, d in missing],
+                ignore_conflicts=True
+            )
+            result.update(computed)
+        return result
+
+
+class CourtSlotGrid(models.Model):
+    """Ocupación materializada de una cancha en un día (bitmap de celdas en hexadecimal)"""
+
+    court = models.ForeignKey(Court, verbose_name='Cancha', on_delete=models.CASCADE, related_name='slot_grids')
+    date = models.DateField('Fecha')
+    occupancy = models.CharField('Ocupación', max_length=CELLS_PER_DAY // 4, default='0' * (CELLS_PER_DAY // 4))
+    updated_at = models.DateTimeField('Fecha de actualización', auto_now=True)
+
+    objects = CourtSlotGridManager()
+
+    class Meta:
+        verbose_name = 'Ocupación diaria'
+        verbose_name_plural = 'Ocupación diaria'
+        constraints = [
+            models.UniqueConstraint(fields=['court', 'date'], name='court_slot_grid_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.court_id} - {self.date}"
+
+    @property
+    def mask(self):
+        return int(self.occupancy, 16)
+
+    @mask.setter
+    def mask(self, value):
+        self.occupancy = format(value, f'0{CELLS_PER_DAY // 4}x')
 
 class Payment(models.Model):
     PAYMENT_TYPES = [
@@ -207,12 +418,39 @@ class Payment(models.Model):
         help_text='Nombre del titular de la cuenta Zelle'
     )
     
+    # Reserva temporal del pago por un administrador en la cola de validación
+    # (PaymentValidationQueue); vencida claim_expires_at, otro puede tomarlo
+    claimed_by = models.ForeignKey(
+        'auth.User',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='payment_claims',
+        verbose_name='Tomado por'
+    )
+    claim_expires_at = models.DateTimeField(null=True, blank=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Pagos que validan los administradores a mano
+    VALIDATION_STATUSES = ('PENDING', 'PENDING_VALIDATION')
+    VALIDATION_TYPES = ('PAGOMOVIL', 'ZELLE')
+
     class Meta:
         verbose_name = 'Pago'
         verbose_name_plural = 'Pagos'
+        indexes = [
+            # Cola de validación: solo las filas pendientes, en orden de llegada
+            models.Index(
+                fields=['created_at', 'id'],
+                condition=Q(
+                    status__in=['PENDING', 'PENDING_VALIDATION'],
+                    payment_type__in=['PAGOMOVIL', 'ZELLE']
+                ),
+                name='payment_validation_queue_idx'
+            ),
+        ]
 
     def clean(self):
         super().clean()
@@ -237,10 +475,36 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"Perfil de {self.user.username}"
 
+class NotificationManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create no dispara post_save: el contador de no leídas se ajusta aquí
+        from .inbox import adjust_unread
+
+        created = super().bulk_create(objs, *args, **kwargs)
+        deltas = {}
+        for notification in created:
+            if not notification.read:
+                deltas[notification.user_id] = deltas.get(notification.user_id, 0) + 1
+        adjust_unread(deltas)
+        return created
+
+    def mark_all_read(self, user):
+        """Marca como leídas todas las notificaciones del usuario con un solo UPDATE"""
+        from .inbox import reset_unread
+
+        updated = self.filter(user=user, read=False).update(read=True)
+        reset_unread(user.pk)
+        return updated
+
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = [
         ('PAYMENT_PENDING', 'Pago Pendiente'),
         ('PAYMENT_STATUS', 'Estado de Pago'),
+        ('PAYMENT_REMINDER', 'Recordatorio de Pago'),
+        ('RESERVATION_CREATED', 'Reserva Creada'),
+        ('RESERVATION_REMINDER', 'Recordatorio de Reserva'),
+        ('DIGEST', 'Resumen'),
     ]
 
     user = models.ForeignKey(
@@ -254,10 +518,226 @@ class Notification(models.Model):
     read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = NotificationManager()
+
     class Meta:
         ordering = ['-created_at']
         verbose_name = 'Notificación'
         verbose_name_plural = 'Notificaciones'
+        indexes = [
+            # Bandeja del usuario y conteo/listado de no leídas
+            models.Index(fields=['user', '-created_at'], name='notification_inbox_idx'),
+            models.Index(fields=['user', 'read', '-created_at'], name='notification_unread_idx'),
+            # Barrido de retención por tipo y antigüedad
+            models.Index(fields=['type', 'created_at'], name='notification_retention_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} - {self.user.username}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Estado de lectura tal como se cargó, para ajustar el contador al guardar
+        instance._loaded_read = instance.__dict__.get('read')
+        return instance
+
+class NotificationArchive(models.Model):
+    """
+    Notificaciones retiradas por la política de retención (core.retention).
+    Conserva el id original; con NOTIFICATION_ARCHIVE_PARTITIONED la tabla está
+    particionada por mes de archived_at y caduca borrando particiones enteras.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    # Sin clave foránea: el archivo no debe impedir borrar usuarios
+    user_id = models.IntegerField()
+    type = models.CharField(max_length=20)
+    title = models.CharField(max_length=100)
+    message = models.TextField()
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Notificación archivada'
+        verbose_name_plural = 'Notificaciones archivadas'
+        indexes = [
+            models.Index(fields=['user_id', '-created_at'], name='notification_archive_user_idx'),
+            models.Index(fields=['archived_at'], name='notification_archive_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.title} (archivada)"
+
+class NotificationOutbox(models.Model):
+    """
+    Bandeja de salida de notificaciones. Se escribe en la misma transacción que
+    el cambio que la origina; tasks.dispatch_notification_outbox la entrega por
+    lotes a Notification (en la app) y a WhatsApp.
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pendiente'),
+        ('SENT', 'Enviada'),
+        ('FAILED', 'Fallida'),
+    ]
+
+    user = models.ForeignKey(
+        'auth.User',
+        on_delete=models.CASCADE,
+        related_name='outbox_notifications'
+    )
+    type = models.CharField(max_length=20)
+    title = models.CharField(max_length=100)
+    message = models.TextField()
+    send_whatsapp = models.BooleanField('Enviar por WhatsApp', default=True)
+    # Clave de idempotencia opcional: un mismo evento no se encola dos veces
+    key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    # Varias filas comparten Notification cuando se entregan como resumen
+    notification = models.ForeignKey(
+        Notification,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='outbox_entries'
+    )
+    whatsapp_sent_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Notificación en cola'
+        verbose_name_plural = 'Notificaciones en cola'
+        indexes = [
+            models.Index(
+                fields=['available_at', 'id'],
+                condition=Q(status='PENDING'),
+                name='outbox_pending_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.title} - {self.get_status_display()}"
+
+class ReminderLedgerManager(models.Manager):
+    def pending(self, queryset, kind, window):
+        """Reservas del queryset sin recordatorio de este tipo en la ventana (un solo NOT EXISTS)"""
+        return queryset.exclude(models.Exists(self.filter(
+            reservation=models.OuterRef('pk'),
+            kind=kind,
+            window_start=window
+        )))
+
+    def claim(self, kind, window, reservation_ids):
+        """
+        Registra los envíos y devuelve los ids de reserva que no estaban ya en
+        el registro. Con ON CONFLICT DO NOTHING dos ejecuciones simultáneas no
+        pueden reclamar la misma reserva.
+        """
+        if not reservation_ids:
+            return set()
+        table = self.model._meta.db_table
+        now = timezone.now()
+        rows = [(reservation_id, kind, window, now) for reservation_id in reservation_ids]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (reservation_id, kind, window_start, sent_at) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s)'] * len(rows))} "
+                f"ON CONFLICT (reservation_id, kind, window_start) DO NOTHING "
+                f"RETURNING reservation_id",
+                [value for row in rows for value in row]
+            )
+            return {reservation_id for (reservation_id,) in cursor.fetchall()}
+
+class ReminderLedger(models.Model):
+    """
+    Recordatorios ya enviados, uno por (reserva, tipo, ventana). Las tareas
+    periódicas descartan con él las reservas ya avisadas en la ventana en curso.
+    """
+    KIND_CHOICES = [
+        ('RESERVATION', 'Recordatorio de reserva'),
+        ('PAYMENT', 'Recordatorio de pago'),
+    ]
+
+    reservation = models.ForeignKey(
+        Reservation,
+        on_delete=models.CASCADE,
+        related_name='reminders'
+    )
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+    # Inicio de la ventana (UTC) en la que se envió
+    window_start = models.DateTimeField()
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    objects = ReminderLedgerManager()
+
+    class Meta:
+        verbose_name = 'Recordatorio enviado'
+        verbose_name_plural = 'Recordatorios enviados'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['reservation', 'kind', 'window_start'],
+                name='reminder_ledger_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['window_start'], name='reminder_ledger_window_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} - reserva {self.reservation_id}"
+
+    @staticmethod
+    def window_for(hours, now=None):
+        """Inicio de la ventana de `hours` horas que contiene `now`, alineada a la época Unix"""
+        now = now or timezone.now()
+        size = hours * 3600
+        return datetime.fromtimestamp(int(now.timestamp()) // size * size, tz=dt_timezone.utc)
+
+class StripeEvent(models.Model):
+    """
+    Eventos de webhook de Stripe ya verificados, tal como llegaron. El webhook
+    solo los guarda (event_id único: los reintentos de Stripe no se duplican)
+    y tasks.process_stripe_events los aplica por lotes.
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pendiente'),
+        ('PROCESSED', 'Procesado'),
+        ('IGNORED', 'Ignorado'),
+        ('FAILED', 'Fallido'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payment_intent_id = models.CharField(max_length=255, null=True, blank=True)
+    payload = models.JSONField()
+    # Momento del evento según Stripe; ordena los eventos de un mismo PaymentIntent
+    stripe_created = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Evento de Stripe'
+        verbose_name_plural = 'Eventos de Stripe'
+        indexes = [
+            models.Index(
+                fields=['stripe_created', 'id'],
+                condition=Q(status='PENDING'),
+                name='stripe_event_pending_idx'
+            ),
+            models.Index(
+                fields=['payment_intent_id', 'stripe_created'],
+                condition=Q(status='PENDING'),
+                name='stripe_event_intent_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
@@ -0,0 +1,19 @@
+import hmac
+
+from django.conf import settings
+from rest_framework.permissions import BasePermission
+
+
+class HasMetricsToken(BasePermission):
+    """
+    Acceso para el scraper de Prometheus: cabecera "Authorization: Bearer
+    <METRICS_TOKEN>" (bearer_token / authorization en la configuración del
+    scrape). Sin METRICS_TOKEN configurado el endpoint queda cerrado.
+    """
+
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        return bool(token) and scheme.lower() == 'bearer' and hmac.compare_digest(
+            credentials.strip().encode(), token.encode()
+        )
@@ -0,0 +1,466 @@
+import codecs
+import csv
+import logging
+import re
+import time
+import unicodedata
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import chain
+
+from django.conf import settings
+from django.utils import timezone
+
+from .exceptions import StatementError
+from .models import Payment
+from .services import PaymentValidationService
+
+logger = logging.getLogger(__name__)
+
+# Conciliación de estados de cuenta contra los pagos pendientes de validar.
+#
+# Los pagos pendientes (Pago Móvil y Zelle) se cargan una vez en un índice en
+# memoria por (últimos dígitos de la referencia, monto en céntimos); cada línea
+# del estado de cuenta se resuelve con una búsqueda en el diccionario y un
+# filtro por fecha, sin consultas por línea. El archivo se lee como flujo, así
+# que el tamaño no importa: solo se guardan las líneas que casan y, hasta un
+# límite, las huérfanas.
+
+REFERENCE_SUFFIX_LENGTH = 4
+READ_CHUNK_SIZE = 64 * 1024
+FALLBACK_ENCODING = 'cp1252'
+
+StatementLine = namedtuple('StatementLine', 'line date amount reference description')
+Candidate = namedtuple('Candidate', 'payment_id date hints')
+
+BANK_NAMES = dict(Payment.BANK_CHOICES)
+
+# Nombres de columna reconocidos en los CSV de los bancos (sin acentos, en minúsculas)
+CSV_COLUMNS = {
+    'date': {'fecha', 'date', 'fecha valor', 'fecha operacion', 'fecha transaccion', 'posted date',
+             'posting date', 'transaction date'},
+    'reference': {'referencia', 'reference', 'ref', 'nro referencia', 'numero de referencia',
+                  'nro. referencia', 'documento', 'confirmacion', 'confirmation', 'confirmation number'},
+    'amount': {'monto', 'amount', 'importe'},
+    'credit': {'credito', 'creditos', 'abono', 'abonos', 'haber', 'credit', 'deposit', 'deposits'},
+    'debit': {'debito', 'debitos', 'cargo', 'cargos', 'debe', 'debit', 'withdrawal', 'withdrawals'},
+    'description': {'descripcion', 'concepto', 'detalle', 'description', 'memo', 'details'},
+}
+
+DATE_FORMATS = ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d/%m/%y', '%m/%d/%Y', '%Y%m%d')
+
+DIGITS = re.compile(r'\d+')
+NON_NUMERIC = re.compile(r'[^\d.,]')
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def _normalize(value):
+    value = unicodedata.normalize('NFKD', value.strip().lower())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+def reference_suffix(value):
+    """Últimos REFERENCE_SUFFIX_LENGTH dígitos de una referencia ('' si no tiene)"""
+    digits = ''.join(DIGITS.findall(value or ''))
+    return digits[-REFERENCE_SUFFIX_LENGTH:]
+
+
+def parse_amount(value):
+    """
+    Monto de un estado de cuenta en céntimos. Acepta '1.234,56', '1,234.56',
+    '-10.00', '(10,00)' y símbolos de moneda; el separador decimal es el
+    último '.' o ',' seguido de uno o dos dígitos. Los separadores en los
+    extremos (el punto de 'Bs. 20') no cuentan.
+    """
+    value = value.strip()
+    negative = value.startswith('-') or value.endswith('-') or value.startswith('(') and value.endswith(')')
+    value = NON_NUMERIC.sub('', value).strip('.,')
+    if not value:
+        raise ValueError('monto vacío')
+
+    separator = max(value.rfind('.'), value.rfind(','))
+    if separator != -1 and 0 < len(value) - separator - 1 <= 2:
+        whole, fraction = value[:separator], value[separator + 1:]
+    else:
+        whole, fraction = value, ''
+    whole = whole.replace('.', '').replace(',', '')
+    try:
+        cents = int(Decimal(f'{whole or 0}.{fraction or 0}') * 100)
+    except InvalidOperation:
+        raise ValueError(f'monto inválido: {value}')
+    return -cents if negative else cents
+
+
+def cents_to_decimal(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+class DateParser:
+    """Convierte fechas probando DATE_FORMATS; se queda con el primero que funciona"""
+
+    def __init__(self, date_format=None):
+        self.formats = (date_format,) if date_format else DATE_FORMATS
+        self.current = self.formats[0]
+
+    def __call__(self, value):
+        # Algunos bancos añaden la hora: solo se usa la fecha
+        value = value.split()[0] if value.strip() else ''
+        try:
+            return datetime.strptime(value, self.current).date()
+        except ValueError:
+            pass
+        for date_format in self.formats:
+            try:
+                parsed = datetime.strptime(value, date_format).date()
+            except ValueError:
+                continue
+            self.current = date_format
+            return parsed
+        raise ValueError(f'fecha inválida: {value}')
+
+
+def _text_stream(file, encoding=None):
+    """
+    Decodifica por bloques un archivo binario (o deja pasar uno de texto). Sin
+    encoding se lee como UTF-8 y, al primer byte inválido, como FALLBACK_ENCODING,
+    que es como exportan muchos bancos.
+    """
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8-sig')(errors='replace' if encoding else 'strict')
+    while True:
+        chunk = file.read(READ_CHUNK_SIZE)
+        if isinstance(chunk, str):
+            text = chunk
+        else:
+            try:
+                text = decoder.decode(chunk, final=not chunk)
+            except UnicodeDecodeError:
+                buffered = decoder.getstate()[0]
+                decoder = codecs.getincrementaldecoder(FALLBACK_ENCODING)(errors='replace')
+                text = decoder.decode(buffered + chunk, final=not chunk)
+        if text:
+            yield text
+        if not chunk:
+            return
+
+
+def _text_lines(file, encoding=None):
+    pending = ''
+    for chunk in _text_stream(file, encoding):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def iter_csv(file, encoding=None, date_format=None, errors=None):
+    """
+    Líneas de un estado de cuenta en CSV (',', ';', tabulador o '|'). La
+    cabecera decide las columnas (CSV_COLUMNS); los montos vienen en una
+    columna con signo o en columnas separadas de crédito y débito. Las filas
+    que no se pueden leer se anotan en errors y se saltan.
+    """
+    lines = _text_lines(file, encoding)
+    header_number = 0
+    header_line = None
+    for header_line in lines:
+        header_number += 1
+        if header_line.strip():
+            break
+    if header_line is None or not header_line.strip():
+        raise StatementError('El archivo está vacío')
+    delimiter = max(',;\t|', key=header_line.count)
+    header = next(csv.reader([header_line], delimiter=delimiter))
+
+    columns = {}
+    for position, name in enumerate(header):
+        name = _normalize(name)
+        for field, aliases in CSV_COLUMNS.items():
+            if name in aliases and field not in columns:
+                columns[field] = position
+    if 'date' not in columns or not ({'amount', 'credit'} & columns.keys()):
+        raise StatementError(
+            'No se reconocen las columnas del estado de cuenta: hacen falta fecha y monto (o crédito)'
+        )
+
+    parse_date = DateParser(date_format)
+    date_column = columns['date']
+    amount_column = columns.get('amount')
+    credit_column, debit_column = columns.get('credit'), columns.get('debit')
+    reference_column = columns.get('reference')
+    description_column = columns.get('description')
+
+    reader = csv.reader(lines, delimiter=delimiter)
+    for row in reader:
+        if not any(row):
+            continue
+        number = header_number + reader.line_num
+        try:
+            if amount_column is not None and row[amount_column].strip():
+                amount = parse_amount(row[amount_column])
+            elif credit_column is not None and row[credit_column].strip():
+                amount = abs(parse_amount(row[credit_column]))
+            elif debit_column is not None and row[debit_column].strip():
+                amount = -abs(parse_amount(row[debit_column]))
+            else:
+                raise ValueError('sin monto')
+            yield StatementLine(
+                number,
+                parse_date(row[date_column]),
+                amount,
+                row[reference_column].strip() if reference_column is not None else '',
+                row[description_column].strip() if description_column is not None else ''
+            )
+        except (IndexError, ValueError) as e:
+            if errors is not None:
+                errors.append((number, str(e)))
+
+
+def iter_ofx(file, encoding=None, date_format=None, errors=None):
+    """
+    Movimientos (STMTTRN) de un archivo OFX, en SGML (1.x) o XML (2.x). Se
+    recorre por bloques, sin depender de los saltos de línea. La referencia
+    es REFNUM, CHECKNUM o FITID, en ese orden.
+    """
+    parse_date = DateParser(date_format or '%Y%m%d')
+    transaction = None
+    number = 0
+    pending = ''
+    # El None final procesa lo que quede tras el último bloque
+    for chunk in chain(_text_stream(file, encoding), [None]):
+        text = pending + (chunk or '')
+        # Una etiqueta puede quedar partida entre bloques: se guarda lo que sigue al último '<'
+        cut = text.rfind('<') if chunk is not None else -1
+        text, pending = (text[:cut], text[cut:]) if cut != -1 else (text, '')
+        for match in OFX_TAG.finditer(text):
+            closing, tag, value = match.group(1), match.group(2).upper(), match.group(3).strip()
+            if tag == 'STMTTRN':
+                if not closing:
+                    transaction = {}
+                    continue
+                if transaction is None:
+                    continue
+                number += 1
+                try:
+                    yield StatementLine(
+                        number,
+                        parse_date(transaction.get('DTPOSTED', '')[:8]),
+                        parse_amount(transaction.get('TRNAMT', '')),
+                        transaction.get('REFNUM') or transaction.get('CHECKNUM') or transaction.get('FITID', ''),
+                        ' '.join(filter(None, (transaction.get('NAME'), transaction.get('MEMO'))))
+                    )
+                except ValueError as e:
+                    if errors is not None:
+                        errors.append((number, str(e)))
+                transaction = None
+            elif transaction is not None and not closing and value:
+                transaction[tag] = value
+
+
+def iter_statement(file, name='', format=None, encoding=None, date_format=None, errors=None):
+    """Elige el lector por el formato indicado o por la extensión del archivo"""
+    if not format:
+        format = name.rsplit('.', 1)[-1] if '.' in name else 'csv'
+    format = format.lower()
+    if format in ('ofx', 'qfx'):
+        return iter_ofx(file, encoding, date_format, errors)
+    if format in ('csv', 'txt', 'tsv'):
+        return iter_csv(file, encoding, date_format, errors)
+    raise StatementError(f'Formato de estado de cuenta no soportado: {format}')
+
+
+class PaymentIndex:
+    """
+    Pagos pendientes de validar indexados por (sufijo de referencia, monto en
+    céntimos) y, para los Zelle sin referencia, por (email, monto). Los
+    'hints' (teléfono, email, banco) desempatan cuando hay varios candidatos.
+    """
+
+    def __init__(self, payments):
+        self.by_reference = defaultdict(list)
+        self.by_email = defaultdict(list)
+        self.size = 0
+        for payment_id, last_digits, bank_reference, amount, created_at, phone, email, bank in payments:
+            cents = int(amount * 100)
+            hints = set()
+            if phone:
+                hints.add(''.join(DIGITS.findall(phone))[-7:])
+            if email:
+                hints.add(email.lower())
+            if bank:
+                hints.update((bank.lower(), BANK_NAMES.get(bank, bank).lower()))
+            candidate = Candidate(payment_id, timezone.localtime(created_at).date(), frozenset(hints))
+            suffix = reference_suffix(last_digits) or reference_suffix(bank_reference)
+            if suffix:
+                self.by_reference[suffix, cents].append(candidate)
+            if email:
+                self.by_email[email.lower(), cents].append(candidate)
+            self.size += 1
+
+    @classmethod
+    def pending(cls):
+        payments = Payment.objects.filter(
+            status__in=Payment.VALIDATION_STATUSES,
+            payment_type__in=Payment.VALIDATION_TYPES
+        ).values_list(
+            'id', 'reference_last_digits', 'bank_reference', 'amount', 'created_at',
+            'phone_number', 'zelle_email', 'bank'
+        )
+        return cls(payments.iterator(chunk_size=2000))
+
+    def candidates(self, line):
+        suffix = reference_suffix(line.reference)
+        found = self.by_reference.get((suffix, line.amount), []) if suffix else []
+        if not found and self.by_email:
+            for email in EMAIL.findall(line.description):
+                found = found + self.by_email.get((email.lower(), line.amount), [])
+        return found
+
+
+class Reconciliation:
+    """
+    Resultado de conciliar un estado de cuenta:
+    - matches: [(línea, payment_id)] con un único pago posible
+    - ambiguous: [(línea, [payment_id, ...], motivo)]
+    - orphans: líneas de crédito sin pago pendiente (hasta orphan_limit; el
+      total está en orphan_count)
+    """
+
+    def __init__(self, orphan_limit=None, errors=None):
+        self.matches = []
+        self.ambiguous = []
+        self.orphans = []
+        self.orphan_count = 0
+        self.orphan_limit = orphan_limit
+        self.lines = 0
+        self.skipped = 0
+        # Filas ilegibles (número, motivo); los lectores las anotan aquí
+        self.errors = errors if errors is not None else []
+        self.elapsed = 0.0
+
+    def add_orphan(self, line):
+        self.orphan_count += 1
+        if self.orphan_limit is None or len(self.orphans) < self.orphan_limit:
+            self.orphans.append(line)
+
+    def summary(self):
+        return {
+            'lines': self.lines,
+            'matched': len(self.matches),
+            'ambiguous': len(self.ambiguous),
+            'orphans': self.orphan_count,
+            'skipped': self.skipped,
+            'errors': len(self.errors),
+            'elapsed': round(self.elapsed, 3),
+        }
+
+    def as_dict(self):
+        def line_data(line):
+            return {
+                'line': line.line,
+                'date': line.date.isoformat(),
+                'amount': str(cents_to_decimal(line.amount)),
+                'reference': line.reference,
+                'description': line.description,
+            }
+
+        return {
+            'summary': self.summary(),
+            'matches': [{**line_data(line), 'payment_id': payment_id} for line, payment_id in self.matches],
+            'ambiguous': [
+                {**line_data(line), 'payment_ids': payment_ids, 'reason': reason}
+                for line, payment_ids, reason in self.ambiguous
+            ],
+            'orphans': [line_data(line) for line in self.orphans],
+            'errors': [{'line': number, 'error': error} for number, error in self.errors[:100]],
+        }
+
+
+def _narrow(line, candidates):
+    """Desempata con los datos del pagador que aparezcan en la descripción"""
+    description = line.description.lower()
+    digits = ''.join(DIGITS.findall(description))
+    return [
+        candidate for candidate in candidates
+        if any(hint and (hint in description or hint.isdigit() and hint in digits) for hint in candidate.hints)
+    ]
+
+
+def reconcile(lines, index=None, window_days=None, orphan_limit=None, errors=None):
+    """
+    Clasifica en una pasada cada línea de crédito del estado de cuenta: un
+    solo pago posible dentro de la ventana de fechas es un match; varios, una
+    línea ambigua; ninguno, una huérfana. Si dos líneas casan con el mismo
+    pago, ambas pasan a ambiguas.
+    """
+    started = time.monotonic()
+    index = index if index is not None else PaymentIndex.pending()
+    window_days = settings.RECONCILIATION_DATE_WINDOW_DAYS if window_days is None else window_days
+    orphan_limit = settings.RECONCILIATION_ORPHAN_LIMIT if orphan_limit is None else orphan_limit
+    result = Reconciliation(orphan_limit, errors)
+
+    matched_lines = defaultdict(list)
+    for line in lines:
+        result.lines += 1
+        if line.amount <= 0:
+            result.skipped += 1
+            continue
+        candidates = [
+            candidate for candidate in index.candidates(line)
+            if abs((line.date - candidate.date).days) <= window_days
+        ]
+        if len(candidates) > 1:
+            candidates = _narrow(line, candidates) or candidates
+        if not candidates:
+            result.add_orphan(line)
+        elif len(candidates) == 1:
+            matched_lines[candidates[0].payment_id].append(line)
+        else:
+            result.ambiguous.append((
+                line, [candidate.payment_id for candidate in candidates], 'Varios pagos posibles'
+            ))
+
+    for payment_id, payment_lines in matched_lines.items():
+        if len(payment_lines) == 1:
+            result.matches.append((payment_lines[0], payment_id))
+        else:
+            result.ambiguous.extend(
+                (line, [payment_id], 'Varias líneas para el mismo pago') for line in payment_lines
+            )
+    result.matches.sort(key=lambda match: match[0].line)
+    result.ambiguous.sort(key=lambda entry: entry[0].line)
+
+    result.elapsed = time.monotonic() - started
+    logger.info(
+        f"Conciliación: {result.lines} líneas contra {index.size} pagos pendientes en {result.elapsed:.2f}s "
+        f"({len(result.matches)} matches, {len(result.ambiguous)} ambiguas, {result.orphan_count} huérfanas)"
+    )
+    return result
+
+
+def apply_matches(result, admin, payment_ids=None):
+    """
+    Aprueba los pagos de los matches (todos, o solo payment_ids) con
+    PaymentValidationService, en lotes de PAYMENT_BATCH_MAX_ITEMS. Devuelve
+    los resultados por pago del servicio.
+    """
+    selected = None if payment_ids is None else set(payment_ids)
+    items = [
+        {
+            'payment_id': payment_id,
+            'action': 'approve',
+            'notes': f'Conciliado con el estado de cuenta: ref. {line.reference or "-"}, '
+                     f'{line.date.isoformat()}, {cents_to_decimal(line.amount)}'
+        }
+        for line, payment_id in result.matches
+        if selected is None or payment_id in selected
+    ]
+    service = PaymentValidationService(admin)
+    results = []
+    batch_size = settings.PAYMENT_BATCH_MAX_ITEMS
+    for start in range(0, len(items), batch_size):
+        results.extend(service.validate(items[start:start + batch_size]))
+    return results
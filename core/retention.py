@@ -0,0 +1,231 @@
+import logging
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .inbox import adjust_unread
+
+logger = logging.getLogger(__name__)
+
+# Política de retención de notificaciones.
+#
+# Cada bloque es una sola sentencia en su propia transacción: selecciona hasta
+# NOTIFICATION_RETENTION_BATCH_SIZE filas vencidas con FOR UPDATE SKIP LOCKED
+# (no espera a filas que otro proceso tenga bloqueadas), las desvincula de la
+# bandeja de salida, las borra y, si el archivo está activo, las inserta en
+# core_notificationarchive con DELETE ... RETURNING. Los bloqueos duran lo que
+# tarda un bloque.
+#
+# La partición mensual es solo del archivo, no de core_notification. La tabla
+# viva queda acotada por la retención (los recordatorios, que son el grueso,
+# duran 14-30 días) y la bandeja se lee por usuario con notification_inbox_idx
+# y notification_unread_idx, cuyo coste depende de las filas del usuario y no
+# del total, así que particionarla no acelera esas consultas. Además exigiría
+# la clave primaria (id, created_at), incompatible con la FK de
+# core_notificationoutbox y con las relaciones de Django por id. Lo que crece
+# sin límite es el archivo; particionado, caduca con DROP TABLE por mes.
+
+ARCHIVE_TABLE = 'core_notificationarchive'
+
+PRUNE_SQL = """
+WITH doomed AS (
+    SELECT id FROM core_notification
+    WHERE {condition}
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+), detached AS (
+    UPDATE core_notificationoutbox SET notification_id = NULL
+    WHERE notification_id IN (SELECT id FROM doomed)
+), removed AS (
+    DELETE FROM core_notification
+    WHERE id IN (SELECT id FROM doomed)
+    RETURNING id, user_id, type, title, message, read, created_at
+){archive}
+SELECT user_id, read FROM removed
+"""
+
+ARCHIVE_SQL = """, archived AS (
+    INSERT INTO core_notificationarchive (id, user_id, type, title, message, read, created_at, archived_at)
+    SELECT id, user_id, type, title, message, read, created_at, now() FROM removed
+    ON CONFLICT DO NOTHING
+)"""
+
+
+def retention_rules(now=None):
+    """
+    Pares (condición SQL, parámetros) según NOTIFICATION_RETENTION_DAYS: una
+    regla por tipo configurado y otra 'default' para el resto de tipos.
+    """
+    now = now or timezone.now()
+    days = dict(settings.NOTIFICATION_RETENTION_DAYS)
+    default_days = days.pop('default', None)
+
+    rules = [
+        ('type = %s AND created_at < %s', [type_, now - timedelta(days=type_days)])
+        for type_, type_days in sorted(days.items())
+    ]
+    if default_days is not None:
+        rules.append((
+            'NOT (type = ANY(%s)) AND created_at < %s',
+            [sorted(days), now - timedelta(days=default_days)]
+        ))
+    return rules
+
+
+def _prune_chunk(condition, params, batch_size, archive):
+    sql = PRUNE_SQL.format(condition=condition, archive=ARCHIVE_SQL if archive else '')
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*params, batch_size])
+            rows = cursor.fetchall()
+        # Las filas borradas en SQL no disparan post_delete
+        unread = Counter(user_id for user_id, read in rows if not read)
+        adjust_unread({user_id: -count for user_id, count in unread.items()})
+    return len(rows)
+
+
+def prune_notifications(batch_size=None, max_batches=None):
+    """
+    Retira las notificaciones vencidas bloque a bloque. Devuelve el total por
+    tipo de regla; max_batches acota la duración de una ejecución.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_RETENTION_BATCH_SIZE
+    archive = settings.NOTIFICATION_ARCHIVE_ENABLED
+    if archive:
+        ensure_archive_partitions()
+
+    totals = {}
+    batches = 0
+    for condition, params in retention_rules():
+        label = params[0] if isinstance(params[0], str) else 'default'
+        total = 0
+        started = time.monotonic()
+        while max_batches is None or batches < max_batches:
+            removed = _prune_chunk(condition, params, batch_size, archive)
+            batches += 1
+            total += removed
+            if removed < batch_size:
+                break
+        totals[label] = total
+        if total:
+            logger.info(
+                f"Retención de notificaciones ({label}): {total} "
+                f"{'archivadas' if archive else 'borradas'} en {time.monotonic() - started:.2f}s"
+            )
+    return totals
+
+
+def prune_outbox(batch_size=None):
+    """Borra en bloques las filas ya procesadas de la bandeja de salida"""
+    from .models import NotificationOutbox
+
+    batch_size = batch_size or settings.NOTIFICATION_RETENTION_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=settings.NOTIFICATION_OUTBOX_RETENTION_DAYS)
+    done = NotificationOutbox.objects.filter(status__in=['SENT', 'FAILED'], created_at__lt=cutoff)
+    total = 0
+    while True:
+        ids = list(done.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += NotificationOutbox.objects.filter(id__in=ids).delete()[0]
+
+
+def prune_reminder_ledger(batch_size=None):
+    """Borra en bloques el registro de recordatorios de ventanas ya lejanas"""
+    from .models import ReminderLedger
+
+    batch_size = batch_size or settings.NOTIFICATION_RETENTION_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=settings.REMINDER_LEDGER_RETENTION_DAYS)
+    expired = ReminderLedger.objects.filter(window_start__lt=cutoff)
+    total = 0
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += ReminderLedger.objects.filter(id__in=ids).delete()[0]
+
+
+# Archivo particionado por mes
+
+def _month_start(value):
+    return value.replace(day=1)
+
+
+def _add_months(value, months):
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f'{ARCHIVE_TABLE}_y{month.year}m{month.month:02d}'
+
+
+def archive_is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = %s",
+            [ARCHIVE_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def ensure_archive_partitions(months_ahead=1):
+    """Crea las particiones del mes en curso y de los siguientes si el archivo está particionado"""
+    if not archive_is_partitioned():
+        return
+    # Los límites van en UTC, la zona de la sesión de Django con USE_TZ
+    current = _month_start(timezone.now().date())
+    with connection.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            month = _add_months(current, offset)
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF {ARCHIVE_TABLE} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [month.isoformat(), _add_months(month, 1).isoformat()]
+            )
+
+
+def prune_archive(batch_size=None):
+    """
+    Caduca el archivo pasados NOTIFICATION_ARCHIVE_MONTHS meses: si está
+    particionado borra particiones enteras (DROP TABLE, sin barrer filas);
+    si no, borra en bloques por archived_at.
+    """
+    from .models import NotificationArchive
+
+    cutoff = _add_months(_month_start(timezone.now().date()), -settings.NOTIFICATION_ARCHIVE_MONTHS)
+    if archive_is_partitioned():
+        dropped = []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = %s AND c.relname ~ '_y[0-9]{4}m[0-9]{2}$'",
+                [ARCHIVE_TABLE]
+            )
+            for (name,) in cursor.fetchall():
+                year, month = int(name[-7:-3]), int(name[-2:])
+                if date(year, month, 1) < cutoff:
+                    cursor.execute(f'DROP TABLE IF EXISTS {name}')
+                    dropped.append(name)
+        if dropped:
+            logger.info(f"Archivo de notificaciones: particiones eliminadas {', '.join(sorted(dropped))}")
+        return len(dropped)
+
+    batch_size = batch_size or settings.NOTIFICATION_RETENTION_BATCH_SIZE
+    cutoff = datetime.combine(cutoff, datetime.min.time(), tzinfo=dt_timezone.utc)
+    expired = NotificationArchive.objects.filter(archived_at__lt=cutoff)
+    total = 0
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return total
+        total += NotificationArchive.objects.filter(id__in=ids).delete()[0]
@@ -1,10 +1,16 @@
 from rest_framework import serializers
 from .models import Court, Membership, Reservation, Payment, UserProfile, Notification
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 from django.utils import timezone
-from .services import NotificationService
-from .tasks import notify_reservation_created
+from datetime import timedelta
+from .services import NotificationService, SlotHoldService
+from .exceptions import SlotHoldError
 from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
 
 class CourtSerializer(serializers.ModelSerializer):
     class Meta:
@@ -17,6 +23,9 @@ class MembershipSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 class ReservationSerializer(serializers.ModelSerializer):
+    # Token de SlotHoldService obtenido al mostrar el precio; se consume al crear
+    hold_token = serializers.CharField(write_only=True, required=False, allow_blank=True)
+
     class Meta:
         model = Reservation
         fields = [
@@ -29,14 +38,84 @@ class ReservationSerializer(serializers.ModelSerializer):
             'updated_at', 
             'user', 
             'court',
-            'total_amount'
+            'total_amount',
+            'hold_token'
         ]
 
     def create(self, validated_data):
-        reservation = Reservation.objects.create(**validated_data)
-        notify_reservation_created.delay(reservation.id)
+        hold_token = validated_data.pop('hold_token', None) or None
+        holds, hold_token = self._check_hold(validated_data, hold_token)
+
+        try:
+            # La notificación se escribe en la bandeja de salida en la misma transacción
+            with transaction.atomic():
+                reservation = Reservation.objects.create(**validated_data)
+                NotificationService.notify_reservation_created(reservation)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+
+        if holds and hold_token:
+            # La reserva ya existe: si no se puede liberar, la retención expira sola
+            try:
+                holds.release(hold_token)
+            except SlotHoldError as e:
+                logger.warning(f"No se pudo liberar la reserva temporal: {str(e)}")
         return reservation
 
+    def _check_hold(self, data, hold_token):
+        """
+        Rechaza en Redis, sin tocar la base de datos, los slots retenidos por
+        otro usuario. Devuelve (servicio, token); el token solo cuenta si es
+        del propio usuario.
+        """
+        try:
+            if hold_token and SlotHoldService.owner(hold_token) != data['user'].id:
+                hold_token = None
+        except SlotHoldError:
+            hold_token = None
+        try:
+            holds = SlotHoldService()
+            state = holds.check(
+                data['court'].id, data['date'], data['start_time'], data['end_time'], hold_token
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo verificar la reserva temporal: {str(e)}")
+            return None, None
+
+        if state < 0:
+            raise serializers.ValidationError(
+                'El horario está temporalmente reservado por otro usuario'
+            )
+        return holds, hold_token
+
+class ReservationSeriesSerializer(serializers.Serializer):
+    MAX_OCCURRENCES = 52
+
+    court = serializers.PrimaryKeyRelatedField(queryset=Court.objects.all())
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    start_date = serializers.DateField()
+    start_time = serializers.TimeField()
+    end_time = serializers.TimeField()
+    occurrences = serializers.IntegerField(min_value=1, max_value=MAX_OCCURRENCES)
+    interval_weeks = serializers.IntegerField(min_value=1, max_value=4, default=1)
+    skip_conflicts = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        if data['end_time'] <= data['start_time']:
+            raise serializers.ValidationError(
+                'La hora de fin debe ser posterior a la hora de inicio'
+            )
+        if data['start_date'] < timezone.now().date():
+            raise serializers.ValidationError(
+                'No se pueden hacer reservas en fechas pasadas'
+            )
+        return data
+
+    def dates(self):
+        data = self.validated_data
+        step = timedelta(weeks=data['interval_weeks'])
+        return [data['start_date'] + step * i for i in range(data['occurrences'])]
+
 class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Payment
@@ -68,6 +147,39 @@ class PaymentSerializer(serializers.ModelSerializer):
                 )
         return data
 
+class PaymentQueueSerializer(PaymentSerializer):
+    """Pago en la cola de validación, con los datos de la reserva que revisa el administrador"""
+    user = serializers.CharField(source='reservation.user.username', read_only=True)
+    court = serializers.CharField(source='reservation.court.name', read_only=True)
+    date = serializers.DateField(source='reservation.date', read_only=True)
+    start_time = serializers.TimeField(source='reservation.start_time', read_only=True)
+    end_time = serializers.TimeField(source='reservation.end_time', read_only=True)
+    claimed_by = serializers.CharField(source='claimed_by.username', read_only=True, default=None)
+
+    class Meta(PaymentSerializer.Meta):
+        fields = PaymentSerializer.Meta.fields + [
+            'user', 'court', 'date', 'start_time', 'end_time', 'claimed_by', 'claim_expires_at'
+        ]
+
+class PaymentValidationItemSerializer(serializers.Serializer):
+    payment_id = serializers.IntegerField()
+    action = serializers.ChoiceField(choices=['approve', 'reject'])
+    notes = serializers.CharField(required=False, allow_blank=True, default='')
+
+class PaymentBatchValidationSerializer(serializers.Serializer):
+    items = serializers.ListField(
+        child=PaymentValidationItemSerializer(),
+        min_length=1,
+        max_length=settings.PAYMENT_BATCH_MAX_ITEMS
+    )
+
+class StatementReconciliationSerializer(serializers.Serializer):
+    statement = serializers.FileField()
+    # Por defecto según la extensión del archivo
+    format = serializers.ChoiceField(choices=['csv', 'ofx'], required=False)
+    date_format = serializers.CharField(required=False, help_text='Formato strptime, p. ej. %d/%m/%Y')
+    apply = serializers.BooleanField(default=False)
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -1,39 +1,234 @@
 from django.conf import settings
-from .models import Notification
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from django.db.models import Case, F, IntegerField, Min, Q, Value, When
+from django.utils import timezone
+from .models import CourtSlotGrid, Notification, NotificationOutbox, Payment, Reservation, StripeEvent
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+import base64
+import random
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from redis.exceptions import RedisError
 import stripe
-from .exceptions import PaymentError
+import time
+import uuid
+from .exceptions import PaymentError, SlotHoldError, SlotHoldUnavailable
 import logging
 from django.contrib.auth.models import User
+from django_redis import get_redis_connection
+from .availability import DayOccupancy, cells_mask, range_occupancy, span_mask, time_to_cell
+from .signals import send_occupancy_changed
 
 logger = logging.getLogger(__name__)
 
+class WhatsAppRateLimiter:
+    """
+    Token buckets en Redis compartidos por todos los workers: uno por número
+    emisor (phone_number_id) y otro por destinatario. Un envío toma un token de
+    cada bucket de forma atómica, o de ninguno si alguno está vacío; en ese
+    caso el script devuelve cuántos ms faltan para que ambos tengan token.
+    """
+
+    ACQUIRE_SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    local wait = 0
+    local tokens = {}
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[2 * i - 1])
+        local capacity = tonumber(ARGV[2 * i])
+        local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+        local available = tonumber(bucket[1]) or capacity
+        local last = tonumber(bucket[2]) or now_ms
+        available = math.min(capacity, available + math.max(0, now_ms - last) * rate)
+        tokens[i] = available
+        if available < 1 then
+            wait = math.max(wait, math.ceil((1 - available) / rate))
+        end
+    end
+    if wait > 0 then
+        return wait
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[2 * i - 1])
+        local capacity = tonumber(ARGV[2 * i])
+        redis.call('HSET', key, 'tokens', tostring(tokens[i] - 1), 'ts', string.format('%d', now_ms))
+        redis.call('PEXPIRE', key, math.ceil(capacity / rate) + 1000)
+    end
+    return 0
+    """
+
+    STATS_KEYS = {
+        'acquired': 'whatsapp:ratelimit:acquired',
+        'waits': 'whatsapp:ratelimit:waits',
+        'wait_ms': 'whatsapp:ratelimit:wait-ms',
+        'rejections': 'whatsapp:ratelimit:rejections',
+    }
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        # Tasas en tokens por milisegundo, que es la unidad del script
+        self.buckets = (
+            (settings.WHATSAPP_NUMBER_RATE / 1000, settings.WHATSAPP_NUMBER_BURST),
+            (settings.WHATSAPP_DESTINATION_RATE / 1000, settings.WHATSAPP_DESTINATION_BURST),
+        )
+        self.max_wait = settings.WHATSAPP_RATE_MAX_WAIT
+
+    def try_acquire(self, phone_number_id, to_phone):
+        """Toma un token de ambos buckets; devuelve 0 o los ms que faltan"""
+        args = [value for bucket in self.buckets for value in bucket]
+        return int(self.redis.eval(
+            self.ACQUIRE_SCRIPT, 2,
+            f'whatsapp:bucket:number:{phone_number_id}',
+            f'whatsapp:bucket:to:{to_phone}',
+            *args
+        ))
+
+    def acquire(self, phone_number_id, to_phone):
+        """
+        Espera (durmiendo justo lo que indica Redis, sin sondear) hasta como
+        mucho max_wait segundos. Devuelve (True, 0) si obtuvo el token o
+        (False, segundos) si conviene reprogramar el envío. Sin Redis no limita.
+        """
+        waited_ms = 0
+        try:
+            while True:
+                wait_ms = self.try_acquire(phone_number_id, to_phone)
+                if not wait_ms:
+                    self._record(acquired=1, waits=int(waited_ms > 0), wait_ms=waited_ms)
+                    return True, 0
+                if (waited_ms + wait_ms) / 1000 > self.max_wait:
+                    self._record(rejections=1, wait_ms=waited_ms)
+                    return False, wait_ms / 1000
+                time.sleep(wait_ms / 1000)
+                waited_ms += wait_ms
+        except Exception as e:
+            logger.warning(f"Limitador de WhatsApp no disponible: {str(e)}")
+            return True, 0
+
+    def _record(self, **amounts):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for stat, amount in amounts.items():
+                if amount:
+                    pipe.incrby(cache.make_key(self.STATS_KEYS[stat]), amount)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"No se pudieron registrar las métricas del limitador: {str(e)}")
+
+    @classmethod
+    def stats(cls):
+        values = cache.get_many(list(cls.STATS_KEYS.values()))
+        return {stat: int(values.get(key, 0)) for stat, key in cls.STATS_KEYS.items()}
+
 class WhatsAppService:
+    """
+    Cliente de la API de WhatsApp Cloud. Todas las instancias del proceso
+    comparten una sesión HTTP con pool de conexiones keep-alive.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    # Detalle que devuelve send_message cuando el limitador pide reprogramar
+    RATE_LIMITED = 'rate_limited'
+
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self):
         self.base_url = settings.WHATSAPP_API_URL
         self.token = settings.WHATSAPP_ACCESS_TOKEN
         self.phone_number_id = settings.WHATSAPP_PHONE_NUMBER_ID
+        self.timeout = (settings.WHATSAPP_CONNECT_TIMEOUT, settings.WHATSAPP_READ_TIMEOUT)
+        self.max_retries = settings.WHATSAPP_MAX_RETRIES
+        self.backoff_base = settings.WHATSAPP_BACKOFF_BASE
+        self.backoff_max = settings.WHATSAPP_BACKOFF_MAX
+        self.concurrency = settings.WHATSAPP_CONCURRENCY
+        self.session = self._get_session()
+        self.limiter = WhatsAppRateLimiter()
 
-    def send_message(self, to_phone, message):
+    @classmethod
+    def _get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                pool_size = max(settings.WHATSAPP_CONCURRENCY, 1)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls._session = session
+            return cls._session
+
+    def _backoff(self, attempt, response=None):
+        """Espera antes del reintento: Retry-After si viene, si no exponencial con jitter"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
         try:
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/json'
-            }
-            
-            data = {
-                "messaging_product": "whatsapp",
-                "to": to_phone,
-                "type": "text",
-                "text": {"body": message}
-            }
-            
-            url = f"{self.base_url}/{self.phone_number_id}/messages"
-            response = requests.post(url, json=data, headers=headers)
-            
-            return response.status_code == 200, response.json()
-        except Exception as e:
-            return False, str(e)
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+        return min(delay, self.backoff_max)
+
+    def send_message(self, to_phone, message):
+        headers = {
+            'Authorization': f'Bearer {self.token}',
+            'Content-Type': 'application/json'
+        }
+        
+        data = {
+            "messaging_product": "whatsapp",
+            "to": to_phone,
+            "type": "text",
+            "text": {"body": message}
+        }
+        
+        url = f"{self.base_url}/{self.phone_number_id}/messages"
+        for attempt in range(self.max_retries + 1):
+            allowed, retry_after = self.limiter.acquire(self.phone_number_id, to_phone)
+            if not allowed:
+                return False, {'error': self.RATE_LIMITED, 'retry_after': retry_after}
+
+            try:
+                response = self.session.post(url, json=data, headers=headers, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                # Incluye ConnectTimeout. Un ReadTimeout no se reintenta: la API
+                # pudo haber aceptado el mensaje y se enviaría dos veces
+                if attempt < self.max_retries:
+                    time.sleep(self._backoff(attempt))
+                    continue
+                return False, str(e)
+            except Exception as e:
+                return False, str(e)
+
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._backoff(attempt, response)
+                logger.warning(
+                    f"WhatsApp respondió {response.status_code} para {to_phone}; "
+                    f"reintento {attempt + 1}/{self.max_retries} en {delay:.2f}s"
+                )
+                time.sleep(delay)
+                continue
+
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            return response.status_code == 200, body
+
+    def send_messages(self, messages):
+        """
+        Envía muchos mensajes [(to_phone, message), ...] en paralelo, como mucho
+        WHATSAPP_CONCURRENCY a la vez. Devuelve los resultados en el mismo orden.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+        workers = max(1, min(self.concurrency, len(messages)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='whatsapp') as executor:
+            return list(executor.map(lambda item: self.send_message(*item), messages))
 
 class NotificationService:
     def __init__(self):
@@ -51,7 +246,7 @@ class NotificationService:
 
     @staticmethod
     def notify_reservation_created(reservation):
-        """Notificar cuando se crea una reserva"""
+        """Encola la notificación de reserva creada (en la transacción en curso)"""
         message = (
             f"¡Hola! Tu reserva ha sido creada:\n"
             f"Cancha: {reservation.court}\n"
@@ -59,57 +254,1151 @@ class NotificationService:
             f"Hora: {reservation.start_time} - {reservation.end_time}\n"
             f"Estado: {reservation.get_status_display()}"
         )
-        return NotificationService.create_notification(
+        return NotificationOutboxService.enqueue(
             user=reservation.user,
             type='RESERVATION_CREATED',
             title='Reserva Creada',
-            message=message
+            message=message,
+            key=f'reservation-created:{reservation.id}'
+        )
+
+    @staticmethod
+    def notify_series_created(reservations):
+        """Encola una única notificación para toda la serie"""
+        first = reservations[0]
+        dates = ', '.join(r.date.strftime('%d/%m') for r in reservations)
+        message = (
+            f"¡Hola! Tu serie de reservas ha sido creada:\n"
+            f"Cancha: {first.court}\n"
+            f"Hora: {first.start_time} - {first.end_time}\n"
+            f"Fechas ({len(reservations)}): {dates}\n"
+            f"Estado: {first.get_status_display()}"
+        )
+        return NotificationOutboxService.enqueue(
+            user=first.user,
+            type='RESERVATION_CREATED',
+            title='Serie de Reservas Creada',
+            message=message,
+            key=f'series-created:{first.series_id}' if first.series_id else None
+        )
+
+def digest_notifications(items):
+    """
+    Combina varias notificaciones (type, title, message) de un mismo usuario en
+    una sola con todos los mensajes, en orden. Con un único elemento lo
+    devuelve tal cual.
+    """
+    items = list(items)
+    if len(items) == 1:
+        return items[0]
+    types = {type for type, _, _ in items}
+    titles = {title for _, title, _ in items}
+    type = next(iter(types)) if len(types) == 1 else 'DIGEST'
+    if len(titles) == 1:
+        # Mismo título: basta con indicarlo una vez
+        title = f"{next(iter(titles))} ({len(items)})"
+        message = '\n\n'.join(message for _, _, message in items)
+    else:
+        title = f"Tienes {len(items)} notificaciones nuevas"
+        message = '\n\n'.join(f"{item_title}\n{message}" for _, item_title, message in items)
+    return type, title[:100], message
+
+class NotificationOutboxService:
+    """
+    Bandeja de salida transaccional. Los productores escriben filas en la
+    transacción del cambio; al hacer commit se programa, como mucho una vez
+    por ventana, la tarea que las entrega por lotes. Así la tarea nunca se
+    adelanta al commit y Celery recibe un mensaje por lote y no por evento.
+    """
+
+    DISPATCH_FLAG_KEY = 'notifications:outbox:dispatch-scheduled'
+    # Si el mensaje a Celery se pierde, la marca caduca y la tarea periódica recoge las filas
+    DISPATCH_FLAG_TIMEOUT = 60
+
+    @classmethod
+    def enqueue(cls, user, type, title, message, key=None, send_whatsapp=True):
+        entry = NotificationOutbox(
+            user=user, type=type, title=title, message=message,
+            key=key, send_whatsapp=send_whatsapp
+        )
+        cls.enqueue_many([entry])
+        return entry
+
+    @classmethod
+    def enqueue_many(cls, entries):
+        entries = list(entries)
+        release = cls._digest_release(entries)
+        # ignore_conflicts: un evento con clave ya encolada no se duplica
+        NotificationOutbox.objects.bulk_create(entries, ignore_conflicts=True)
+        transaction.on_commit(lambda: cls.schedule_dispatch(release))
+
+    @staticmethod
+    def _digest_release(entries):
+        """
+        Retiene las filas hasta que acaba la ventana de resumen del usuario: la
+        primera fila pendiente abre la ventana (NOTIFICATION_DIGEST_WINDOW) y
+        las que llegan dentro de ella toman su mismo available_at, así que se
+        entregan juntas. Devuelve el available_at más próximo.
+        """
+        now = timezone.now()
+        window = timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+        if not window or not entries:
+            return now
+        open_windows = dict(
+            NotificationOutbox.objects
+            .filter(
+                user_id__in={entry.user_id for entry in entries},
+                status='PENDING', attempts=0, available_at__gt=now,
+                created_at__gt=now - window,
+                # Las ya entregadas en la app esperan WhatsApp, no su ventana
+                notification__isnull=True
+            )
+            .values('user_id')
+            .annotate(release=Min('available_at'))
+            .values_list('user_id', 'release')
+        )
+        for entry in entries:
+            entry.available_at = open_windows.setdefault(entry.user_id, now + window)
+        return min(entry.available_at for entry in entries)
+
+    @classmethod
+    def schedule_dispatch(cls, at=None):
+        """Programa la entrega para cuando vencen las filas (at), si no hay otra programada"""
+        from .tasks import dispatch_notification_outbox
+
+        countdown = settings.NOTIFICATION_OUTBOX_DELAY
+        if at is not None:
+            countdown = max(countdown, int((at - timezone.now()).total_seconds()) + 1)
+        try:
+            if cache.add(cls.DISPATCH_FLAG_KEY, 1, countdown + cls.DISPATCH_FLAG_TIMEOUT):
+                dispatch_notification_outbox.apply_async(countdown=countdown)
+        except Exception as e:
+            logger.warning(f"No se pudo programar el envío de notificaciones: {str(e)}")
+
+    @classmethod
+    def schedule_next(cls):
+        """Tras drenar, programa la entrega de las filas que aún esperan su ventana o reintento"""
+        next_at = NotificationOutbox.objects.filter(status='PENDING').aggregate(
+            next_at=Min('available_at')
+        )['next_at']
+        if next_at is not None:
+            cls.schedule_dispatch(next_at)
+
+    @classmethod
+    def clear_dispatch_flag(cls):
+        try:
+            cache.delete(cls.DISPATCH_FLAG_KEY)
+        except Exception as e:
+            logger.warning(f"No se pudo limpiar la marca de envío de notificaciones: {str(e)}")
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.NOTIFICATION_OUTBOX_BATCH_SIZE
+        self.max_attempts = settings.NOTIFICATION_OUTBOX_MAX_ATTEMPTS
+        # Sin credenciales de WhatsApp solo se entrega en la app
+        self.whatsapp = WhatsAppService() if (
+            settings.WHATSAPP_ACCESS_TOKEN and settings.WHATSAPP_PHONE_NUMBER_ID
+        ) else None
+
+    def dispatch(self, max_batches=50):
+        """Vacía la bandeja lote a lote; devuelve {'sent', 'retry', 'failed'}"""
+        totals = {'sent': 0, 'retry': 0, 'failed': 0}
+        for _ in range(max_batches):
+            counts = self.dispatch_batch()
+            if counts is None:
+                break
+            for name, value in counts.items():
+                totals[name] += value
+        return totals
+
+    def dispatch_batch(self):
+        """
+        Entrega un lote en dos transacciones cortas, con WhatsApp entre ambas:
+
+        1. Bloquea las filas con SKIP LOCKED (varios workers drenan a la vez sin
+           repartirse la misma fila), crea las Notification y marca las filas:
+           las que no van por WhatsApp quedan enviadas y las demás se reservan
+           hasta claimed_until (NOTIFICATION_OUTBOX_CLAIM_SECONDS). La entrega
+           en la app es exactamente una.
+        2. Sin transacción ni bloqueos, envía los mensajes de WhatsApp, con sus
+           reintentos y esperas del limitador.
+        3. Registra el resultado solo en las filas que siguen reservadas por
+           este worker. Si el proceso cae antes, la reserva vence y otro worker
+           reenvía: la entrega por WhatsApp es al menos una.
+        """
+        now = timezone.now()
+        claimed_until = now + timedelta(seconds=settings.NOTIFICATION_OUTBOX_CLAIM_SECONDS)
+        counts = {'sent': 0, 'retry': 0, 'failed': 0}
+        with transaction.atomic():
+            rows = list(
+                NotificationOutbox.objects
+                .select_for_update(skip_locked=True, of=('self',))
+                .select_related('user__userprofile')
+                .filter(status='PENDING', available_at__lte=now)
+                .order_by('available_at', 'id')[:self.batch_size]
+            )
+            if not rows:
+                return None
+
+            # Las filas de un mismo usuario se entregan juntas: una Notification
+            # y un mensaje de WhatsApp por grupo en lugar de uno por fila
+            in_app = []
+            to_whatsapp = []
+            for group in self._digest_groups(rows):
+                pending = [row for row in group if row.notification_id is None]
+                if pending:
+                    in_app.append(pending)
+                pending = [row for row in group if row.send_whatsapp and row.whatsapp_sent_at is None]
+                phone = self._phone(group[0].user) if self.whatsapp and pending else None
+                if phone:
+                    to_whatsapp.append((pending, phone))
+
+            created = Notification.objects.bulk_create([self._notification(group) for group in in_app])
+            for group, notification in zip(in_app, created):
+                for row in group:
+                    row.notification = notification
+
+            waiting = {row.id for pending, _ in to_whatsapp for row in pending}
+            for row in rows:
+                if row.id in waiting:
+                    row.available_at = claimed_until
+                else:
+                    row.status = 'SENT'
+                    row.sent_at = now
+                    counts['sent'] += 1
+            NotificationOutbox.objects.bulk_update(rows, ['notification', 'status', 'sent_at', 'available_at'])
+
+        if to_whatsapp:
+            results = self.whatsapp.send_messages([
+                (phone, self._digest(pending)[2]) for pending, phone in to_whatsapp
+            ])
+            self._record_whatsapp(to_whatsapp, results, claimed_until, counts)
+
+        logger.info(
+            f"Bandeja de notificaciones: lote de {len(rows)} "
+            f"({counts['sent']} enviadas, {counts['retry']} a reintentar, {counts['failed']} fallidas)"
         )
+        return counts
+
+    def _record_whatsapp(self, to_whatsapp, results, claimed_until, counts):
+        now = timezone.now()
+        outcome = {}
+        for (pending, _), (ok, detail) in zip(to_whatsapp, results):
+            for row in pending:
+                outcome[row.id] = (ok, detail)
+
+        with transaction.atomic():
+            # Las filas cuya reserva venció ya son de otro worker
+            rows = list(
+                NotificationOutbox.objects
+                .select_for_update(of=('self',))
+                .filter(id__in=list(outcome), status='PENDING', available_at=claimed_until)
+            )
+            for row in rows:
+                ok, detail = outcome[row.id]
+                if ok:
+                    row.whatsapp_sent_at = now
+                    row.status = 'SENT'
+                    row.sent_at = now
+                    counts['sent'] += 1
+                elif isinstance(detail, dict) and detail.get('error') == WhatsAppService.RATE_LIMITED:
+                    # Limitado por el token bucket: se reprograma sin gastar intento
+                    row.available_at = now + timedelta(seconds=detail['retry_after'])
+                    counts['retry'] += 1
+                else:
+                    row.attempts += 1
+                    row.last_error = str(detail)[:1000]
+                    if row.attempts >= self.max_attempts:
+                        row.status = 'FAILED'
+                        counts['failed'] += 1
+                    else:
+                        row.available_at = now + timedelta(seconds=30 * 2 ** row.attempts)
+                        counts['retry'] += 1
+            NotificationOutbox.objects.bulk_update(rows, [
+                'whatsapp_sent_at', 'status', 'sent_at', 'attempts', 'available_at', 'last_error'
+            ])
+
+    @staticmethod
+    def _digest(rows):
+        return digest_notifications((row.type, row.title, row.message) for row in rows)
+
+    @classmethod
+    def _notification(cls, rows):
+        type, title, message = cls._digest(rows)
+        return Notification(user_id=rows[0].user_id, type=type, title=title, message=message)
+
+    @staticmethod
+    def _digest_groups(rows):
+        """
+        Agrupa las filas del lote por usuario; dentro de cada usuario, las
+        creadas a menos de NOTIFICATION_DIGEST_WINDOW segundos de la primera del
+        grupo van juntas, hasta NOTIFICATION_DIGEST_MAX_ITEMS por grupo (un
+        mensaje de WhatsApp admite como mucho 4096 caracteres). Conserva el
+        orden del lote.
+        """
+        window = timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+        max_items = settings.NOTIFICATION_DIGEST_MAX_ITEMS
+        groups = []
+        open_groups = {}
+        for row in rows:
+            group = open_groups.get(row.user_id)
+            if (group is None or len(group) >= max_items
+                    or abs(row.created_at - group[0].created_at) > window):
+                group = open_groups[row.user_id] = []
+                groups.append(group)
+            group.append(row)
+        return groups
+
+    @staticmethod
+    def _phone(user):
+        profile = getattr(user, 'userprofile', None)
+        return profile.phone if profile and profile.phone else None
+
+class ReservationSeriesService:
+    """
+    Reserva el mismo horario en varias fechas (ligas, academias). Detecta
+    conflictos de todas las fechas con una sola consulta de rango e inserta
+    las reservas con bulk_create en una transacción.
+    """
+
+    def __init__(self, court, user, start_time, end_time, dates):
+        self.court = court
+        self.user = user
+        self.start_time = start_time
+        self.end_time = end_time
+        self.dates = sorted(dates)
+
+    def find_conflicts(self):
+        """Devuelve {fecha: motivo} para las fechas que no se pueden reservar"""
+        conflicts = {}
+        today = timezone.now().date()
+        span = span_mask(self.start_time, self.end_time)
+        pairs = [(self.court.id, date) for date in self.dates]
+
+        occupancy = range_occupancy([self.court.id], self.dates[0], self.dates[-1])
+        try:
+            held = SlotHoldService().held_masks(pairs)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer las reservas temporales: {str(e)}")
+            held = {}
+
+        for pair in pairs:
+            date = pair[1]
+            if date < today:
+                conflicts[date] = 'No se pueden hacer reservas en fechas pasadas'
+                continue
+            available, reason = self.court.is_available(date, self.start_time)
+            if not available:
+                conflicts[date] = reason
+            elif self.end_time > self.court.closing_time:
+                conflicts[date] = 'Horario fuera del horario de operación'
+            elif occupancy.get(pair, DayOccupancy()).mask & span:
+                conflicts[date] = 'Ya existe una reserva para este horario'
+            elif held.get(pair, 0) & span:
+                conflicts[date] = 'El horario está temporalmente reservado por otro usuario'
+        return conflicts
+
+    def total_amount(self):
+        start = datetime.combine(self.dates[0], self.start_time)
+        end = datetime.combine(self.dates[0], self.end_time)
+        hours = Decimal((end - start).total_seconds()) / Decimal(3600)
+        return (self.court.price_per_hour * hours).quantize(Decimal('0.01'))
+
+    def book(self, skip_conflicts=False):
+        """
+        Crea las reservas de la serie. Si hay conflictos y skip_conflicts es
+        False no se crea ninguna. Devuelve (reservas_creadas, conflictos).
+        """
+        series_id = uuid.uuid4()
+        total_amount = self.total_amount()
+
+        with transaction.atomic():
+            conflicts = self.find_conflicts()
+            if conflicts and not skip_conflicts:
+                return [], conflicts
+
+            reservations = [
+                Reservation(
+                    user=self.user,
+                    court=self.court,
+                    date=date,
+                    start_time=self.start_time,
+                    end_time=self.end_time,
+                    status='PENDING',
+                    total_amount=total_amount,
+                    series_id=series_id,
+                    time_range=Reservation.build_time_range(date, self.start_time, self.end_time)
+                )
+                for date in self.dates
+                if date not in conflicts
+            ]
+            if not reservations:
+                return [], conflicts
+
+            try:
+                # Si otra reserva entra entre la consulta y el insert, la
+                # restricción de exclusión aborta la serie completa
+                with transaction.atomic():
+                    Reservation.objects.bulk_create(reservations)
+            except IntegrityError:
+                raise ValidationError(
+                    'Otra reserva ocupó uno de los horarios mientras se creaba la serie; inténtelo de nuevo'
+                )
+
+            # bulk_create no dispara post_save
+            CourtSlotGrid.objects.rebuild((self.court.id, r.date) for r in reservations)
+            send_occupancy_changed((self.court.id, r.date) for r in reservations)
+            NotificationService.notify_series_created(reservations)
+
+        return reservations, conflicts
+
+_stripe_client = None
+_stripe_client_lock = threading.Lock()
+
+def get_stripe_client():
+    """
+    Cliente de Stripe compartido por el proceso, configurado una sola vez: no
+    toca stripe.api_key global, reutiliza conexiones (una sesión HTTP por
+    hilo) y aplica timeouts y reintentos de red con clave de idempotencia.
+    """
+    global _stripe_client
+    with _stripe_client_lock:
+        if _stripe_client is None:
+            _stripe_client = stripe.StripeClient(
+                settings.STRIPE_SECRET_KEY,
+                base_addresses={'api': settings.STRIPE_API_BASE},
+                max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+                http_client=stripe.RequestsClient(
+                    timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT)
+                )
+            )
+        return _stripe_client
 
 class PaymentService:
+    # client_secret y estado de cada PaymentIntent, para no consultar a Stripe al pintar el pago
+    INTENT_CACHE_KEY = 'stripe:intent:{}'
+
     def __init__(self):
-        stripe.api_key = settings.STRIPE_SECRET_KEY
+        self.client = get_stripe_client()
 
     def create_payment_intent(self, reservation):
         try:
-            intent = stripe.PaymentIntent.create(
-                amount=int(float(reservation.total_amount) * 100),  # Convertir a centavos
-                currency='usd',
-                metadata={'reservation_id': reservation.id}
-            )
-            return intent
+            intent = self.client.payment_intents.create(params={
+                'amount': int(reservation.total_amount * 100),  # Convertir a centavos
+                'currency': 'usd',
+                'metadata': {'reservation_id': reservation.id}
+            })
         except stripe.error.StripeError as e:
             raise PaymentError(str(e))
+        self.cache_intent(intent.id, intent.client_secret, intent.status)
+        return intent
+
+    def get_intent_details(self, payment_intent_id):
+        """{'client_secret', 'status'} del PaymentIntent; solo va a Stripe si no está en caché"""
+        details = self._cached_intent(payment_intent_id)
+        if details is None:
+            try:
+                intent = self.client.payment_intents.retrieve(payment_intent_id)
+            except stripe.error.StripeError as e:
+                raise PaymentError(str(e))
+            details = self.cache_intent(intent.id, intent.client_secret, intent.status)
+        return details
+
+    @classmethod
+    def _cached_intent(cls, payment_intent_id):
+        try:
+            return cache.get(cls.INTENT_CACHE_KEY.format(payment_intent_id))
+        except Exception as e:
+            logger.warning(f"No se pudo leer el PaymentIntent en caché: {str(e)}")
+            return None
+
+    @classmethod
+    def cache_intent(cls, payment_intent_id, client_secret, status):
+        details = {'client_secret': client_secret, 'status': status}
+        try:
+            cache.set(
+                cls.INTENT_CACHE_KEY.format(payment_intent_id), details,
+                settings.STRIPE_INTENT_CACHE_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el PaymentIntent en caché: {str(e)}")
+        return details
+
+    @classmethod
+    def update_cached_status(cls, payment_intent_id, status):
+        """Refresca el estado en caché (lo llama el consumidor de webhooks)"""
+        details = cls._cached_intent(payment_intent_id)
+        if details is not None and details['status'] != status:
+            cls.cache_intent(payment_intent_id, details['client_secret'], status)
+
+def confirm_reservations(reservations, now=None):
+    """
+    Confirma las reservas de pagos aprobados. PENDING -> CONFIRMED no cambia
+    la ocupación, así que basta un UPDATE sin señales; cualquier otro estado
+    (p. ej. una reserva cancelada) pasa por save() y su validación. Devuelve
+    {reservation_id: error} de las que no se pudieron confirmar.
+    """
+    now = now or timezone.now()
+    pending = [reservation for reservation in reservations if reservation.status == 'PENDING']
+    Reservation.objects.filter(
+        id__in=[reservation.id for reservation in pending], status='PENDING'
+    ).update(status='CONFIRMED', updated_at=now)
+    for reservation in pending:
+        reservation.status = 'CONFIRMED'
+
+    failed = {}
+    for reservation in reservations:
+        if reservation.status == 'CONFIRMED':
+            continue
+        previous = reservation.status
+        reservation.status = 'CONFIRMED'
+        try:
+            reservation.save(update_fields=['status', 'updated_at'])
+        except ValidationError as e:
+            reservation.status = previous
+            failed[reservation.id] = e.messages[0]
+    return failed
+
+class StripeEventService:
+    """
+    Aplica los eventos de webhook de Stripe guardados en StripeEvent. El
+    webhook solo inserta el evento verificado y responde; esta clase lo aplica
+    después por lotes, respetando el orden de los eventos de cada PaymentIntent.
+    """
+
+    PROCESS_FLAG_KEY = 'stripe:events:process-scheduled'
+    PROCESS_FLAG_TIMEOUT = 60
+    # Un evento que espera a otro anterior de su PaymentIntent se vuelve a mirar tras estos segundos
+    DEFER_SECONDS = 5
+
+    # Estado del pago que deja cada tipo de evento; el resto se ignoran
+    PAYMENT_STATUS = {
+        'payment_intent.succeeded': 'COMPLETED',
+        'payment_intent.payment_failed': 'FAILED',
+    }
+
+    @classmethod
+    def ingest(cls, event):
+        """
+        Guarda el evento (dict JSON ya verificado); uno repetido no se duplica.
+        Los tipos que no se aplican se guardan ya ignorados, para que nunca
+        retengan a los eventos posteriores de su PaymentIntent.
+        """
+        data = event.get('data', {}).get('object', {})
+        intent_id = data.get('id') if data.get('object') == 'payment_intent' else data.get('payment_intent')
+        applicable = event['type'] in cls.PAYMENT_STATUS and bool(intent_id)
+        StripeEvent.objects.bulk_create([
+            StripeEvent(
+                event_id=event['id'],
+                type=event['type'],
+                payment_intent_id=intent_id,
+                payload=event,
+                stripe_created=datetime.fromtimestamp(event['created'], tz=dt_timezone.utc),
+                status='PENDING' if applicable else 'IGNORED',
+                processed_at=None if applicable else timezone.now()
+            )
+        ], ignore_conflicts=True)
+        if applicable:
+            transaction.on_commit(cls.schedule_processing)
+
+    @classmethod
+    def schedule_processing(cls):
+        from .tasks import process_stripe_events
+
+        try:
+            if cache.add(cls.PROCESS_FLAG_KEY, 1, cls.PROCESS_FLAG_TIMEOUT):
+                process_stripe_events.delay()
+        except Exception as e:
+            logger.warning(f"No se pudo programar el procesamiento de eventos de Stripe: {str(e)}")
+
+    @classmethod
+    def clear_process_flag(cls):
+        try:
+            cache.delete(cls.PROCESS_FLAG_KEY)
+        except Exception as e:
+            logger.warning(f"No se pudo limpiar la marca de eventos de Stripe: {str(e)}")
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.STRIPE_EVENT_BATCH_SIZE
+        self.max_attempts = settings.STRIPE_EVENT_MAX_ATTEMPTS
+
+    def process(self, max_batches=50):
+        """Aplica los eventos pendientes lote a lote; devuelve los totales por resultado"""
+        totals = {'processed': 0, 'ignored': 0, 'deferred': 0, 'retry': 0, 'failed': 0}
+        for _ in range(max_batches):
+            counts = self.process_batch()
+            if counts is None:
+                break
+            for name, value in counts.items():
+                totals[name] += value
+        return totals
+
+    def process_batch(self):
+        """
+        Aplica un lote. Los eventos se bloquean con SKIP LOCKED, así varios
+        workers pueden procesar a la vez; si un PaymentIntent tiene un evento
+        anterior pendiente fuera del lote (de otro worker o esperando
+        reintento), sus eventos se aplazan para no aplicarlos desordenados.
+        Aplicar un evento dos veces no tiene efecto: solo se cambia lo que
+        difiere del estado final.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            events = list(
+                StripeEvent.objects
+                .select_for_update(skip_locked=True)
+                .filter(status='PENDING', available_at__lte=now)
+                .order_by('stripe_created', 'id')[:self.batch_size]
+            )
+            if not events:
+                return None
+
+            counts = {'processed': 0, 'ignored': 0, 'deferred': 0, 'retry': 0, 'failed': 0}
+            by_intent = {}
+            for event in events:
+                if event.type in self.PAYMENT_STATUS and event.payment_intent_id:
+                    by_intent.setdefault(event.payment_intent_id, []).append(event)
+                else:
+                    event.status = 'IGNORED'
+                    event.processed_at = now
+                    counts['ignored'] += 1
+
+            # Solo se aplican los eventos anteriores al primer pendiente del
+            # mismo PaymentIntent que no está en el lote
+            earlier = self._earlier_pending(by_intent, {event.id for event in events})
+            for intent_id, blocker in earlier.items():
+                intent_events = by_intent.pop(intent_id)
+                ready = [event for event in intent_events if (event.stripe_created, event.id) < blocker]
+                for event in intent_events[len(ready):]:
+                    event.available_at = now + timedelta(seconds=self.DEFER_SECONDS)
+                    counts['deferred'] += 1
+                if ready:
+                    by_intent[intent_id] = ready
+
+            if by_intent:
+                try:
+                    with transaction.atomic():
+                        missing = self._apply(by_intent, now)
+                except Exception as e:
+                    logger.exception(f"Error aplicando eventos de Stripe: {str(e)}")
+                    missing = {intent_id: str(e) for intent_id in by_intent}
+
+                for intent_id, intent_events in by_intent.items():
+                    for event in intent_events:
+                        if intent_id in missing:
+                            event.attempts += 1
+                            event.last_error = missing[intent_id][:1000]
+                            if event.attempts >= self.max_attempts:
+                                event.status = 'FAILED'
+                                counts['failed'] += 1
+                            else:
+                                event.available_at = now + timedelta(seconds=30 * 2 ** event.attempts)
+                                counts['retry'] += 1
+                        else:
+                            event.status = 'PROCESSED'
+                            event.processed_at = now
+                            counts['processed'] += 1
+
+            StripeEvent.objects.bulk_update(events, [
+                'status', 'attempts', 'available_at', 'last_error', 'processed_at'
+            ])
+
+        logger.info(
+            f"Eventos de Stripe: lote de {len(events)} "
+            f"({', '.join(f'{value} {name}' for name, value in counts.items() if value)})"
+        )
+        return counts
+
+    @classmethod
+    def _earlier_pending(cls, by_intent, batch_ids):
+        """
+        {payment_intent_id: (stripe_created, id)} del primer evento pendiente
+        fuera del lote. Solo cuentan los tipos que se aplican.
+        """
+        earlier = {}
+        if not by_intent:
+            return earlier
+        rows = (
+            StripeEvent.objects
+            .filter(status='PENDING', payment_intent_id__in=list(by_intent), type__in=list(cls.PAYMENT_STATUS))
+            .exclude(id__in=batch_ids)
+            .order_by('stripe_created', 'id')
+            .values_list('payment_intent_id', 'stripe_created', 'id')
+        )
+        for intent_id, created, event_id in rows:
+            earlier.setdefault(intent_id, (created, event_id))
+        return earlier
+
+    def _apply(self, by_intent, now):
+        """
+        Aplica los eventos agrupados por PaymentIntent con UPDATE por lote.
+        Devuelve {payment_intent_id: error} de los que no se pudieron aplicar
+        (p. ej. el pago aún no existe porque el webhook llegó antes del commit).
+        """
+        payments = {
+            payment.stripe_payment_intent_id: payment
+            for payment in Payment.objects.select_for_update(of=('self',))
+            .select_related('reservation')
+            .filter(stripe_payment_intent_id__in=list(by_intent))
+        }
+        missing = {}
+        new_status = {}
+        for intent_id, intent_events in by_intent.items():
+            payment = payments.get(intent_id)
+            if payment is None:
+                missing[intent_id] = 'Pago no encontrado'
+                continue
+            status = payment.status
+            for event in intent_events:
+                target = self.PAYMENT_STATUS[event.type]
+                # Un pago completado no vuelve a fallido
+                if status != 'COMPLETED':
+                    status = target
+            if status != payment.status:
+                new_status.setdefault(status, []).append(payment)
+            # Estado del PaymentIntent en Stripe tras el último evento
+            intent_status = intent_events[-1].payload.get('data', {}).get('object', {}).get('status')
+            if intent_status:
+                transaction.on_commit(
+                    lambda intent_id=intent_id, intent_status=intent_status:
+                        PaymentService.update_cached_status(intent_id, intent_status)
+                )
+
+        for status, status_payments in new_status.items():
+            Payment.objects.filter(id__in=[payment.id for payment in status_payments]).update(
+                status=status, updated_at=now
+            )
+
+        failed = confirm_reservations([payment.reservation for payment in new_status.get('COMPLETED', [])], now)
+        for reservation_id, error in failed.items():
+            logger.warning(f"Pago completado pero no se pudo confirmar la reserva #{reservation_id}: {error}")
+        return missing
+
+class PaymentValidationQueue:
+    """
+    Cola de pagos por validar (Pago Móvil y Zelle) para varios administradores
+    a la vez. Se recorre por keyset sobre (created_at, id), el orden del
+    índice parcial payment_validation_queue_idx, sin OFFSET. Cada
+    administrador toma lotes con SELECT ... FOR UPDATE SKIP LOCKED y los
+    retiene PAYMENT_CLAIM_TTL segundos: mientras dure la reserva nadie más
+    los toma, y si no los valida vuelven solos a la cola.
+    """
+
+    def __init__(self, admin):
+        self.admin = admin
+
+    @staticmethod
+    def queryset():
+        return Payment.objects.filter(
+            status__in=Payment.VALIDATION_STATUSES,
+            payment_type__in=Payment.VALIDATION_TYPES
+        )
+
+    def _available(self, now):
+        # Libres, con la reserva vencida o ya tomados por este administrador
+        return Q(claimed_by__isnull=True) | Q(claim_expires_at__lte=now) | Q(claimed_by=self.admin)
+
+    @staticmethod
+    def _limit(limit):
+        return max(1, min(limit or settings.PAYMENT_QUEUE_PAGE_SIZE, settings.PAYMENT_QUEUE_MAX_PAGE_SIZE))
+
+    @staticmethod
+    def encode_cursor(payment):
+        raw = f'{payment.created_at.isoformat()}|{payment.id}'
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            created_at, payment_id = raw.rsplit('|', 1)
+            return datetime.fromisoformat(created_at), int(payment_id)
+        except ValueError:
+            raise ValidationError('Cursor inválido')
+
+    def _with_details(self, payments):
+        return payments.select_related('reservation__court', 'reservation__user', 'claimed_by')
+
+    def page(self, cursor=None, limit=None, available_only=False):
+        """Una página de la cola en orden de llegada; devuelve (pagos, cursor_siguiente)"""
+        limit = self._limit(limit)
+        payments = self._with_details(self.queryset()).order_by('created_at', 'id')
+        if cursor:
+            created_at, payment_id = self.decode_cursor(cursor)
+            payments = payments.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=payment_id)
+            )
+        if available_only:
+            payments = payments.filter(self._available(timezone.now()))
+        items = list(payments[:limit + 1])
+        next_cursor = self.encode_cursor(items[limit - 1]) if len(items) > limit else None
+        return items[:limit], next_cursor
+
+    def claim(self, limit=None):
+        """
+        Toma hasta `limit` pagos libres, los más antiguos primero. Las filas
+        que otro administrador está tomando en ese momento se saltan (SKIP
+        LOCKED) en lugar de esperar. Devuelve (pagos, vencimiento).
+        """
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=settings.PAYMENT_CLAIM_TTL)
+        with transaction.atomic():
+            ids = list(
+                self.queryset()
+                .filter(self._available(now))
+                .select_for_update(skip_locked=True)
+                .order_by('created_at', 'id')
+                .values_list('id', flat=True)[:self._limit(limit)]
+            )
+            Payment.objects.filter(id__in=ids).update(claimed_by=self.admin, claim_expires_at=expires_at)
+        payments = self._with_details(Payment.objects.filter(id__in=ids)).order_by('created_at', 'id')
+        return list(payments), expires_at
+
+    def release(self, payment_ids=None):
+        """Devuelve a la cola los pagos tomados por este administrador (todos o los indicados)"""
+        payments = Payment.objects.filter(claimed_by=self.admin)
+        if payment_ids is not None:
+            payments = payments.filter(id__in=payment_ids)
+        return payments.update(claimed_by=None, claim_expires_at=None)
+
+class PaymentValidationService:
+    """
+    Aprueba o rechaza pagos por lote en una transacción: un UPDATE con
+    Case/When para todos los pagos, un UPDATE para las reservas y un INSERT
+    para las notificaciones, en lugar de varias escrituras por pago.
+    """
+
+    ACTIONS = {'approve': 'COMPLETED', 'reject': 'FAILED'}
+
+    def __init__(self, admin):
+        self.admin = admin
+
+    def validate(self, items):
+        """
+        items: [{'payment_id', 'action' ('approve'|'reject'), 'notes'}]. Devuelve
+        un resultado por elemento, en el mismo orden: {'payment_id', 'ok',
+        'status'} o {'payment_id', 'ok': False, 'error'}. Los errores de un
+        elemento no afectan a los demás.
+        """
+        now = timezone.now()
+        results = {}
+        with transaction.atomic():
+            payments = {
+                payment.id: payment
+                for payment in Payment.objects
+                .select_for_update(of=('self',))
+                .select_related('reservation__court', 'reservation__user')
+                .filter(id__in={item['payment_id'] for item in items})
+            }
+
+            accepted = {}
+            for index, item in enumerate(items):
+                payment = payments.get(item['payment_id'])
+                error = None
+                if payment is None:
+                    error = 'Pago no encontrado'
+                elif payment.id in accepted:
+                    error = 'Pago repetido en el lote'
+                elif payment.status not in Payment.VALIDATION_STATUSES:
+                    error = f'El pago ya fue procesado ({payment.get_status_display()})'
+                elif (payment.claimed_by_id not in (None, self.admin.id)
+                        and payment.claim_expires_at and payment.claim_expires_at > now):
+                    error = 'El pago lo tiene tomado otro administrador'
+                if error:
+                    results[index] = {'payment_id': item['payment_id'], 'ok': False, 'error': error}
+                else:
+                    accepted[payment.id] = (index, item)
+
+            # Las reservas primero: si una ya no se puede confirmar, su pago no se aprueba
+            approved = [payments[payment_id] for payment_id, (_, item) in accepted.items()
+                        if item['action'] == 'approve']
+            failed = confirm_reservations([payment.reservation for payment in approved], now)
+            for payment in approved:
+                if payment.reservation_id in failed:
+                    index, item = accepted.pop(payment.id)
+                    results[index] = {
+                        'payment_id': payment.id, 'ok': False,
+                        'error': f'No se pudo confirmar la reserva: {failed[payment.reservation_id]}'
+                    }
+
+            if accepted:
+                self._update_payments(accepted, now)
+                for payment_id, (index, item) in accepted.items():
+                    payment = payments[payment_id]
+                    payment.status = self.ACTIONS[item['action']]
+                    results[index] = {'payment_id': payment_id, 'ok': True, 'status': payment.status}
+                PaymentNotificationService().notify_payment_statuses(
+                    payments[payment_id] for payment_id in accepted
+                )
+
+        return [results[index] for index in range(len(items))]
+
+    def _update_payments(self, accepted, now):
+        approve_ids = [payment_id for payment_id, (_, item) in accepted.items() if item['action'] == 'approve']
+        notes = [
+            When(id=payment_id, then=Value(item['notes']))
+            for payment_id, (_, item) in accepted.items() if item.get('notes')
+        ]
+        Payment.objects.filter(id__in=list(accepted)).update(
+            status=Case(When(id__in=approve_ids, then=Value('COMPLETED')), default=Value('FAILED')),
+            received_by=Case(
+                When(id__in=approve_ids, then=Value(self.admin.id)),
+                default=F('received_by'),
+                output_field=IntegerField()
+            ),
+            validation_notes=Case(*notes, default=Value('')) if notes else Value(''),
+            claimed_by=None,
+            claim_expires_at=None,
+            updated_at=now
+        )
 
 class PaymentNotificationService:
+    # Ids de los administradores; se invalida cuando cambia is_staff (core.signals)
+    STAFF_IDS_KEY = 'notifications:staff-ids'
+    STAFF_IDS_TIMEOUT = 60 * 60
+
+    @classmethod
+    def staff_ids(cls):
+        ids = cache.get(cls.STAFF_IDS_KEY)
+        if ids is None:
+            ids = list(User.objects.filter(is_staff=True).order_by('id').values_list('id', flat=True))
+            cache.set(cls.STAFF_IDS_KEY, ids, cls.STAFF_IDS_TIMEOUT)
+        return ids
+
+    @classmethod
+    def invalidate_staff_ids(cls):
+        # Se llama tras el commit: sin Redis la lista caduca sola (STAFF_IDS_TIMEOUT)
+        try:
+            cache.delete(cls.STAFF_IDS_KEY)
+        except Exception as e:
+            logger.warning(f"No se pudo invalidar la lista de administradores: {str(e)}")
+
     def notify_admin_pending_validation(self, payment):
-        """Notifica a los administradores sobre un nuevo pago pendiente"""
-        admins = User.objects.filter(is_staff=True)
-        
-        for admin in admins:
-            Notification.objects.create(
-                user=admin,
+        """
+        Notifica a los administradores sobre un nuevo pago pendiente con un solo
+        INSERT. Se ejecuta en Celery (tasks.notify_admins_pending_payment).
+        """
+        message = (
+            f'El pago #{payment.id} requiere validación.\n'
+            f'Reserva: {payment.reservation}\n'
+            f'Monto: ${payment.amount}\n'
+            f'Método: {payment.get_payment_type_display()}'
+        )
+        return Notification.objects.bulk_create([
+            Notification(
+                user_id=admin_id,
                 type='PAYMENT_PENDING',
                 title='Nuevo pago pendiente de validación',
-                message=f'El pago #{payment.id} requiere validación.\n'
-                        f'Reserva: {payment.reservation}\n'
-                        f'Monto: ${payment.amount}\n'
-                        f'Método: {payment.get_payment_type_display()}'
+                message=message
             )
+            for admin_id in self.staff_ids()
+        ])
 
-    def notify_payment_status(self, payment):
-        """Notifica al usuario sobre el estado de su pago"""
-        status_messages = {
-            'PENDING_VALIDATION': 'Tu pago está pendiente de validación',
-            'COMPLETED': 'Tu pago ha sido aprobado',
-            'FAILED': 'Tu pago ha sido rechazado'
-        }
-        
-        Notification.objects.create(
+    STATUS_MESSAGES = {
+        'PENDING_VALIDATION': 'Tu pago está pendiente de validación',
+        'COMPLETED': 'Tu pago ha sido aprobado',
+        'FAILED': 'Tu pago ha sido rechazado'
+    }
+
+    def _status_entry(self, payment):
+        return NotificationOutbox(
             user=payment.reservation.user,
             type='PAYMENT_STATUS',
             title=f'Estado de pago actualizado',
-            message=f'{status_messages[payment.status]}\n'
+            message=f'{self.STATUS_MESSAGES[payment.status]}\n'
                     f'Reserva: {payment.reservation}\n'
                     f'Monto: ${payment.amount}'
-        )
\ No newline at end of file
+        )
+
+    def notify_payment_status(self, payment):
+        """Notifica al usuario sobre el estado de su pago"""
+        NotificationOutboxService.enqueue_many([self._status_entry(payment)])
+
+    def notify_payment_statuses(self, payments):
+        """Igual que notify_payment_status para varios pagos, con un solo INSERT"""
+        entries = [self._status_entry(payment) for payment in payments]
+        if entries:
+            NotificationOutboxService.enqueue_many(entries)
+
+class SlotHoldService:
+    """
+    Reservas temporales de slots en Redis mientras el usuario confirma.
+
+    Cada (cancha, día) es un sorted set cuyos miembros son
+    "<token>:<celda_inicio>:<celda_fin>" con la expiración (ms) como score.
+    Los scripts Lua limpian expirados y comprueban solapamientos de forma
+    atómica, así que la contención se resuelve en Redis y no en PostgreSQL.
+    Cada usuario tiene además un sorted set con sus tokens vigentes, que
+    limita cuántas retenciones puede tener a la vez (SLOT_HOLD_MAX_PER_USER).
+    """
+
+    # Devuelve la expiración (ms), 0 si otro token retiene el intervalo y -1
+    # si el usuario ya tiene el máximo de retenciones
+    ACQUIRE_SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now_ms)
+    if not redis.call('ZSCORE', KEYS[2], ARGV[4]) and redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[5]) then
+        return -1
+    end
+    local start_cell = tonumber(ARGV[2])
+    local end_cell = tonumber(ARGV[3])
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        local token, s, e = string.match(member, '^([^:]+):(%d+):(%d+)$')
+        if token == ARGV[4] then
+            redis.call('ZREM', KEYS[1], member)
+        elseif tonumber(s) < end_cell and tonumber(e) > start_cell then
+            return 0
+        end
+    end
+    local expires = now_ms + tonumber(ARGV[1])
+    redis.call('ZADD', KEYS[1], expires, ARGV[4] .. ':' .. ARGV[2] .. ':' .. ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+    redis.call('ZADD', KEYS[2], expires, ARGV[4])
+    redis.call('PEXPIRE', KEYS[2], ARGV[1])
+    return expires
+    """
+
+    # Devuelve 1 si el token cubre el intervalo, 0 si nadie lo retiene y -1 si
+    # lo retiene otro token
+    CHECK_SCRIPT = """
+    local now = redis.call('TIME')
+    local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+    local start_cell = tonumber(ARGV[1])
+    local end_cell = tonumber(ARGV[2])
+    local result = 0
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        local token, s, e = string.match(member, '^([^:]+):(%d+):(%d+)$')
+        s = tonumber(s)
+        e = tonumber(e)
+        if token == ARGV[3] then
+            if s <= start_cell and e >= end_cell then
+                result = 1
+            end
+        elseif s < end_cell and e > start_cell then
+            return -1
+        end
+    end
+    return result
+    """
+
+    RELEASE_SCRIPT = """
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        if string.sub(member, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. ':' then
+            redis.call('ZREM', KEYS[1], member)
+            return 1
+        end
+    end
+    return 0
+    """
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        self.ttl = getattr(settings, 'SLOT_HOLD_TTL', 300)
+        self.max_per_user = settings.SLOT_HOLD_MAX_PER_USER
+
+    @staticmethod
+    def _key(court_id, date):
+        return cache.make_key(f'holds:{court_id}:{date}')
+
+    @staticmethod
+    def _user_key(user_id):
+        return cache.make_key(f'holds:user:{user_id}')
+
+    @staticmethod
+    def _split_token(token):
+        """El token lleva la cancha, el día y el usuario: <court_id>.<YYYY-MM-DD>.<user_id>.<uuid>"""
+        try:
+            court_id, date, user_id, _ = token.split('.')
+            return int(court_id), date, int(user_id)
+        except (AttributeError, ValueError):
+            raise SlotHoldError('Token de reserva temporal inválido')
+
+    @classmethod
+    def parse_token(cls, token):
+        court_id, date, _ = cls._split_token(token)
+        return court_id, date
+
+    @classmethod
+    def owner(cls, token):
+        return cls._split_token(token)[2]
+
+    def _eval(self, script, *args):
+        try:
+            return self.redis.eval(script, *args)
+        except RedisError as e:
+            logger.warning(f"No se pudo acceder a las reservas temporales: {str(e)}")
+            raise SlotHoldUnavailable('Las reservas temporales no están disponibles, intente de nuevo')
+
+    def acquire(self, court_id, date, start_time, end_time, user_id, token=None):
+        """Retiene el intervalo para user_id; devuelve (token, expira_en_ms) o lanza SlotHoldError"""
+        token = token or f'{court_id}.{date}.{user_id}.{uuid.uuid4().hex}'
+        expires = int(self._eval(
+            self.ACQUIRE_SCRIPT, 2, self._key(court_id, date), self._user_key(user_id),
+            self.ttl * 1000,
+            time_to_cell(start_time),
+            time_to_cell(end_time, round_up=True),
+            token,
+            self.max_per_user
+        ))
+        if expires < 0:
+            raise SlotHoldError(
+                f'Ya tienes {self.max_per_user} reservas temporales activas; confirma o libera alguna'
+            )
+        if not expires:
+            raise SlotHoldError('El horario está temporalmente reservado por otro usuario')
+        return token, expires
+
+    def check(self, court_id, date, start_time, end_time, token=None):
+        return int(self.redis.eval(
+            self.CHECK_SCRIPT, 1, self._key(court_id, date),
+            time_to_cell(start_time),
+            time_to_cell(end_time, round_up=True),
+            token or ''
+        ))
+
+    def release(self, token):
+        court_id, date, user_id = self._split_token(token)
+        return bool(self._eval(
+            self.RELEASE_SCRIPT, 2, self._key(court_id, date), self._user_key(user_id), token
+        ))
+
+    def held_masks(self, pairs, exclude_token=None):
+        """
+        Máscara de celdas retenidas por (court_id, date), leída en un solo
+        pipeline. La expiración se compara con TIME de Redis, el mismo reloj
+        que usan los scripts.
+        """
+        pairs = list(pairs)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.time()
+        for court_id, date in pairs:
+            pipe.zrange(self._key(court_id, date), 0, -1, withscores=True)
+        (seconds, microseconds), *results = pipe.execute()
+        now_ms = seconds * 1000 + microseconds // 1000
+
+        masks = {}
+        for pair, members in zip(pairs, results):
+            mask = 0
+            for member, expires in members:
+                if expires <= now_ms:
+                    continue
+                token, start_cell, end_cell = member.decode().rsplit(':', 2)
+                if token != exclude_token:
+                    mask |= cells_mask(int(start_cell), int(end_cell))
+            masks[pair] = mask
+        return masks
+
+    def apply_to(self, occupancy, exclude_token=None):
+        """Suma las retenciones vigentes a un dict {(court_id, date): DayOccupancy}"""
+        try:
+            masks = self.held_masks(occupancy.keys(), exclude_token)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer las reservas temporales: {str(e)}")
+            return occupancy
+        return {
+            pair: DayOccupancy(day.mask | masks.get(pair, 0))
+            for pair, day in occupancy.items()
+        }
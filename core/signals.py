@@ -0,0 +1,127 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .availability import invalidate_court, invalidate_days
+from .catalog import court_catalog
+from .events import publish_availability_changes
+from .inbox import adjust_unread
+from .models import Court, CourtSlotGrid, Notification, Reservation
+
+logger = logging.getLogger(__name__)
+
+# Se emite tras el commit con pairs=[(court_id, date), ...] cada vez que cambia
+# la ocupación de una cancha. Las operaciones masivas (bulk_create, update) no
+# disparan post_save y deben enviarla explícitamente.
+occupancy_changed = Signal()
+
+
+def send_occupancy_changed(pairs, sender=Reservation):
+    pairs = {(court_id, date) for court_id, date in pairs if court_id and date}
+    if pairs:
+        # robust: un receptor que falla no impide los demás ni el resto de on_commit
+        transaction.on_commit(
+            lambda: occupancy_changed.send_robust(sender=sender, pairs=pairs), robust=True
+        )
+
+
+@receiver(occupancy_changed)
+def invalidate_availability_cache(sender, pairs, **kwargs):
+    invalidate_days(pairs)
+
+
+@receiver(occupancy_changed)
+def publish_availability(sender, pairs, **kwargs):
+    # Después de invalidar la caché, para que los suscriptores lean el estado nuevo
+    publish_availability_changes(pairs)
+
+
+@receiver(post_save, sender=Reservation)
+def reservation_saved(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_occupancy', None)
+    current = instance.occupancy_state()
+    instance._loaded_occupancy = current
+
+    if previous == current:
+        return
+    # Dentro de la transacción del save: la tabla materializada cambia con la reserva
+    CourtSlotGrid.objects.apply_change(previous, current)
+    send_occupancy_changed(state[:2] for state in (previous, current) if state)
+
+
+@receiver(post_delete, sender=Reservation)
+def reservation_deleted(sender, instance, origin=None, **kwargs):
+    state = getattr(instance, '_loaded_occupancy', None) or instance.occupancy_state()
+    if not state:
+        return
+    # Al borrar la cancha sus filas de ocupación se borran en cascada
+    if not isinstance(origin, Court):
+        CourtSlotGrid.objects.apply_change(state, None)
+    send_occupancy_changed([state[:2]])
+
+
+@receiver(post_save, sender=Court)
+def court_saved(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_loaded_schedule', None)
+    current = instance.schedule_state()
+    instance._loaded_schedule = current
+
+    transaction.on_commit(court_catalog.invalidate, robust=True)
+    if not created and previous != current:
+        transaction.on_commit(lambda: invalidate_court(instance.pk), robust=True)
+
+
+@receiver(post_delete, sender=Court)
+def court_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(court_catalog.invalidate, robust=True)
+    transaction.on_commit(lambda: invalidate_court(pk), robust=True)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # update_last_login y similares guardan solo otros campos: nada que revisar
+    if update_fields is not None and 'is_staff' not in update_fields:
+        return
+
+    # Se compara con la lista en caché para no consultar el estado anterior
+    from .services import PaymentNotificationService
+
+    try:
+        staff_ids = cache.get(PaymentNotificationService.STAFF_IDS_KEY)
+    except Exception as e:
+        logger.warning(f"No se pudo leer la lista de administradores en caché: {str(e)}")
+        return
+    if staff_ids is not None and (instance.pk in staff_ids) != instance.is_staff:
+        transaction.on_commit(PaymentNotificationService.invalidate_staff_ids)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    from .services import PaymentNotificationService
+
+    if instance.is_staff:
+        transaction.on_commit(PaymentNotificationService.invalidate_staff_ids)
+
+
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance, created, **kwargs):
+    if created:
+        was_unread = False
+    else:
+        was_unread = getattr(instance, '_loaded_read', instance.read) is False
+    is_unread = not instance.read
+    instance._loaded_read = instance.read
+
+    if was_unread != is_unread:
+        adjust_unread({instance.user_id: 1 if is_unread else -1})
+
+
+@receiver(post_delete, sender=Notification)
+def notification_deleted(sender, instance, **kwargs):
+    if not getattr(instance, '_loaded_read', instance.read):
+        adjust_unread({instance.user_id: -1})
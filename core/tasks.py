@@ -1,26 +1,176 @@
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
+from collections import defaultdict
 from datetime import timedelta
-from .models import Reservation
-from .services import NotificationService
+from . import availability, retention
+from .models import Notification, Payment, ReminderLedger, Reservation
+from .services import (
+    NotificationOutboxService, NotificationService, PaymentNotificationService, StripeEventService,
+    digest_notifications
+)
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+@shared_task
+def dispatch_notification_outbox():
+    """Entrega por lotes las notificaciones pendientes de la bandeja de salida"""
+    # Se limpia antes de drenar: lo que se encole mientras tanto programa otra ejecución
+    NotificationOutboxService.clear_dispatch_flag()
+    totals = NotificationOutboxService().dispatch()
+    NotificationOutboxService.schedule_next()
+    if any(totals.values()):
+        logger.info(f"Bandeja de notificaciones drenada: {totals}")
+    return totals
+
+@shared_task
+def process_stripe_events():
+    """Aplica por lotes los eventos de webhook de Stripe pendientes"""
+    StripeEventService.clear_process_flag()
+    totals = StripeEventService().process()
+    if any(totals.values()):
+        logger.info(f"Eventos de Stripe: {totals}")
+    return totals
+
+@shared_task(bind=True, max_retries=settings.AVAILABILITY_INVALIDATION_MAX_RETRIES)
+def retry_availability_invalidation(self, key):
+    """Sube una versión de disponibilidad cuya invalidación falló tras el commit"""
+    try:
+        availability.bump_version(key)
+    except Exception as e:
+        logger.warning(f"Reintento de invalidación de {key} fallido: {str(e)}")
+        raise self.retry(exc=e, countdown=min(2 ** self.request.retries, 60))
+
 @shared_task
 def notify_reservation_created(reservation_id):
+    """Compatibilidad con mensajes ya encolados: la notificación va a la bandeja de salida"""
     try:
-        reservation = Reservation.objects.get(id=reservation_id)
-        logger.info(f"Procesando notificación para reserva {reservation_id}")
+        reservation = Reservation.objects.select_related('court', 'user').get(id=reservation_id)
+        with transaction.atomic():
+            NotificationService.notify_reservation_created(reservation=reservation)
+        logger.info(f"Notificación encolada para reserva {reservation_id}")
         
-        notification = NotificationService.notify_reservation_created(reservation=reservation)
-        logger.info(f"Notificación {notification.id} creada para reserva {reservation_id}")
-        
-        return f"Notificación {notification.id} enviada para la reserva {reservation_id}"
+        return f"Notificación encolada para la reserva {reservation_id}"
     except Exception as e:
         logger.error(f"Error al notificar reserva {reservation_id}: {str(e)}")
         raise
 
+@shared_task
+def notify_admins_pending_payment(payment_id):
+    """Avisa a todos los administradores de un pago pendiente de validación"""
+    try:
+        payment = Payment.objects.select_related('reservation__court').get(id=payment_id)
+    except Payment.DoesNotExist:
+        logger.warning(f"Pago {payment_id} no encontrado para notificar a los administradores")
+        return None
+
+    notifications = PaymentNotificationService().notify_admin_pending_validation(payment)
+    logger.info(f"Pago {payment_id}: {len(notifications)} administradores notificados")
+    return len(notifications)
+
+def _keyset_after(fields, values):
+    """Filtro "(fields) > (values)" en orden lexicográfico, para paginar por keyset"""
+    condition = Q()
+    for position, field in enumerate(fields):
+        equal = dict(zip(fields[:position], values[:position]))
+        condition |= Q(**equal, **{f'{field}__gt': values[position]})
+    return condition
+
+def iter_chunks(queryset, chunk_size, fields=('id',)):
+    """
+    Recorre el queryset en bloques de chunk_size paginando por fields (keyset;
+    el último campo debe ser único), de modo que la memoria queda acotada a un
+    bloque sin importar el total.
+    """
+    queryset = queryset.order_by(*fields)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(_keyset_after(fields, last))
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = [getattr(chunk[-1], field) for field in fields]
+
+def _digest_by_user(notifications):
+    """Una Notification por usuario con todos sus recordatorios del bloque"""
+    by_user = defaultdict(list)
+    for notification in notifications:
+        by_user[notification.user_id].append(notification)
+    digests = []
+    for user_id, items in by_user.items():
+        type, title, message = digest_notifications(
+            (item.type, item.title, item.message) for item in items
+        )
+        digests.append(Notification(user_id=user_id, type=type, title=title, message=message))
+    return digests
+
+def _send_reminders(queryset, build_notification, label, kind, window_hours):
+    """
+    Crea con bulk_create las notificaciones bloque a bloque, solo para las
+    reservas sin recordatorio de este tipo en la ventana en curso. Cada bloque
+    registra sus envíos en ReminderLedger en la misma transacción, así que
+    repetir la tarea dentro de la ventana no vuelve a avisar. Las reservas se
+    recorren por usuario y cada usuario recibe un único resumen por bloque.
+    """
+    chunk_size = settings.REMINDER_CHUNK_SIZE
+    window = ReminderLedger.window_for(window_hours)
+    queryset = ReminderLedger.objects.pending(queryset, kind, window)
+    total = 0
+    started = chunk_started = time.monotonic()
+
+    for number, chunk in enumerate(iter_chunks(queryset, chunk_size, ('user_id', 'id')), 1):
+        # El tiempo del bloque incluye su lectura, que ocurre en iter_chunks
+        with transaction.atomic():
+            claimed = ReminderLedger.objects.claim(kind, window, [reservation.id for reservation in chunk])
+            created = Notification.objects.bulk_create(
+                _digest_by_user(build_notification(reservation) for reservation in chunk if reservation.id in claimed),
+                batch_size=chunk_size
+            )
+        elapsed = time.monotonic() - chunk_started
+        total += len(created)
+        logger.info(
+            f"{label}: bloque {number} con {len(claimed)} reservas en {len(created)} notificaciones "
+            f"en {elapsed:.2f}s ({len(claimed) / max(elapsed, 1e-6):.0f} reservas/s)"
+        )
+        chunk_started = time.monotonic()
+
+    elapsed = time.monotonic() - started
+    logger.info(f"{label}: {total} notificaciones en {elapsed:.2f}s")
+    return total
+
+def _reservation_reminder(reservation):
+    return Notification(
+        user_id=reservation.user_id,
+        type='RESERVATION_REMINDER',
+        title='Recordatorio de Reserva',
+        message=(
+            f"¡Recordatorio!\n"
+            f"Tienes una reserva mañana:\n"
+            f"Cancha: {reservation.court}\n"
+            f"Hora: {reservation.start_time} - {reservation.end_time}\n"
+            f"¡Te esperamos!"
+        )
+    )
+
+def _payment_reminder(reservation):
+    return Notification(
+        user_id=reservation.user_id,
+        type='PAYMENT_REMINDER',
+        title='Pago Pendiente',
+        message=(
+            f"Recordatorio de pago pendiente:\n"
+            f"Reserva: {reservation.court}\n"
+            f"Fecha: {reservation.date}\n"
+            f"Hora: {reservation.start_time} - {reservation.end_time}\n"
+            f"Por favor, realiza el pago para confirmar tu reserva."
+        )
+    )
+
 @shared_task
 def send_reservation_reminders():
     """Envía recordatorios para reservas próximas"""
@@ -29,25 +179,12 @@ def send_reservation_reminders():
     reservations = Reservation.objects.filter(
         date=tomorrow,
         status='CONFIRMED'
+    ).select_related('court')
+
+    return _send_reminders(
+        reservations, _reservation_reminder, 'Recordatorios de reserva',
+        'RESERVATION', settings.RESERVATION_REMINDER_WINDOW_HOURS
     )
-    
-    notification_service = NotificationService()
-    
-    for reservation in reservations:
-        message = (
-            f"¡Recordatorio!\n"
-            f"Tienes una reserva mañana:\n"
-            f"Cancha: {reservation.court}\n"
-            f"Hora: {reservation.start_time} - {reservation.end_time}\n"
-            f"¡Te esperamos!"
-        )
-        
-        notification_service.create_notification(
-            user=reservation.user,
-            type='RESERVATION_REMINDER',
-            title='Recordatorio de Reserva',
-            message=message
-        )
 
 @shared_task
 def send_payment_reminder():
@@ -56,22 +193,22 @@ def send_payment_reminder():
     reservations = Reservation.objects.filter(
         status='PENDING',
         date__gt=timezone.now().date()
+    ).select_related('court')
+
+    return _send_reminders(
+        reservations, _payment_reminder, 'Recordatorios de pago',
+        'PAYMENT', settings.PAYMENT_REMINDER_WINDOW_HOURS
     )
-    
-    notification_service = NotificationService()
-    
-    for reservation in reservations:
-        message = (
-            f"Recordatorio de pago pendiente:\n"
-            f"Reserva: {reservation.court}\n"
-            f"Fecha: {reservation.date}\n"
-            f"Hora: {reservation.start_time} - {reservation.end_time}\n"
-            f"Por favor, realiza el pago para confirmar tu reserva."
-        )
-        
-        notification_service.create_notification(
-            user=reservation.user,
-            type='PAYMENT_REMINDER',
-            title='Pago Pendiente',
-            message=message
-        )
\ No newline at end of file
+
+@shared_task
+def prune_notifications():
+    """Aplica la retención de notificaciones, bandeja de salida, archivo y registro de recordatorios"""
+    totals = retention.prune_notifications()
+    outbox = retention.prune_outbox()
+    archive = retention.prune_archive()
+    ledger = retention.prune_reminder_ledger()
+    logger.info(
+        f"Retención: notificaciones {totals}, bandeja {outbox}, archivo {archive}, "
+        f"registro de recordatorios {ledger}"
+    )
+    return {'notifications': totals, 'outbox': outbox, 'archive': archive, 'reminder_ledger': ledger}
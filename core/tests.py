@@ -1,3 +1,1977 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import io
+import json
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, time as dt_time, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command, load_command_class
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.test import APIRequestFactory
+
+from . import availability, catalog, retention, services
+from .availability import DayOccupancy, iter_bits, run_starts, span_mask, time_to_cell
+from .catalog import court_catalog
+from .events import AvailabilityBroadcaster, changed_ranges, day_state
+from .exceptions import PaymentError, SlotHoldError, StatementError
+from .inbox import unread_count
+from .reconciliation import (
+    PaymentIndex, StatementLine, apply_matches, iter_csv, iter_ofx, iter_statement, parse_amount, reconcile
+)
+from .models import (
+    Court, CourtSlotGrid, Notification, NotificationArchive, NotificationOutbox, Payment, ReminderLedger,
+    Reservation, StripeEvent, UserProfile
+)
+from .serializers import ReservationSerializer
+from .services import (
+    NotificationOutboxService, NotificationService, PaymentNotificationService, PaymentService,
+    SlotHoldService, StripeEventService, WhatsAppRateLimiter, WhatsAppService, digest_notifications
+)
+from .tasks import (
+    iter_chunks, notify_admins_pending_payment, send_payment_reminder, send_reservation_reminders
+)
+from .views import MobilePaymentView, ProcessPaymentView, generate_available_slots
+
+
+class ArenaTestCase(TestCase):
+    """
+    Base de las pruebas con base de datos. Las escrituras de los helpers
+    ejecutan sus callbacks on_commit (catálogo de canchas, caché de
+    disponibilidad), que en TestCase nunca llegan a correr.
+    """
+
+    def setUp(self):
+        super().setUp()
+        court_catalog.invalidate()
+        self.addCleanup(court_catalog.invalidate)
+        # Sin broker en las pruebas: las tareas que se encolan tras el commit no
+        # se envían (las que interesan se parchean en cada prueba)
+        broker = mock.patch('celery.app.task.Task.apply_async')
+        broker.start()
+        self.addCleanup(broker.stop)
+        self.user = User.objects.create_user('jugador', 'jugador@example.com')
+        # Un martes lejos de hoy: siempre futuro y siempre el mismo día de la semana
+        self.day = timezone.localdate() + timedelta(days=14)
+        self.day += timedelta(days=(1 - self.day.weekday()) % 7)
+
+    def create_court(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Court.objects.create(**{
+                'name': 'Cancha 1', 'price_per_hour': Decimal('20.00'),
+                'opening_time': dt_time(8), 'closing_time': dt_time(22), **fields
+            })
+
+    def book(self, court, start, end, day=None, user=None, status='PENDING'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Reservation.objects.create(
+                user=user or self.user, court=court, date=day or self.day,
+                start_time=start, end_time=end, status=status, total_amount=court.price_per_hour
+            )
+
+
+class StubServer:
+    """
+    Stub (manage.py stripe_stub / whatsapp_stub) en un hilo y en un puerto
+    libre; stop() lo detiene y cierra su socket.
+    """
+
+    def __init__(self, command, **options):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        self.command = load_command_class('core', command)
+        self.thread = threading.Thread(
+            target=call_command, args=(self.command,), daemon=True,
+            kwargs={'port': port, 'jitter_ms': 0, 'stdout': io.StringIO(), **options}
+        )
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def stop(self):
+        self.command.server.shutdown()
+        self.thread.join(timeout=5)
+
+
+def start_stub(test_class, command, **options):
+    """Arranca un stub que se detiene al terminar las pruebas de la clase"""
+    stub = StubServer(command, **options)
+    test_class.addClassCleanup(stub.stop)
+    return stub.url
+
+
+class StripeStubMixin:
+    """PaymentService contra manage.py stripe_stub; el cliente compartido se crea por prueba"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub_url = start_stub(cls, 'stripe_stub', latency_ms=0)
+        cls.failing_stub_url = start_stub(cls, 'stripe_stub', latency_ms=0, error_rate=1.0)
+        cls.slow_stub_url = start_stub(cls, 'stripe_stub', latency_ms=1000)
+
+    def setUp(self):
+        super().setUp()
+        self.reset_client()
+        self.addCleanup(self.reset_client)
+
+    @staticmethod
+    def reset_client():
+        services._stripe_client = None
+
+    def stripe_settings(self, url, **overrides):
+        return override_settings(
+            STRIPE_API_BASE=url, STRIPE_SECRET_KEY='sk_test_stub',
+            STRIPE_MAX_NETWORK_RETRIES=0, **overrides
+        )
+
+    def create_intent(self, reservation):
+        intent = PaymentService().create_payment_intent(reservation)
+        self.addCleanup(cache.delete, PaymentService.INTENT_CACHE_KEY.format(intent.id))
+        return intent
+
+
+class StripeClientTestCase(StripeStubMixin, SimpleTestCase):
+    # create_payment_intent solo lee el importe y el id de la reserva
+    reservation = Reservation(id=1, total_amount=Decimal('20.00'))
+
+    def test_create_payment_intent_caches_client_secret_and_status(self):
+        with self.stripe_settings(self.stub_url):
+            intent = self.create_intent(self.reservation)
+
+        self.assertEqual(intent.amount, 2000)
+        self.assertEqual(
+            cache.get(PaymentService.INTENT_CACHE_KEY.format(intent.id)),
+            {'client_secret': intent.client_secret, 'status': 'requires_payment_method'}
+        )
+
+    def test_api_errors_raise_payment_error(self):
+        with self.stripe_settings(self.failing_stub_url):
+            with self.assertRaises(PaymentError):
+                PaymentService().create_payment_intent(self.reservation)
+
+    def test_timeout_raises_payment_error(self):
+        with self.stripe_settings(self.slow_stub_url, STRIPE_READ_TIMEOUT=0.2):
+            started = time.monotonic()
+            with self.assertRaises(PaymentError):
+                PaymentService().create_payment_intent(self.reservation)
+
+        self.assertLess(time.monotonic() - started, 0.9)
+
+
+class ProcessPaymentViewTestCase(StripeStubMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('jugador')
+        court = Court.objects.create(name='Cancha 1', price_per_hour=Decimal('20.00'))
+        self.reservation = Reservation.objects.create(
+            user=user, court=court, date=timezone.now().date() + timedelta(days=1),
+            start_time=dt_time(10), end_time=dt_time(11), total_amount=Decimal('20.00')
+        )
+
+    def process_payment(self, payment_intent_id):
+        request = APIRequestFactory().get(f'/payments/process/{payment_intent_id}/')
+        return ProcessPaymentView.as_view()(request, payment_intent_id=payment_intent_id)
+
+    def create_payment(self, intent):
+        return Payment.objects.create(
+            reservation=self.reservation, amount=self.reservation.total_amount,
+            payment_type='CARD', stripe_payment_intent_id=intent.id
+        )
+
+    def test_renders_from_cache(self):
+        with self.stripe_settings(self.stub_url):
+            intent = self.create_intent(self.reservation)
+            self.create_payment(intent)
+            client = services.get_stripe_client()
+            with mock.patch.object(client.payment_intents, 'retrieve') as retrieve:
+                response = self.process_payment(intent.id)
+
+        retrieve.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['payment']['client_secret'], intent.client_secret)
+        self.assertEqual(response.data['payment']['status'], 'requires_payment_method')
+
+    def test_fetches_missing_intent_once(self):
+        with self.stripe_settings(self.stub_url):
+            intent = self.create_intent(self.reservation)
+            cache.delete(PaymentService.INTENT_CACHE_KEY.format(intent.id))
+            self.create_payment(intent)
+            client = services.get_stripe_client()
+            with mock.patch.object(
+                client.payment_intents, 'retrieve', wraps=client.payment_intents.retrieve
+            ) as retrieve:
+                first = self.process_payment(intent.id)
+                second = self.process_payment(intent.id)
+
+        self.assertEqual(retrieve.call_count, 1)
+        self.assertEqual(first.data['payment']['client_secret'], intent.client_secret)
+        self.assertEqual(second.data['payment'], first.data['payment'])
+
+
+class WhatsAppStubTestCase(SimpleTestCase):
+    """WhatsAppService contra manage.py whatsapp_stub"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub_url = start_stub(cls, 'whatsapp_stub', latency_ms=200)
+        cls.failing_stub_url = start_stub(cls, 'whatsapp_stub', latency_ms=0, error_rate=1.0)
+        cls.slow_stub_url = start_stub(cls, 'whatsapp_stub', latency_ms=1000)
+
+    def whatsapp_settings(self, url, **overrides):
+        # Backoff mínimo y buckets holgados para que el limitador no intervenga
+        return override_settings(**{
+            'WHATSAPP_API_URL': f'{url}/v17.0', 'WHATSAPP_ACCESS_TOKEN': 'token',
+            'WHATSAPP_PHONE_NUMBER_ID': '1000', 'WHATSAPP_MAX_RETRIES': 2,
+            'WHATSAPP_BACKOFF_BASE': 0.01, 'WHATSAPP_BACKOFF_MAX': 0.01,
+            'WHATSAPP_NUMBER_BURST': 1000, 'WHATSAPP_DESTINATION_BURST': 1000,
+            **overrides
+        })
+
+    @staticmethod
+    def phone():
+        return f'58414{uuid.uuid4().int % 10 ** 7:07d}'
+
+    def test_retries_stop_after_max_retries(self):
+        with self.whatsapp_settings(self.failing_stub_url):
+            service = WhatsAppService()
+            with mock.patch.object(service.session, 'post', wraps=service.session.post) as post:
+                ok, body = service.send_message(self.phone(), 'Hola')
+
+        self.assertFalse(ok)
+        self.assertEqual(post.call_count, 3)
+        self.assertIn('error', body)
+
+    def test_success_is_not_retried(self):
+        with self.whatsapp_settings(self.stub_url):
+            service = WhatsAppService()
+            phone = self.phone()
+            with mock.patch.object(service.session, 'post', wraps=service.session.post) as post:
+                ok, body = service.send_message(phone, 'Hola')
+
+        self.assertTrue(ok)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(body['contacts'][0]['input'], phone)
+
+    def test_read_timeout_is_honoured_and_not_retried(self):
+        with self.whatsapp_settings(self.slow_stub_url, WHATSAPP_READ_TIMEOUT=0.2):
+            service = WhatsAppService()
+            started = time.monotonic()
+            with mock.patch.object(service.session, 'post', wraps=service.session.post) as post:
+                ok, error = service.send_message(self.phone(), 'Hola')
+
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertFalse(ok)
+        self.assertIn('timed out', error)
+        # El mensaje pudo haberse aceptado: reintentar lo enviaría dos veces
+        self.assertEqual(post.call_count, 1)
+
+    def test_send_messages_keeps_order_with_limited_concurrency(self):
+        with self.whatsapp_settings(self.stub_url, WHATSAPP_CONCURRENCY=2):
+            service = WhatsAppService()
+            post = service.session.post
+            lock = threading.Lock()
+            in_flight = [0, 0]  # actuales, máximo
+
+            def tracked_post(*args, **kwargs):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                try:
+                    return post(*args, **kwargs)
+                finally:
+                    with lock:
+                        in_flight[0] -= 1
+
+            phones = [self.phone() for _ in range(6)]
+            started = time.monotonic()
+            with mock.patch.object(service.session, 'post', side_effect=tracked_post):
+                results = service.send_messages((phone, f'Mensaje {i}') for i, phone in enumerate(phones))
+            elapsed = time.monotonic() - started
+
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual([body['contacts'][0]['input'] for _, body in results], phones)
+        self.assertEqual(in_flight[1], 2)
+        # 6 mensajes de 200ms de dos en dos: al menos tres rondas
+        self.assertGreaterEqual(elapsed, 0.55)
+
+
+class OccupancyBitmapTests(SimpleTestCase):
+    def test_run_starts_marks_cells_followed_by_enough_free_cells(self):
+        free = 0b11110111
+        self.assertEqual(list(iter_bits(run_starts(free, 3))), [0, 4, 5])
+        self.assertEqual(run_starts(free, 1), free)
+        self.assertEqual(run_starts(free, 5), 0)
+
+    def test_conflicts_use_half_open_ranges_rounded_to_cells(self):
+        day = DayOccupancy()
+        day.add(dt_time(10), dt_time(11))
+        self.assertTrue(day.conflicts(dt_time(10, 45), dt_time(11, 15)))
+        self.assertTrue(day.conflicts(dt_time(9, 50), dt_time(10, 5)))
+        self.assertFalse(day.conflicts(dt_time(11), dt_time(12)))
+        self.assertFalse(day.conflicts(dt_time(9), dt_time(10)))
+
+    def test_free_slots_skip_booked_cells_inside_opening_hours(self):
+        day = DayOccupancy()
+        day.add(dt_time(10), dt_time(11))
+        slots = day.free_slots(dt_time(8), dt_time(12))
+        self.assertEqual(slots, [(32, 36), (36, 40), (44, 48)])
+        # Slots de 90 minutos cada 30: ninguno puede cruzar 10:00-11:00
+        slots = day.free_slots(dt_time(8), dt_time(12), slot_minutes=90, step_minutes=30)
+        self.assertEqual([start for start, _ in slots], [time_to_cell(dt_time(8)), time_to_cell(dt_time(8, 30))])
+
+    def test_generate_available_slots_flags_each_hour(self):
+        court = Court(opening_time=dt_time(8), closing_time=dt_time(12))
+        day = DayOccupancy()
+        day.add(dt_time(10, 30), dt_time(11))
+        slots = generate_available_slots(court, day)
+        self.assertEqual(
+            [(slot['time'], slot['available']) for slot in slots],
+            [('08:00', True), ('09:00', True), ('10:00', False), ('11:00', True)]
+        )
+
+
+class CourtAvailabilityEndpointTests(ArenaTestCase):
+    def test_booked_hours_are_not_available(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(12))
+        self.book(court, dt_time(9), dt_time(10))
+        self.book(court, dt_time(11), dt_time(12), status='CANCELLED')
+
+        response = self.client.get(f'/api/courts/{court.id}/availability/', {'date': self.day.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [slot['available'] for slot in response.json()],
+            [True, False, True, True]
+        )
+
+    def test_span_query_reports_conflict(self):
+        court = self.create_court()
+        self.book(court, dt_time(18), dt_time(19, 30))
+
+        url = f'/api/courts/{court.id}/availability/'
+        busy = self.client.get(url, {'date': self.day.isoformat(), 'start_time': '19:00', 'end_time': '20:00'})
+        free = self.client.get(url, {'date': self.day.isoformat(), 'start_time': '19:30', 'end_time': '20:30'})
+        self.assertFalse(busy.json()['available'])
+        self.assertTrue(free.json()['available'])
+
+
+class AvailabilityMatrixTests(ArenaTestCase):
+    def test_matrix_encodes_free_cells_per_court_and_day(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(10), available_days='2')
+        other = self.create_court(name='Cancha 2', opening_time=dt_time(9), closing_time=dt_time(10))
+        self.book(court, dt_time(8, 30), dt_time(9))
+
+        response = self.client.get('/api/courts/availability/matrix/', {
+            'courts': f'{court.id},{other.id}', 'start': self.day.isoformat(), 'days': 2
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['cell_minutes'], 15)
+        days = {row['id']: row['days'] for row in data['courts']}
+        # Martes: 8:30-9:00 ocupado; miércoles la primera cancha no abre
+        self.assertEqual(days[court.id], ['11001111', None])
+        self.assertEqual(days[other.id], ['1111', '1111'])
+
+    def test_days_out_of_range_are_rejected(self):
+        for days in (0, 32, 'x'):
+            response = self.client.get('/api/courts/availability/matrix/', {'days': days})
+            self.assertEqual(response.status_code, 400)
+
+
+
+class OccupancyCacheTests(ArenaTestCase):
+    def test_second_read_is_served_from_redis(self):
+        court = self.create_court()
+        self.book(court, dt_time(10), dt_time(11))
+        pair = (court.id, self.day)
+
+        before = availability.cache_stats()
+        first = availability.load_occupancy([pair])
+        with self.assertNumQueries(0):
+            second = availability.load_occupancy([pair])
+        after = availability.cache_stats()
+
+        self.assertEqual(first[pair].mask, second[pair].mask)
+        self.assertTrue(second[pair].conflicts(dt_time(10), dt_time(11)))
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_committed_booking_invalidates_the_day(self):
+        court = self.create_court()
+        self.assertFalse(availability.day_occupancy(court.id, self.day).conflicts(dt_time(10), dt_time(11)))
+
+        reservation = self.book(court, dt_time(10), dt_time(11))
+        self.assertTrue(availability.day_occupancy(court.id, self.day).conflicts(dt_time(10), dt_time(11)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.status = 'CANCELLED'
+            reservation.save(update_fields=['status'])
+        self.assertFalse(availability.day_occupancy(court.id, self.day).conflicts(dt_time(10), dt_time(11)))
+
+    def test_schedule_change_bumps_the_court_version(self):
+        court = self.create_court()
+        pair = (court.id, self.day)
+        court_version, _ = availability.day_versions([pair])[pair]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            court.closing_time = dt_time(20)
+            court.save()
+        self.assertGreater(availability.day_versions([pair])[pair][0], court_version)
+
+    def test_failed_bump_schedules_a_retry(self):
+        court = self.create_court()
+        with mock.patch.object(availability, 'bump_version', side_effect=ConnectionError('redis caído')), \
+                mock.patch('core.tasks.retry_availability_invalidation.delay') as retry:
+            self.book(court, dt_time(10), dt_time(11))
+        retry.assert_called_once_with(availability._day_version_key(court.id, self.day))
+
+
+class ReservationOverlapTests(ArenaTestCase):
+    def test_overlapping_booking_is_rejected(self):
+        court = self.create_court()
+        self.book(court, dt_time(10), dt_time(11, 30))
+
+        with self.assertRaisesMessage(ValidationError, 'Ya existe una reserva para este horario'):
+            self.book(court, dt_time(11), dt_time(12))
+        # La transacción sigue usable y la reserva original intacta
+        self.assertEqual(Reservation.objects.filter(court=court).count(), 1)
+
+    def test_adjacent_cancelled_and_other_court_bookings_are_allowed(self):
+        court = self.create_court()
+        other = self.create_court(name='Cancha 2')
+        self.book(court, dt_time(10), dt_time(11))
+
+        self.book(court, dt_time(11), dt_time(12))
+        self.book(court, dt_time(9), dt_time(10))
+        self.book(court, dt_time(10), dt_time(11), status='CANCELLED')
+        self.book(other, dt_time(10), dt_time(11))
+        self.book(court, dt_time(10), dt_time(11), day=self.day + timedelta(days=1))
+
+    def test_reactivating_into_an_occupied_slot_is_rejected(self):
+        court = self.create_court()
+        cancelled = self.book(court, dt_time(10), dt_time(11), status='CANCELLED')
+        self.book(court, dt_time(10, 30), dt_time(11, 30))
+
+        cancelled.status = 'PENDING'
+        with self.assertRaises(ValidationError):
+            cancelled.save(update_fields=['status'])
+
+    def test_status_only_update_skips_clean(self):
+        court = self.create_court()
+        reservation = self.book(court, dt_time(10), dt_time(11))
+        # Una reserva ya pasada debe poder confirmarse o cancelarse
+        Reservation.objects.filter(pk=reservation.pk).update(date=timezone.localdate() - timedelta(days=1))
+        reservation.refresh_from_db()
+
+        reservation.status = 'CONFIRMED'
+        with mock.patch.object(Reservation, 'clean') as clean:
+            reservation.save(update_fields=['status'])
+        clean.assert_not_called()
+        self.assertEqual(Reservation.objects.get(pk=reservation.pk).status, 'CONFIRMED')
+
+        with self.assertRaisesMessage(ValidationError, 'fechas pasadas'):
+            reservation.save(update_fields=['start_time'])
+
+    def test_rescheduling_updates_the_time_range(self):
+        court = self.create_court()
+        reservation = self.book(court, dt_time(10), dt_time(11))
+
+        reservation.start_time, reservation.end_time = dt_time(15), dt_time(16)
+        reservation.save(update_fields=['start_time', 'end_time'])
+        self.book(court, dt_time(10), dt_time(11))
+        with self.assertRaises(ValidationError):
+            self.book(court, dt_time(15, 30), dt_time(16, 30))
+
+
+class ReservationOverlapRaceTests(TransactionTestCase):
+    def test_only_one_concurrent_booking_wins(self):
+        court_catalog.invalidate()
+        self.addCleanup(court_catalog.invalidate)
+        court = Court.objects.create(
+            name='Cancha 1', price_per_hour=Decimal('20.00'),
+            opening_time=dt_time(8), closing_time=dt_time(22)
+        )
+        users = [User.objects.create_user(f'jugador{i}') for i in range(4)]
+        day = timezone.localdate() + timedelta(days=7)
+        barrier = threading.Barrier(len(users))
+        results = []
+
+        def book(user):
+            try:
+                barrier.wait()
+                Reservation.objects.create(
+                    user=user, court=court, date=day, start_time=dt_time(18), end_time=dt_time(19, 30),
+                    total_amount=Decimal('30.00')
+                )
+                results.append('ok')
+            except ValidationError:
+                results.append('conflict')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), ['conflict'] * 3 + ['ok'])
+        self.assertEqual(Reservation.objects.filter(court=court).count(), 1)
+
+
+class SlotHoldTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.court = self.create_court()
+        self.rival = User.objects.create_user('rival', 'rival@example.com')
+        self.holds = SlotHoldService()
+
+    def test_overlapping_hold_of_another_user_is_rejected(self):
+        token, _ = self.holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+
+        with self.assertRaisesMessage(SlotHoldError, 'temporalmente reservado'):
+            self.holds.acquire(self.court.id, self.day, dt_time(10, 30), dt_time(11, 30), self.rival.id)
+        self.holds.acquire(self.court.id, self.day, dt_time(11), dt_time(12), self.rival.id)
+
+        self.assertEqual(self.holds.check(self.court.id, self.day, dt_time(10), dt_time(11), token), 1)
+        self.assertEqual(self.holds.check(self.court.id, self.day, dt_time(10), dt_time(11)), -1)
+        self.assertTrue(self.holds.release(token))
+        self.assertEqual(self.holds.check(self.court.id, self.day, dt_time(10), dt_time(11)), 0)
+
+    def test_only_one_concurrent_hold_wins(self):
+        users = [User.objects.create_user(f'jugador{i}') for i in range(6)]
+        barrier = threading.Barrier(len(users))
+        results = []
+
+        def acquire(user):
+            holds = SlotHoldService()
+            barrier.wait()
+            try:
+                holds.acquire(self.court.id, self.day, dt_time(18), dt_time(19), user.id)
+                results.append('ok')
+            except SlotHoldError:
+                results.append('conflict')
+
+        threads = [threading.Thread(target=acquire, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['conflict'] * 5 + ['ok'])
+
+    @override_settings(SLOT_HOLD_MAX_PER_USER=2)
+    def test_holds_per_user_are_capped(self):
+        holds = SlotHoldService()
+        holds.acquire(self.court.id, self.day, dt_time(8), dt_time(9), self.user.id)
+        token, _ = holds.acquire(self.court.id, self.day, dt_time(9), dt_time(10), self.user.id)
+
+        with self.assertRaisesMessage(SlotHoldError, 'Ya tienes 2 reservas temporales'):
+            holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+        # Renovar un token propio no cuenta como una retención más
+        holds.acquire(self.court.id, self.day, dt_time(9), dt_time(10, 30), self.user.id, token=token)
+        holds.release(token)
+        holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+
+    def test_availability_hides_held_cells_except_for_the_owner(self):
+        token, _ = self.holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+        url = f'/api/courts/{self.court.id}/availability/'
+        params = {'date': self.day.isoformat(), 'start_time': '10:00', 'end_time': '11:00'}
+
+        self.assertFalse(self.client.get(url, params).json()['available'])
+        self.assertTrue(self.client.get(url, {**params, 'hold': token}).json()['available'])
+
+    def test_reservation_is_rejected_on_a_slot_held_by_another_user(self):
+        rival_token, _ = self.holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.rival.id)
+        data = {
+            'user': self.user.id, 'court': self.court.id, 'date': self.day.isoformat(),
+            'start_time': '10:00', 'end_time': '11:00', 'total_amount': '20.00'
+        }
+
+        serializer = ReservationSerializer(data={**data, 'hold_token': rival_token})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.assertRaises(serializers.ValidationError):
+            serializer.save()
+
+        self.holds.release(rival_token)
+        token, _ = self.holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+        serializer = ReservationSerializer(data={**data, 'hold_token': token})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            serializer.save()
+        # La retención se consume al crear la reserva
+        self.assertEqual(self.holds.check(self.court.id, self.day, dt_time(10), dt_time(11)), 0)
+
+    def test_hold_endpoint_validates_the_span(self):
+        self.client.force_login(self.user)
+        payload = {'court': self.court.id, 'date': self.day.isoformat()}
+
+        response = self.client.post('/api/holds/', {**payload, 'start_time': '10:00', 'end_time': '11:00'})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['token'].startswith(f'{self.court.id}.{self.day}.{self.user.id}.'))
+        for start, end in (('11:00', '10:00'), ('21:00', '23:00'), ('08:00', '12:00'), ('10', '11')):
+            response = self.client.post('/api/holds/', {**payload, 'start_time': start, 'end_time': end})
+            self.assertEqual(response.status_code, 400, (start, end))
+
+        self.client.force_login(self.rival)
+        response = self.client.post('/api/holds/', {**payload, 'start_time': '10:30', 'end_time': '11:30'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_only_the_owner_releases_a_hold(self):
+        token, _ = self.holds.acquire(self.court.id, self.day, dt_time(10), dt_time(11), self.user.id)
+
+        self.client.force_login(self.rival)
+        self.assertEqual(self.client.delete(f'/api/holds/{token}/').status_code, 404)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.delete(f'/api/holds/{token}/').status_code, 204)
+        self.assertEqual(self.holds.check(self.court.id, self.day, dt_time(10), dt_time(11)), 0)
+
+
+class ReservationSeriesTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.court = self.create_court()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        self.client.force_login(self.admin)
+        self.book(self.court, dt_time(18, 30), dt_time(19, 30), day=self.day + timedelta(weeks=1))
+
+    def post_series(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/reservations/series/', {
+                'court': self.court.id, 'user': self.user.id, 'start_date': self.day.isoformat(),
+                'start_time': '18:00', 'end_time': '19:00', 'occurrences': 4, **fields
+            })
+
+    def test_conflict_aborts_the_whole_series(self):
+        response = self.post_series()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['created'], [])
+        self.assertEqual(response.json()['conflicts'], [{
+            'date': (self.day + timedelta(weeks=1)).isoformat(),
+            'reason': 'Ya existe una reserva para este horario'
+        }])
+        self.assertFalse(Reservation.objects.filter(series_id__isnull=False).exists())
+
+    def test_skip_conflicts_books_the_free_dates_with_one_notification(self):
+        response = self.post_series(skip_conflicts=True)
+
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(
+            [item['date'] for item in body['created']],
+            [(self.day + timedelta(weeks=week)).isoformat() for week in (0, 2, 3)]
+        )
+        self.assertEqual(len(body['conflicts']), 1)
+        series = Reservation.objects.filter(series_id=body['series_id'])
+        self.assertEqual(series.count(), 3)
+        self.assertEqual({r.total_amount for r in series}, {Decimal('20.00')})
+        self.assertEqual(NotificationOutbox.objects.filter(user=self.user).count(), 1)
+        # bulk_create no dispara señales: la ocupación se actualiza a mano
+        self.assertTrue(availability.day_occupancy(self.court.id, self.day).conflicts(dt_time(18), dt_time(19)))
+
+    def test_interval_and_closed_days(self):
+        self.court.available_days = '2'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.court.save()
+        response = self.post_series(start_date=(self.day + timedelta(days=1)).isoformat(), occurrences=1)
+        self.assertEqual(response.json()['conflicts'][0]['reason'], 'La cancha no está disponible este día')
+
+        response = self.post_series(occurrences=2, interval_weeks=2)
+        self.assertEqual(
+            [item['date'] for item in response.json()['created']],
+            [self.day.isoformat(), (self.day + timedelta(weeks=2)).isoformat()]
+        )
+
+    def test_only_admins_create_series(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.post_series().status_code, 403)
+
+
+class NextAvailableSlotsTests(ArenaTestCase):
+    def test_returns_earliest_slots_across_courts(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(12))
+        other = self.create_court(name='Cancha 2', opening_time=dt_time(10), closing_time=dt_time(12))
+        self.book(court, dt_time(8), dt_time(10, 30))
+
+        response = self.client.get('/api/courts/next-available/', {
+            'from': self.day.isoformat(), 'duration': 60, 'limit': 3
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(slot['court_id'], slot['start_time'], slot['end_time']) for slot in response.json()['slots']],
+            [(other.id, '10:00', '11:00'), (court.id, '10:30', '11:30'), (other.id, '10:30', '11:30')]
+        )
+
+    def test_after_and_closed_days_are_respected(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(12), available_days='3')
+
+        response = self.client.get('/api/courts/next-available/', {
+            'from': self.day.isoformat(), 'days': 2, 'duration': 90, 'after': '10:15', 'courts': court.id
+        })
+        slots = response.json()['slots']
+        # El martes no abre; el miércoles el único inicio de 90 minutos tras 10:15 es 10:30
+        self.assertEqual(len(slots), 1)
+        self.assertEqual(slots[0]['date'], (self.day + timedelta(days=1)).isoformat())
+        self.assertEqual((slots[0]['start_time'], slots[0]['end_time']), ('10:30', '12:00'))
+
+    def test_invalid_duration_is_rejected(self):
+        response = self.client.get('/api/courts/next-available/', {'duration': 5})
+        self.assertEqual(response.status_code, 400)
+
+
+class AvailabilityEventsTests(ArenaTestCase):
+    def test_changed_ranges_merges_adjacent_cells(self):
+        # Desde las 08:00: se ocupa 08:15-08:45 y se libera 09:00-09:15
+        self.assertEqual(
+            changed_ranges(32, '11110', '10011'),
+            [['08:15', '08:45'], ['09:00', '09:15']]
+        )
+        self.assertEqual(changed_ranges(32, '1111', '1111'), [])
+        self.assertIsNone(changed_ranges(32, None, '1111'))
+        self.assertIsNone(changed_ranges(32, '111', '1111'))
+
+    def test_day_state_encodes_the_opening_hours(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(9), available_days='2')
+        self.book(court, dt_time(8, 30), dt_time(9))
+
+        self.assertEqual(day_state(court.id, self.day), {
+            'court': court.id, 'date': str(self.day), 'free': '1100', 'first_cell': 32
+        })
+        self.assertIsNone(day_state(court.id, self.day + timedelta(days=1))['free'])
+
+    def test_changes_are_published_after_commit_only(self):
+        court = self.create_court()
+        with mock.patch('core.signals.publish_availability_changes') as publish:
+            reservation = self.book(court, dt_time(10), dt_time(11))
+            publish.assert_called_once_with({(court.id, self.day)})
+
+            publish.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    Reservation.objects.create(
+                        user=self.user, court=court, date=self.day, start_time=dt_time(12),
+                        end_time=dt_time(13), total_amount=Decimal('20.00')
+                    )
+                    raise RuntimeError
+            publish.assert_not_called()
+
+            reservation.date = self.day + timedelta(days=1)
+            with self.captureOnCommitCallbacks(execute=True):
+                reservation.save()
+            publish.assert_called_once_with({(court.id, self.day), (court.id, reservation.date)})
+
+    def test_dispatch_sends_only_real_changes(self):
+        court = self.create_court(opening_time=dt_time(8), closing_time=dt_time(10))
+        pair = (court.id, self.day)
+        broadcaster = AvailabilityBroadcaster()
+        queue = mock.Mock(**{'full.return_value': False})
+        broadcaster.subscribers[pair].add(queue)
+        async_to_sync(broadcaster.snapshot)(pair)
+
+        self.book(court, dt_time(9), dt_time(9, 30))
+        async_to_sync(broadcaster._dispatch)(pair)
+        async_to_sync(broadcaster._dispatch)(pair)
+
+        queue.put_nowait.assert_called_once()
+        state = queue.put_nowait.call_args.args[0]
+        self.assertEqual(state['free'], '11110011')
+        self.assertEqual(state['changed'], [['09:00', '09:30']])
+
+    def test_stream_requires_asgi(self):
+        response = self.client.get('/api/courts/availability/stream/', {'subscribe': f'1:{self.day}'})
+        self.assertEqual(response.status_code, 501)
+
+
+class CourtSlotGridTests(ArenaTestCase):
+    def grid_mask(self, court, day=None):
+        return CourtSlotGrid.objects.get(court=court, date=day or self.day).mask
+
+    def test_grid_follows_reservations_in_the_same_transaction(self):
+        court = self.create_court()
+        first = self.book(court, dt_time(10), dt_time(11))
+        second = self.book(court, dt_time(11, 10), dt_time(12))
+        self.assertEqual(self.grid_mask(court), span_mask(dt_time(10), dt_time(12)))
+
+        # 11:10 no está alineado a celdas: liberar recalcula el día
+        second.status = 'CANCELLED'
+        second.save(update_fields=['status'])
+        self.assertEqual(self.grid_mask(court), span_mask(dt_time(10), dt_time(11)))
+
+        first.date = self.day + timedelta(days=1)
+        first.save()
+        self.assertEqual(self.grid_mask(court), 0)
+        self.assertEqual(self.grid_mask(court, first.date), span_mask(dt_time(10), dt_time(11)))
+
+        first.delete()
+        self.assertEqual(self.grid_mask(court, first.date), 0)
+
+    def test_load_materializes_missing_days_in_one_query(self):
+        court = self.create_court()
+        self.book(court, dt_time(10), dt_time(11))
+        CourtSlotGrid.objects.all().delete()
+        pairs = [(court.id, self.day), (court.id, self.day + timedelta(days=1))]
+
+        loaded = CourtSlotGrid.objects.load(pairs)
+        self.assertEqual(loaded[pairs[0]].mask, span_mask(dt_time(10), dt_time(11)))
+        self.assertEqual(loaded[pairs[1]].mask, 0)
+        self.assertEqual(CourtSlotGrid.objects.filter(court=court).count(), 2)
+        with self.assertNumQueries(1):
+            CourtSlotGrid.objects.load(pairs)
+
+    def test_rebuild_command_fixes_drifted_rows(self):
+        court = self.create_court()
+        self.book(court, dt_time(10), dt_time(11))
+        CourtSlotGrid.objects.filter(court=court).update(occupancy='f' * 24)
+        self.assertTrue(availability.day_occupancy(court.id, self.day).conflicts(dt_time(11), dt_time(12)))
+
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'rebuild_slot_grid', start=self.day.isoformat(),
+                end=(self.day + timedelta(days=1)).isoformat(), courts=[court.id], stdout=out
+            )
+        self.assertIn('1 fila(s) corregida(s)', out.getvalue())
+        self.assertEqual(self.grid_mask(court), span_mask(dt_time(10), dt_time(11)))
+        self.assertFalse(availability.day_occupancy(court.id, self.day).conflicts(dt_time(11), dt_time(12)))
+
+
+class CourtCatalogTests(ArenaTestCase):
+    def test_courts_are_served_from_memory(self):
+        court = self.create_court()
+        self.create_court(name='Cancha 2', is_active=False)
+        court_catalog.json()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(court_catalog.get(court.id).name, 'Cancha 1')
+            self.assertEqual([entry.id for entry in court_catalog.active()], [court.id])
+            response = self.client.get('/api/courts/')
+        self.assertEqual([item['name'] for item in response.json()], ['Cancha 1', 'Cancha 2'])
+
+    def test_saving_a_court_reloads_the_catalog(self):
+        court = self.create_court()
+        court_catalog.json()
+        with self.captureOnCommitCallbacks(execute=True):
+            court.name = 'Central'
+            court.save()
+        self.assertEqual(court_catalog.get(court.id).name, 'Central')
+
+    def test_other_workers_pick_up_the_new_version(self):
+        court = self.create_court()
+        version = court_catalog.version
+        # Otro proceso guarda la cancha: cambia la fila y sube la versión en Redis
+        Court.objects.filter(pk=court.pk).update(name='Central')
+        availability.bump_version(catalog.VERSION_KEY)
+
+        self.assertEqual(court_catalog.get(court.id).name, 'Cancha 1')
+        court_catalog._next_check = 0
+        self.assertEqual(court_catalog.get(court.id).name, 'Central')
+        self.assertGreater(court_catalog.version, version)
+
+    def test_redis_outage_keeps_the_loaded_catalog(self):
+        court = self.create_court()
+        court_catalog.json()
+        court_catalog._next_check = 0
+
+        with mock.patch.object(catalog, 'get_versions', side_effect=ConnectionError('redis caído')):
+            with self.assertNumQueries(0):
+                self.assertEqual(court_catalog.get(court.id).name, 'Cancha 1')
+            self.assertEqual(court_catalog._failures, 1)
+            # Con el catálogo demasiado viejo se recarga de la base de datos
+            court_catalog._next_check = 0
+            court_catalog._loaded_at -= catalog.MAX_STALE
+            with self.assertNumQueries(1):
+                court_catalog.get(court.id)
+
+    def test_is_available_uses_the_parsed_schedule(self):
+        court = self.create_court(available_days='2', opening_time=dt_time(8), closing_time=dt_time(12))
+        court = Court.objects.get(pk=court.pk)
+
+        self.assertEqual(court.is_available(self.day, dt_time(9)), (True, 'Disponible'))
+        self.assertFalse(court.is_available(self.day, dt_time(12))[0])
+        self.assertFalse(court.is_available(self.day + timedelta(days=1), dt_time(9))[0])
+        # Con cambios sin guardar manda la instancia, no el catálogo
+        court.available_days = '3'
+        self.assertTrue(court.is_available(self.day + timedelta(days=1), dt_time(9))[0])
+
+
+class ConditionalRequestTests(ArenaTestCase):
+    def test_courts_answer_304_on_matching_etag(self):
+        self.create_court()
+        response = self.client.get('/api/courts/')
+        etag = response['ETag']
+        self.assertIn('Accept', response['Vary'])
+        self.assertIn('max-age=60', response['Cache-Control'])
+
+        cached = self.client.get('/api/courts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], etag)
+
+        self.create_court(name='Cancha 2')
+        self.assertEqual(self.client.get('/api/courts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_if_modified_since_alone_never_answers_304(self):
+        self.create_court()
+        response = self.client.get('/api/courts/')
+        again = self.client.get('/api/courts/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(again.status_code, 200)
+
+    def test_availability_etag_follows_bookings_and_holds(self):
+        court = self.create_court()
+        url = f'/api/courts/{court.id}/availability/'
+        params = {'date': self.day.isoformat()}
+        etag = self.client.get(url, params)['ETag']
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.book(court, dt_time(10), dt_time(11))
+        booked = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(booked.status_code, 200)
+        self.assertTrue(booked.has_header('Last-Modified'))
+
+        SlotHoldService().acquire(court.id, self.day, dt_time(12), dt_time(13), self.user.id)
+        held = self.client.get(url, params, HTTP_IF_NONE_MATCH=booked['ETag'])
+        self.assertEqual(held.status_code, 200)
+        # Las retenciones caducan sin cambiar la versión: solo vale el ETag
+        self.assertFalse(held.has_header('Last-Modified'))
+
+
+class AdminPaymentNotificationTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.delete(PaymentNotificationService.STAFF_IDS_KEY)
+        self.admins = [User.objects.create_user(f'admin{i}', is_staff=True) for i in range(3)]
+        court = self.create_court()
+        self.reservation = self.book(court, dt_time(10), dt_time(11))
+
+    def create_payment(self):
+        return Payment.objects.create(
+            reservation=self.reservation, amount=Decimal('20.00'),
+            payment_type='PAGOMOVIL', status='PENDING_VALIDATION'
+        )
+
+    def test_fan_out_is_a_single_insert(self):
+        payment = self.create_payment()
+        PaymentNotificationService.staff_ids()
+
+        with self.assertNumQueries(2):
+            self.assertEqual(notify_admins_pending_payment(payment.id), 3)
+        self.assertEqual(
+            set(Notification.objects.filter(type='PAYMENT_PENDING').values_list('user_id', flat=True)),
+            {admin.id for admin in self.admins}
+        )
+        self.assertIsNone(notify_admins_pending_payment(0))
+
+    def test_staff_changes_invalidate_the_cached_ids(self):
+        self.assertEqual(PaymentNotificationService.staff_ids(), [admin.id for admin in self.admins])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        self.assertIn(self.user.id, PaymentNotificationService.staff_ids())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admins[0].delete()
+        self.assertNotIn(self.admins[0].id, PaymentNotificationService.staff_ids())
+
+    def post_mobile_payment(self):
+        request = APIRequestFactory().post('/payments/mobile/', {
+            'reservation': self.reservation.id, 'amount': '20.00', 'payment_type': 'PAGOMOVIL',
+            'bank_reference': '123456', 'reference_last_digits': '3456',
+            'phone_number': '04141234567', 'bank': 'BANCO1'
+        })
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = MobilePaymentView.as_view()(request)
+        return response, callbacks
+
+    def test_mobile_payment_notifies_admins_after_commit(self):
+        with mock.patch('core.views.notify_admins_pending_payment.delay') as delay:
+            response, callbacks = self.post_mobile_payment()
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertTrue(callbacks)
+        delay.assert_called_once_with(response.data['id'])
+
+    def test_broker_outage_does_not_fail_the_payment(self):
+        with mock.patch('core.views.notify_admins_pending_payment.delay', side_effect=ConnectionError('broker caído')), \
+                self.assertLogs('core.views', 'WARNING'):
+            response, _ = self.post_mobile_payment()
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(Payment.objects.get(pk=response.data['id']).status, 'PENDING_VALIDATION')
+
+
+class ReminderTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.court = self.create_court()
+        self.other = User.objects.create_user('otro')
+        self.tomorrow = timezone.localdate() + timedelta(days=1)
+
+    def test_iter_chunks_walks_the_keyset_in_order(self):
+        ids = [self.book(self.court, dt_time(hour), dt_time(hour + 1), user=user).id
+               for hour, user in zip(range(8, 13), [self.other, self.user, self.other, self.user, self.user])]
+        queryset = Reservation.objects.filter(id__in=ids)
+
+        chunks = list(iter_chunks(queryset, 2, ('user_id', 'id')))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(
+            [(r.user_id, r.id) for chunk in chunks for r in chunk],
+            sorted((r.user_id, r.id) for r in queryset)
+        )
+
+    @override_settings(REMINDER_CHUNK_SIZE=2)
+    def test_reservation_reminders_send_one_digest_per_user_and_chunk(self):
+        for hour in (10, 12):
+            self.book(self.court, dt_time(hour), dt_time(hour + 1), day=self.tomorrow, status='CONFIRMED')
+        self.book(self.court, dt_time(14), dt_time(15), day=self.tomorrow, user=self.other, status='CONFIRMED')
+        self.book(self.court, dt_time(16), dt_time(17), day=self.tomorrow, user=self.other)
+        self.book(self.court, dt_time(10), dt_time(11), status='CONFIRMED')
+
+        self.assertEqual(send_reservation_reminders(), 2)
+        mine = Notification.objects.get(user=self.user, type='RESERVATION_REMINDER')
+        self.assertEqual(mine.title, 'Recordatorio de Reserva (2)')
+        self.assertEqual(mine.message.count('Tienes una reserva mañana'), 2)
+        self.assertEqual(Notification.objects.filter(user=self.other).count(), 1)
+
+
+@override_settings(
+    NOTIFICATION_DIGEST_WINDOW=0, WHATSAPP_ACCESS_TOKEN='token', WHATSAPP_PHONE_NUMBER_ID='123'
+)
+class NotificationOutboxTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.court = self.create_court()
+        UserProfile.objects.create(user=self.user, phone='584141234567')
+        schedule = mock.patch('core.tasks.dispatch_notification_outbox.apply_async')
+        self.schedule = schedule.start()
+        self.addCleanup(schedule.stop)
+        NotificationOutboxService.clear_dispatch_flag()
+
+    def test_row_is_written_with_the_reservation(self):
+        serializer = ReservationSerializer(data={
+            'user': self.user.id, 'court': self.court.id, 'date': self.day.isoformat(),
+            'start_time': '10:00', 'end_time': '11:00', 'total_amount': '20.00'
+        })
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = serializer.save()
+
+        row = NotificationOutbox.objects.get(user=self.user)
+        self.assertEqual(row.key, f'reservation-created:{reservation.id}')
+        self.assertEqual(row.type, 'RESERVATION_CREATED')
+        self.schedule.assert_called_once()
+
+    def test_rollback_leaves_no_row_and_schedules_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                reservation = Reservation.objects.create(
+                    user=self.user, court=self.court, date=self.day, start_time=dt_time(10),
+                    end_time=dt_time(11), total_amount=Decimal('20.00')
+                )
+                NotificationService.notify_reservation_created(reservation)
+                raise RuntimeError
+        self.assertFalse(NotificationOutbox.objects.exists())
+        self.schedule.assert_not_called()
+
+    def test_same_key_is_enqueued_once(self):
+        for _ in range(2):
+            NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Aprobado', key='payment:1')
+        self.assertEqual(NotificationOutbox.objects.count(), 1)
+
+    @override_settings(NOTIFICATION_DIGEST_WINDOW=60)
+    def test_dispatch_delivers_in_app_once_and_whatsapp(self):
+        NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Aprobado')
+        NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Rechazado', send_whatsapp=False)
+        # Las dos filas esperan juntas a que cierre la ventana de resumen
+        self.assertEqual(NotificationOutbox.objects.values('available_at').distinct().count(), 1)
+        self.assertEqual(NotificationOutboxService().dispatch()['sent'], 0)
+        NotificationOutbox.objects.update(available_at=timezone.now())
+
+        with mock.patch.object(WhatsAppService, 'send_messages', return_value=[(True, {})]) as send:
+            totals = NotificationOutboxService().dispatch()
+
+        self.assertEqual(totals, {'sent': 2, 'retry': 0, 'failed': 0})
+        send.assert_called_once_with([('584141234567', 'Aprobado')])
+        notification = Notification.objects.get(user=self.user)
+        self.assertEqual((notification.title, notification.message), ('Pago (2)', 'Aprobado\n\nRechazado'))
+        self.assertFalse(NotificationOutbox.objects.exclude(status='SENT').exists())
+        self.assertEqual(NotificationOutboxService().dispatch(), {'sent': 0, 'retry': 0, 'failed': 0})
+
+    def test_whatsapp_failure_is_retried_without_repeating_in_app(self):
+        NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Aprobado')
+
+        with mock.patch.object(WhatsAppService, 'send_messages', return_value=[(False, 'caído')]):
+            self.assertEqual(NotificationOutboxService().dispatch()['retry'], 1)
+        row = NotificationOutbox.objects.get()
+        self.assertEqual((row.status, row.attempts, row.last_error), ('PENDING', 1, 'caído'))
+        self.assertGreater(row.available_at, timezone.now())
+
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        with mock.patch.object(WhatsAppService, 'send_messages', return_value=[(True, {})]):
+            self.assertEqual(NotificationOutboxService().dispatch()['sent'], 1)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 1)
+        self.assertIsNotNone(NotificationOutbox.objects.get().whatsapp_sent_at)
+
+
+@override_settings(
+    WHATSAPP_NUMBER_RATE=1000, WHATSAPP_NUMBER_BURST=1000,
+    WHATSAPP_DESTINATION_RATE=1 / 6, WHATSAPP_DESTINATION_BURST=2, WHATSAPP_RATE_MAX_WAIT=0.2
+)
+class WhatsAppRateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.number = uuid.uuid4().hex
+        self.phone = uuid.uuid4().hex
+
+    def test_bucket_allows_the_burst_then_asks_to_wait(self):
+        limiter = WhatsAppRateLimiter()
+        self.assertEqual(limiter.try_acquire(self.number, self.phone), 0)
+        self.assertEqual(limiter.try_acquire(self.number, self.phone), 0)
+        wait_ms = limiter.try_acquire(self.number, self.phone)
+        self.assertTrue(5000 < wait_ms <= 6000, wait_ms)
+        # Otro destinatario tiene su propio bucket
+        self.assertEqual(limiter.try_acquire(self.number, uuid.uuid4().hex), 0)
+
+    def test_acquire_gives_up_past_max_wait(self):
+        limiter = WhatsAppRateLimiter()
+        before = WhatsAppRateLimiter.stats()
+        for _ in range(2):
+            self.assertEqual(limiter.acquire(self.number, self.phone), (True, 0))
+        allowed, retry_after = limiter.acquire(self.number, self.phone)
+        after = WhatsAppRateLimiter.stats()
+
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after, 5)
+        self.assertEqual(after['acquired'] - before['acquired'], 2)
+        self.assertEqual(after['rejections'] - before['rejections'], 1)
+
+    @override_settings(WHATSAPP_DESTINATION_RATE=20, WHATSAPP_DESTINATION_BURST=1)
+    def test_acquire_sleeps_for_short_waits(self):
+        limiter = WhatsAppRateLimiter()
+        before = WhatsAppRateLimiter.stats()
+        limiter.acquire(self.number, self.phone)
+        started = time.monotonic()
+        self.assertEqual(limiter.acquire(self.number, self.phone), (True, 0))
+        self.assertGreaterEqual(time.monotonic() - started, 0.03)
+        self.assertEqual(WhatsAppRateLimiter.stats()['waits'] - before['waits'], 1)
+
+    @override_settings(WHATSAPP_PHONE_NUMBER_ID='123')
+    def test_rate_limited_message_is_not_posted(self):
+        service = WhatsAppService()
+        service.limiter = mock.Mock(**{'acquire.return_value': (False, 6.0)})
+        with mock.patch.object(service.session, 'post') as post:
+            ok, detail = service.send_message(self.phone, 'Hola')
+        post.assert_not_called()
+        self.assertFalse(ok)
+        self.assertEqual(detail, {'error': WhatsAppService.RATE_LIMITED, 'retry_after': 6.0})
+
+
+class MetricsEndpointTests(SimpleTestCase):
+    def test_requires_the_scrape_token(self):
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        with self.settings(METRICS_TOKEN='secreto'):
+            self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer otro').status_code, 403)
+            response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secreto')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE arenaspadel_availability_cache_hits_total counter', body)
+        self.assertIn('arenaspadel_whatsapp_ratelimit_rejections_total ', body)
+
+
+class NotificationInboxTests(ArenaTestCase):
+    def notify(self, user=None, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Notification.objects.create(
+                user=user or self.user, type='PAYMENT_STATUS', title='Pago', message='Aprobado', **fields
+            )
+
+    def test_counter_follows_every_change_without_counting_rows(self):
+        self.notify()
+        self.notify(read=True)
+        self.assertEqual(unread_count(self.user.id), 1)
+
+        second = self.notify()
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.bulk_create([
+                Notification(user=self.user, type='DIGEST', title='Resumen', message='...')
+                for _ in range(3)
+            ])
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_count(self.user.id), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.read = True
+            second.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.filter(type='DIGEST').first().delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_count(self.user.id), 3)
+        self.assertEqual(Notification.objects.filter(user=self.user, read=False).count(), 3)
+
+    def test_unread_count_and_mark_all_read_endpoints(self):
+        other = User.objects.create_user('otro')
+        for _ in range(2):
+            self.notify()
+        self.notify(user=other)
+        self.client.force_login(self.user)
+
+        self.assertEqual(self.client.get('/api/notifications/unread-count/').json(), {'unread': 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/notifications/mark-all-read/')
+        self.assertEqual(response.json(), {'updated': 2, 'unread': 0})
+        self.assertEqual(self.client.get('/api/notifications/unread-count/').json(), {'unread': 0})
+        self.assertEqual(unread_count(other.id), 1)
+
+    def test_endpoints_require_login(self):
+        self.assertEqual(self.client.get('/api/notifications/unread-count/').status_code, 403)
+
+
+class NotificationRetentionTests(ArenaTestCase):
+    def aged(self, type, days, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            notification = Notification.objects.create(
+                user=self.user, type=type, title='Aviso', message='...', **fields
+            )
+        Notification.objects.filter(pk=notification.pk).update(created_at=timezone.now() - timedelta(days=days))
+        return notification
+
+    def test_each_type_keeps_its_own_retention(self):
+        expired = [
+            self.aged('PAYMENT_REMINDER', 20),
+            self.aged('PAYMENT_STATUS', 400, read=True),
+            self.aged('PAYMENT_STATUS', 400),
+        ]
+        kept = [
+            self.aged('RESERVATION_REMINDER', 20),
+            self.aged('PAYMENT_REMINDER', 10),
+            self.aged('PAYMENT_STATUS', 100),
+        ]
+        outbox = NotificationOutbox.objects.create(
+            user=self.user, type='PAYMENT_REMINDER', title='Aviso', message='...',
+            status='SENT', notification=expired[0]
+        )
+        self.assertEqual(unread_count(self.user.id), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            totals = retention.prune_notifications(batch_size=1)
+
+        self.assertEqual(totals['PAYMENT_REMINDER'], 1)
+        self.assertEqual(totals['default'], 2)
+        self.assertEqual(
+            set(Notification.objects.values_list('id', flat=True)), {n.id for n in kept}
+        )
+        self.assertEqual(
+            set(NotificationArchive.objects.values_list('id', flat=True)), {n.id for n in expired}
+        )
+        self.assertTrue(NotificationArchive.objects.get(pk=expired[1].pk).read)
+        outbox.refresh_from_db()
+        self.assertIsNone(outbox.notification_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_count(self.user.id), 3)
+
+    @override_settings(NOTIFICATION_ARCHIVE_ENABLED=False)
+    def test_without_archive_rows_are_only_deleted(self):
+        self.aged('PAYMENT_REMINDER', 20)
+        retention.prune_notifications()
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(NotificationArchive.objects.exists())
+
+    def test_archive_outbox_and_ledger_expire(self):
+        now = timezone.now()
+        NotificationArchive.objects.create(
+            id=10 ** 9, user_id=self.user.id, type='DIGEST', title='Viejo', message='...',
+            created_at=now - timedelta(days=800), archived_at=now - timedelta(days=400)
+        )
+        NotificationArchive.objects.create(
+            id=10 ** 9 + 1, user_id=self.user.id, type='DIGEST', title='Reciente', message='...',
+            created_at=now - timedelta(days=400), archived_at=now - timedelta(days=30)
+        )
+        for status in ('SENT', 'FAILED', 'PENDING'):
+            NotificationOutbox.objects.create(user=self.user, type='DIGEST', title=status, message='...', status=status)
+        NotificationOutbox.objects.update(created_at=now - timedelta(days=8))
+
+        self.assertEqual(retention.prune_archive(), 1)
+        self.assertEqual(retention.prune_outbox(batch_size=1), 2)
+        self.assertEqual(list(NotificationArchive.objects.values_list('title', flat=True)), ['Reciente'])
+        self.assertEqual(list(NotificationOutbox.objects.values_list('status', flat=True)), ['PENDING'])
+
+
+class ReminderLedgerTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.court = self.create_court()
+        self.reservations = [self.book(self.court, dt_time(hour), dt_time(hour + 1)) for hour in (10, 12)]
+
+    def test_claim_returns_only_new_rows(self):
+        window = ReminderLedger.window_for(24)
+        ids = [reservation.id for reservation in self.reservations]
+
+        self.assertEqual(ReminderLedger.objects.claim('PAYMENT', window, ids[:1]), {ids[0]})
+        self.assertEqual(ReminderLedger.objects.claim('PAYMENT', window, ids), {ids[1]})
+        self.assertEqual(ReminderLedger.objects.claim('PAYMENT', window, ids), set())
+        # Otro tipo u otra ventana son registros distintos
+        self.assertEqual(ReminderLedger.objects.claim('RESERVATION', window, ids), set(ids))
+        self.assertEqual(ReminderLedger.objects.claim('PAYMENT', window - timedelta(days=1), ids), set(ids))
+
+    def test_window_is_aligned(self):
+        now = timezone.now()
+        window = ReminderLedger.window_for(6, now)
+        self.assertLessEqual(window, now)
+        self.assertLess(now - window, timedelta(hours=6))
+        self.assertEqual(window.timestamp() % (6 * 3600), 0)
+        self.assertEqual(ReminderLedger.window_for(6, window + timedelta(hours=5, minutes=59)), window)
+
+    def test_repeated_runs_do_not_remind_twice(self):
+        self.assertEqual(send_payment_reminder(), 1)
+        self.assertEqual(send_payment_reminder(), 0)
+        self.assertEqual(Notification.objects.filter(user=self.user, type='PAYMENT_REMINDER').count(), 1)
+
+        # Una reserva nueva sí recibe su aviso dentro de la misma ventana
+        self.book(self.court, dt_time(16), dt_time(17))
+        self.assertEqual(send_payment_reminder(), 1)
+        self.assertEqual(ReminderLedger.objects.filter(kind='PAYMENT').count(), 3)
+
+    def test_expired_ledger_rows_are_pruned(self):
+        window = ReminderLedger.window_for(24)
+        ids = [reservation.id for reservation in self.reservations]
+        ReminderLedger.objects.claim('PAYMENT', window, ids[:1])
+        ReminderLedger.objects.claim('PAYMENT', window - timedelta(days=40), ids)
+
+        self.assertEqual(retention.prune_reminder_ledger(batch_size=1), 2)
+        self.assertEqual(ReminderLedger.objects.get().window_start, window)
+
+
+class ReminderLedgerRaceTests(TransactionTestCase):
+    def test_concurrent_claims_are_disjoint(self):
+        court_catalog.invalidate()
+        self.addCleanup(court_catalog.invalidate)
+        user = User.objects.create_user('jugador')
+        court = Court.objects.create(
+            name='Cancha 1', price_per_hour=Decimal('20.00'),
+            opening_time=dt_time(8), closing_time=dt_time(22)
+        )
+        day = timezone.localdate() + timedelta(days=7)
+        ids = [
+            Reservation.objects.create(
+                user=user, court=court, date=day, start_time=dt_time(hour), end_time=dt_time(hour + 1),
+                total_amount=Decimal('20.00')
+            ).id
+            for hour in range(8, 20)
+        ]
+        window = ReminderLedger.window_for(24)
+        barrier = threading.Barrier(3)
+        claimed = []
+
+        def claim():
+            try:
+                barrier.wait()
+                with transaction.atomic():
+                    claimed.append(ReminderLedger.objects.claim('PAYMENT', window, ids))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(len(rows) for rows in claimed), len(ids))
+        self.assertEqual(set().union(*claimed), set(ids))
+
+
+class NotificationDigestTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        schedule = mock.patch('core.tasks.dispatch_notification_outbox.apply_async')
+        self.schedule = schedule.start()
+        self.addCleanup(schedule.stop)
+        NotificationOutboxService.clear_dispatch_flag()
+
+    def test_digest_notifications(self):
+        single = ('PAYMENT_STATUS', 'Pago', 'Aprobado')
+        self.assertEqual(digest_notifications([single]), single)
+        self.assertEqual(
+            digest_notifications([single, ('PAYMENT_STATUS', 'Pago', 'Rechazado')]),
+            ('PAYMENT_STATUS', 'Pago (2)', 'Aprobado\n\nRechazado')
+        )
+        self.assertEqual(
+            digest_notifications([single, ('RESERVATION_CREATED', 'Reserva', 'Creada')]),
+            ('DIGEST', 'Tienes 2 notificaciones nuevas', 'Pago\nAprobado\n\nReserva\nCreada')
+        )
+        _, title, _ = digest_notifications([('DIGEST', 'x' * 100, 'a'), ('DIGEST', 'x' * 100, 'b')])
+        self.assertEqual(len(title), 100)
+
+    @override_settings(NOTIFICATION_DIGEST_WINDOW=60)
+    def test_rows_inside_the_window_share_their_release(self):
+        other = User.objects.create_user('otro')
+        with self.captureOnCommitCallbacks(execute=True):
+            first = NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Aprobado')
+        second = NotificationOutboxService.enqueue(self.user, 'RESERVATION_CREATED', 'Reserva', 'Creada')
+        elsewhere = NotificationOutboxService.enqueue(other, 'PAYMENT_STATUS', 'Pago', 'Aprobado')
+
+        self.assertGreater(first.available_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(second.available_at, first.available_at)
+        self.assertGreaterEqual(elsewhere.available_at, first.available_at)
+        # La entrega se programa para cuando cierra la ventana
+        self.assertGreaterEqual(self.schedule.call_args.kwargs['countdown'], 59)
+
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        NotificationOutboxService().dispatch()
+        digest = Notification.objects.get(user=self.user)
+        self.assertEqual((digest.type, digest.title), ('DIGEST', 'Tienes 2 notificaciones nuevas'))
+        self.assertEqual(Notification.objects.filter(user=other).count(), 1)
+
+        # Entregada la anterior, la siguiente abre una ventana nueva
+        third = NotificationOutboxService.enqueue(self.user, 'PAYMENT_STATUS', 'Pago', 'Aprobado')
+        self.assertGreater(third.available_at, timezone.now() + timedelta(seconds=50))
+
+    @override_settings(NOTIFICATION_DIGEST_WINDOW=0, NOTIFICATION_DIGEST_MAX_ITEMS=2)
+    def test_digest_groups_are_capped(self):
+        NotificationOutboxService.enqueue_many([
+            NotificationOutbox(user=self.user, type='DIGEST', title='Aviso', message=str(i)) for i in range(3)
+        ])
+        NotificationOutbox.objects.update(created_at=timezone.now())
+
+        NotificationOutboxService().dispatch()
+        self.assertEqual(
+            sorted(Notification.objects.filter(user=self.user).values_list('title', flat=True)),
+            ['Aviso', 'Aviso (2)']
+        )
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_prueba')
+class StripeEventTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        court = self.create_court()
+        self.reservation = self.book(court, dt_time(10), dt_time(11))
+        self.payment = Payment.objects.create(
+            reservation=self.reservation, amount=Decimal('20.00'),
+            payment_type='CARD', stripe_payment_intent_id=f'pi_{uuid.uuid4().hex}'
+        )
+        self.created = int(time.time())
+        StripeEventService.clear_process_flag()
+
+    def event(self, type, offset=0, intent_id=None, **fields):
+        return {
+            'id': f'evt_{uuid.uuid4().hex}', 'type': type, 'created': self.created + offset,
+            'data': {'object': {
+                'id': intent_id or self.payment.stripe_payment_intent_id, 'object': 'payment_intent', **fields
+            }}
+        }
+
+    def ingest(self, *events):
+        for event in events:
+            StripeEventService.ingest(event)
+
+    def test_ingest_dedupes_and_ignores_unmapped_types(self):
+        succeeded = self.event('payment_intent.succeeded')
+        charge = {
+            'id': f'evt_{uuid.uuid4().hex}', 'type': 'charge.refunded', 'created': self.created,
+            'data': {'object': {'id': 'ch_1', 'object': 'charge', 'payment_intent': self.payment.stripe_payment_intent_id}}
+        }
+        self.ingest(succeeded, succeeded, charge, self.event('payment_intent.created'))
+
+        self.assertEqual(StripeEvent.objects.count(), 3)
+        self.assertEqual(StripeEvent.objects.get(event_id=succeeded['id']).status, 'PENDING')
+        ignored = StripeEvent.objects.filter(status='IGNORED')
+        self.assertEqual(ignored.count(), 2)
+        self.assertFalse(ignored.filter(processed_at__isnull=True).exists())
+        self.assertEqual(
+            set(ignored.values_list('payment_intent_id', flat=True)), {self.payment.stripe_payment_intent_id}
+        )
+
+    def test_succeeded_event_completes_payment_and_confirms_reservation(self):
+        PaymentService.cache_intent(self.payment.stripe_payment_intent_id, 'secret', 'processing')
+        self.ingest(self.event('payment_intent.succeeded', status='succeeded'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            totals = StripeEventService().process()
+        self.assertEqual(totals['processed'], 1)
+        self.payment.refresh_from_db()
+        self.reservation.refresh_from_db()
+        self.assertEqual((self.payment.status, self.reservation.status), ('COMPLETED', 'CONFIRMED'))
+        self.assertEqual(
+            PaymentService._cached_intent(self.payment.stripe_payment_intent_id)['status'], 'succeeded'
+        )
+
+    def test_completed_payment_is_not_downgraded(self):
+        self.ingest(
+            self.event('payment_intent.payment_failed', offset=2),
+            self.event('payment_intent.succeeded', offset=1),
+        )
+        StripeEventService().process()
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'COMPLETED')
+
+        self.ingest(self.event('payment_intent.payment_failed', offset=3))
+        StripeEventService().process()
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'COMPLETED')
+
+    def test_later_events_wait_for_an_earlier_pending_one(self):
+        earlier = self.event('payment_intent.payment_failed', offset=1)
+        later = self.event('payment_intent.succeeded', offset=2)
+        self.ingest(earlier, later)
+        # El anterior espera un reintento: el posterior no puede adelantarse
+        StripeEvent.objects.filter(event_id=earlier['id']).update(available_at=timezone.now() + timedelta(minutes=1))
+
+        totals = StripeEventService().process()
+        self.assertEqual(totals['deferred'], 1)
+        self.assertEqual(StripeEvent.objects.get(event_id=later['id']).status, 'PENDING')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'PENDING')
+
+        StripeEvent.objects.update(available_at=timezone.now())
+        StripeEventService().process()
+        self.assertFalse(StripeEvent.objects.filter(status='PENDING').exists())
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'COMPLETED')
+
+    @override_settings(STRIPE_EVENT_MAX_ATTEMPTS=2)
+    def test_unknown_payment_is_retried_then_failed(self):
+        self.ingest(self.event('payment_intent.succeeded', intent_id='pi_desconocido'))
+
+        self.assertEqual(StripeEventService().process()['retry'], 1)
+        event = StripeEvent.objects.get(payment_intent_id='pi_desconocido')
+        self.assertEqual((event.attempts, event.last_error), (1, 'Pago no encontrado'))
+        StripeEvent.objects.update(available_at=timezone.now())
+        self.assertEqual(StripeEventService().process()['failed'], 1)
+
+    def post_webhook(self, event, secret='whsec_prueba'):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                '/api/payments/webhook/', payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}'
+            )
+
+    def test_webhook_verifies_the_signature_and_only_stores_the_event(self):
+        event = self.event('payment_intent.succeeded')
+        self.assertEqual(self.post_webhook(event, secret='otro').status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+        with mock.patch('core.tasks.process_stripe_events.delay') as process:
+            response = self.post_webhook(event)
+            self.post_webhook(event)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeEvent.objects.get().event_id, event['id'])
+        process.assert_called_once_with()
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'PENDING')
+
+
+def create_validation_payments(reservation, count, **fields):
+    """Pagos móviles pendientes de validar, en orden de llegada"""
+    return [
+        Payment.objects.create(
+            reservation=reservation, amount=Decimal('20.00'), payment_type='PAGOMOVIL',
+            status='PENDING_VALIDATION', bank='BANCO1', reference_last_digits=f'{i:04d}', **fields
+        )
+        for i in range(count)
+    ]
+
+
+class PaymentValidationQueueTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        self.other_admin = User.objects.create_user('admin2', is_staff=True)
+        self.reservation = self.book(self.create_court(), dt_time(10), dt_time(11))
+        self.payments = create_validation_payments(self.reservation, 5)
+        # Fuera de la cola: ya procesado o pagado con tarjeta
+        Payment.objects.create(reservation=self.reservation, amount=Decimal('20.00'), payment_type='PAGOMOVIL',
+                               status='COMPLETED')
+        Payment.objects.create(reservation=self.reservation, amount=Decimal('20.00'), payment_type='CARD')
+
+    def ids(self, payments):
+        return [payment.id for payment in payments]
+
+    def test_pages_follow_the_cursor_without_gaps(self):
+        queue = services.PaymentValidationQueue(self.admin)
+        first, cursor = queue.page(limit=2)
+        second, cursor = queue.page(cursor=cursor, limit=2)
+        third, last_cursor = queue.page(cursor=cursor, limit=2)
+
+        self.assertEqual(self.ids(first + second + third), self.ids(self.payments))
+        self.assertIsNone(last_cursor)
+        with self.assertRaises(ValidationError):
+            queue.page(cursor='no-es-un-cursor')
+
+    def test_claims_are_disjoint_and_expire(self):
+        mine, expires_at = services.PaymentValidationQueue(self.admin).claim(limit=3)
+        theirs, _ = services.PaymentValidationQueue(self.other_admin).claim(limit=3)
+
+        self.assertEqual(self.ids(mine), self.ids(self.payments[:3]))
+        self.assertEqual(self.ids(theirs), self.ids(self.payments[3:]))
+        self.assertGreater(expires_at, timezone.now())
+        available, _ = services.PaymentValidationQueue(self.admin).page(available_only=True)
+        self.assertEqual(self.ids(available), self.ids(self.payments[:3]))
+
+        # Vencida la reserva, los pagos vuelven a la cola
+        Payment.objects.filter(claimed_by=self.admin).update(claim_expires_at=timezone.now() - timedelta(seconds=1))
+        again, _ = services.PaymentValidationQueue(self.other_admin).claim()
+        self.assertEqual(self.ids(again), self.ids(self.payments))
+
+    def test_release_only_touches_own_claims(self):
+        services.PaymentValidationQueue(self.admin).claim(limit=2)
+        services.PaymentValidationQueue(self.other_admin).claim(limit=2)
+
+        queue = services.PaymentValidationQueue(self.admin)
+        self.assertEqual(queue.release([self.payments[0].id, self.payments[2].id]), 1)
+        self.assertEqual(queue.release(), 1)
+        self.assertEqual(Payment.objects.filter(claimed_by=self.other_admin).count(), 2)
+        self.assertFalse(Payment.objects.filter(claimed_by=self.admin).exists())
+
+    def test_endpoints_are_admin_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/api/payments/pending/').status_code, 403)
+        self.assertEqual(self.client.post('/api/payments/pending/claim/').status_code, 403)
+
+        self.client.force_login(self.admin)
+        response = self.client.get('/api/payments/pending/', {'limit': 4})
+        self.assertEqual([row['id'] for row in response.json()['results']], self.ids(self.payments[:4]))
+        self.assertEqual(response.json()['results'][0]['user'], 'jugador')
+        response = self.client.get('/api/payments/pending/', {'cursor': response.json()['next_cursor']})
+        self.assertEqual([row['id'] for row in response.json()['results']], self.ids(self.payments[4:]))
+        self.assertIsNone(response.json()['next_cursor'])
+        self.assertEqual(self.client.get('/api/payments/pending/', {'cursor': '%%%'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/payments/pending/', {'limit': 'x'}).status_code, 400)
+
+        response = self.client.post('/api/payments/pending/claim/', {'limit': 2}, content_type='application/json')
+        self.assertEqual([row['claimed_by'] for row in response.json()['results']], ['admin', 'admin'])
+        response = self.client.post(
+            '/api/payments/pending/release/', {'payment_ids': self.payments[0].id}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/payments/pending/release/', {}, content_type='application/json')
+        self.assertEqual(response.json()['released'], 2)
+
+
+class PaymentClaimRaceTests(TransactionTestCase):
+    def test_concurrent_claims_skip_locked_rows(self):
+        court_catalog.invalidate()
+        self.addCleanup(court_catalog.invalidate)
+        admins = [User.objects.create_user(f'admin{i}', is_staff=True) for i in range(3)]
+        court = Court.objects.create(
+            name='Cancha 1', price_per_hour=Decimal('20.00'),
+            opening_time=dt_time(8), closing_time=dt_time(22)
+        )
+        reservation = Reservation.objects.create(
+            user=admins[0], court=court, date=timezone.localdate() + timedelta(days=7),
+            start_time=dt_time(10), end_time=dt_time(11), total_amount=Decimal('20.00')
+        )
+        payments = create_validation_payments(reservation, 9)
+        barrier = threading.Barrier(len(admins))
+        claimed = []
+
+        def claim(admin):
+            try:
+                barrier.wait()
+                claimed.append({payment.id for payment in services.PaymentValidationQueue(admin).claim(limit=3)[0]})
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(admin,)) for admin in admins]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(len(ids) for ids in claimed), len(payments))
+        self.assertEqual(set().union(*claimed), {payment.id for payment in payments})
+        self.assertEqual(
+            sorted(Payment.objects.values_list('claimed_by', flat=True).distinct()),
+            sorted(admin.id for admin in admins)
+        )
+
+
+class BatchPaymentValidationTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        self.other_admin = User.objects.create_user('admin2', is_staff=True)
+        self.court = self.create_court()
+        self.approved, self.rejected = [
+            create_validation_payments(self.book(self.court, dt_time(hour), dt_time(hour + 1)), 1)[0]
+            for hour in (10, 12)
+        ]
+
+    def validate(self, *items):
+        with self.captureOnCommitCallbacks(execute=True):
+            return services.PaymentValidationService(self.admin).validate(list(items))
+
+    def test_results_follow_the_items(self):
+        done = create_validation_payments(self.approved.reservation, 1)[0]
+        Payment.objects.filter(id=done.id).update(status='FAILED')
+        taken = create_validation_payments(self.approved.reservation, 1)[0]
+        services.PaymentValidationQueue(self.other_admin).claim()
+        Payment.objects.exclude(id=taken.id).update(claimed_by=None, claim_expires_at=None)
+
+        results = self.validate(
+            {'payment_id': self.approved.id, 'action': 'approve', 'notes': 'Referencia verificada'},
+            {'payment_id': 0, 'action': 'approve'},
+            {'payment_id': self.rejected.id, 'action': 'reject'},
+            {'payment_id': self.approved.id, 'action': 'reject'},
+            {'payment_id': done.id, 'action': 'approve'},
+            {'payment_id': taken.id, 'action': 'approve'},
+        )
+
+        self.assertEqual(results[0], {'payment_id': self.approved.id, 'ok': True, 'status': 'COMPLETED'})
+        self.assertEqual(results[1], {'payment_id': 0, 'ok': False, 'error': 'Pago no encontrado'})
+        self.assertEqual(results[2], {'payment_id': self.rejected.id, 'ok': True, 'status': 'FAILED'})
+        self.assertEqual(results[3]['error'], 'Pago repetido en el lote')
+        self.assertEqual(results[4]['error'], 'El pago ya fue procesado (Fallido)')
+        self.assertEqual(results[5]['error'], 'El pago lo tiene tomado otro administrador')
+
+        self.approved.refresh_from_db()
+        self.assertEqual(
+            (self.approved.status, self.approved.received_by, self.approved.validation_notes),
+            ('COMPLETED', self.admin, 'Referencia verificada')
+        )
+        self.approved.reservation.refresh_from_db()
+        self.assertEqual(self.approved.reservation.status, 'CONFIRMED')
+        self.rejected.refresh_from_db()
+        self.rejected.reservation.refresh_from_db()
+        self.assertEqual((self.rejected.status, self.rejected.received_by), ('FAILED', None))
+        self.assertEqual(self.rejected.reservation.status, 'PENDING')
+        # Una notificación por pago procesado, en un solo INSERT
+        self.assertEqual(NotificationOutbox.objects.filter(user=self.user, type='PAYMENT_STATUS').count(), 2)
+
+    def test_own_or_expired_claims_do_not_block(self):
+        services.PaymentValidationQueue(self.admin).claim(limit=1)
+        services.PaymentValidationQueue(self.other_admin).claim(limit=1)
+        Payment.objects.filter(id=self.rejected.id).update(claim_expires_at=timezone.now() - timedelta(seconds=1))
+
+        results = self.validate(
+            {'payment_id': self.approved.id, 'action': 'approve'},
+            {'payment_id': self.rejected.id, 'action': 'reject'},
+        )
+        self.assertTrue(all(result['ok'] for result in results))
+        self.assertFalse(Payment.objects.filter(claimed_by__isnull=False).exists())
+
+    def test_reservation_that_cannot_be_confirmed_keeps_its_payment_pending(self):
+        reservation = self.approved.reservation
+        Reservation.objects.filter(id=reservation.id).update(status='CANCELLED')
+        self.book(self.court, dt_time(10), dt_time(11), user=self.admin, status='CONFIRMED')
+
+        result, = self.validate({'payment_id': self.approved.id, 'action': 'approve'})
+        self.assertFalse(result['ok'])
+        self.assertTrue(result['error'].startswith('No se pudo confirmar la reserva: '))
+        self.approved.refresh_from_db()
+        self.assertEqual(self.approved.status, 'PENDING_VALIDATION')
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_endpoint(self):
+        url = '/api/payments/validate/'
+        payload = {'items': [
+            {'payment_id': self.approved.id, 'action': 'approve'},
+            {'payment_id': self.rejected.id, 'action': 'reject', 'notes': 'Referencia no encontrada'},
+            {'payment_id': 0, 'action': 'approve'},
+        ]}
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.post(url, payload, content_type='application/json').status_code, 403)
+
+        self.client.force_login(self.admin)
+        invalid = {'items': [{'payment_id': self.approved.id, 'action': 'aprobar'}]}
+        self.assertEqual(self.client.post(url, invalid, content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post(url, {'items': []}, content_type='application/json').status_code, 400)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual((response.json()['validated'], response.json()['errors']), (2, 1))
+        self.assertEqual([result['ok'] for result in response.json()['results']], [True, True, False])
+        self.rejected.refresh_from_db()
+        self.assertEqual(self.rejected.validation_notes, 'Referencia no encontrada')
+
+
+class StatementParsingTests(SimpleTestCase):
+    def test_parse_amount(self):
+        for value, cents in [('1.234,56', 123456), ('1,234.56', 123456), ('-10.00', -1000), ('(10,00)', -1000),
+                             ('Bs. 20', 2000), ('$1,000', 100000), ('7,5', 750)]:
+            with self.subTest(value=value):
+                self.assertEqual(parse_amount(value), cents)
+        with self.assertRaises(ValueError):
+            parse_amount('Bs.')
+
+    def test_csv_columns_and_cp1252(self):
+        statement = (
+            '\n'
+            'Fecha;Nro. Referencia;Descripción;Débito;Crédito\n'
+            '01/03/2025;00451234;Pago móvil 0414-1234567;;1.250,00\n'
+            '02/03/2025 10:15;;Comisión;5,00;\n'
+            '\n'
+            '03/03/2025;00459999;Sin monto;;\n'
+            '31/02/2025;00458888;Fecha inválida;;10,00\n'
+        ).encode('cp1252')
+        errors = []
+        lines = list(iter_csv(io.BytesIO(statement), errors=errors))
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], StatementLine(3, date(2025, 3, 1), 125000, '00451234',
+                                                 'Pago móvil 0414-1234567'))
+        self.assertEqual((lines[1].date.day, lines[1].amount, lines[1].description), (2, -500, 'Comisión'))
+        self.assertEqual([number for number, _ in errors], [6, 7])
+
+    def test_csv_needs_date_and_amount_columns(self):
+        with self.assertRaises(StatementError):
+            list(iter_csv(io.BytesIO(b'Fecha,Referencia\n01/03/2025,1234\n')))
+        with self.assertRaises(StatementError):
+            list(iter_csv(io.BytesIO(b'\n\n')))
+
+    def test_ofx_tags_split_across_chunks(self):
+        statement = (
+            'OFXHEADER:100\nDATA:OFXSGML\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>'
+            '<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20250301120000[-4:VET]<TRNAMT>25.00'
+            '<FITID>F1<NAME>Zelle ana@example.com<MEMO>Reserva</STMTTRN>'
+            '<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20250302<TRNAMT>-3.50<FITID>F2<CHECKNUM>77</STMTTRN>'
+            '<STMTTRN><DTPOSTED>20250303<TRNAMT>abc<FITID>F3</STMTTRN>'
+            '</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>'
+        ).encode()
+        errors = []
+        with mock.patch('core.reconciliation.READ_CHUNK_SIZE', 7):
+            lines = list(iter_statement(io.BytesIO(statement), name='marzo.OFX', errors=errors))
+
+        self.assertEqual(
+            [(line.date.day, line.amount, line.reference, line.description) for line in lines],
+            [(1, 2500, 'F1', 'Zelle ana@example.com Reserva'), (2, -350, '77', '')]
+        )
+        self.assertEqual([number for number, _ in errors], [3])
+        self.assertEqual(list(iter_ofx(io.BytesIO(b''))), [])
+        with self.assertRaises(StatementError):
+            iter_statement(io.BytesIO(b''), name='marzo.pdf')
+
+
+class ReconcileTests(SimpleTestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.today = timezone.localdate()
+        self.index = PaymentIndex([
+            # (id, últimos dígitos, referencia, monto, creado, teléfono, email, banco)
+            (1, '1234', None, Decimal('20.00'), self.now, '0414-1234567', None, 'BANCO1'),
+            (2, '5678', None, Decimal('30.00'), self.now, '0414-5550001', None, 'BANCO2'),
+            (3, None, '00985678', Decimal('30.00'), self.now, '0414-5550002', None, 'BANCO2'),
+            (4, None, None, Decimal('25.00'), self.now, None, 'Ana@Example.com', None),
+            (5, '4321', None, Decimal('15.00'), self.now, None, None, None),
+        ])
+
+    def line(self, number, amount, reference='', description='', days=0):
+        return StatementLine(number, self.today + timedelta(days=days), amount, reference, description)
+
+    def test_lines_are_matched_ambiguous_or_orphans(self):
+        result = reconcile([
+            self.line(1, 2000, '00011234'),
+            self.line(2, 3000, '5678'),
+            self.line(3, 3000, '5678', 'Pago móvil desde 0414-555.0002'),
+            self.line(4, 2500, description='ZELLE FROM ana@example.com'),
+            self.line(5, 1500, '4321'),
+            self.line(6, 1500, '4321'),
+            self.line(7, 2000, '1234', days=5),
+            self.line(8, 1000, '9999'),
+            self.line(9, -2000, '1234'),
+        ], index=self.index, window_days=3, orphan_limit=1)
+
+        self.assertEqual([(line.line, payment_id) for line, payment_id in result.matches], [(1, 1), (3, 3), (4, 4)])
+        self.assertEqual(
+            [(line.line, ids, reason) for line, ids, reason in result.ambiguous],
+            [(2, [2, 3], 'Varios pagos posibles'),
+             (5, [5], 'Varias líneas para el mismo pago'), (6, [5], 'Varias líneas para el mismo pago')]
+        )
+        self.assertEqual([line.line for line in result.orphans], [7])
+        self.assertEqual(
+            {key: value for key, value in result.summary().items() if key != 'elapsed'},
+            {'lines': 9, 'matched': 3, 'ambiguous': 3, 'orphans': 2, 'skipped': 1, 'errors': 0}
+        )
+        self.assertEqual(result.as_dict()['matches'][0]['amount'], '20.00')
+
+
+class StatementReconciliationTests(ArenaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        reservations = [self.book(self.create_court(), dt_time(hour), dt_time(hour + 1)) for hour in (10, 12)]
+        self.payments = [create_validation_payments(reservation, 1)[0] for reservation in reservations]
+        Payment.objects.filter(id=self.payments[1].id).update(reference_last_digits='0001', bank='BANCO2')
+        today = timezone.localdate().strftime('%d/%m/%Y')
+        self.statement = (
+            'Fecha,Referencia,Monto\n'
+            f'{today},12340000,20.00\n'
+            f'{today},56780001,20.00\n'
+            f'{today},99999999,40.00\n'
+        ).encode()
+
+    def test_apply_matches_approves_selected_payments(self):
+        result = reconcile(iter_csv(io.BytesIO(self.statement)))
+        self.assertEqual([payment_id for _, payment_id in result.matches], [payment.id for payment in self.payments])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            applied = apply_matches(result, self.admin, payment_ids=[self.payments[0].id])
+        self.assertEqual(applied, [{'payment_id': self.payments[0].id, 'ok': True, 'status': 'COMPLETED'}])
+        approved = Payment.objects.get(id=self.payments[0].id)
+        self.assertEqual(approved.received_by, self.admin)
+        self.assertTrue(approved.validation_notes.startswith('Conciliado con el estado de cuenta: ref. 12340000'))
+        self.assertEqual(Payment.objects.get(id=self.payments[1].id).status, 'PENDING_VALIDATION')
+
+    def test_endpoint(self):
+        url = '/api/payments/reconcile/'
+        self.client.force_login(self.admin)
+        response = self.client.post(url, {'statement': SimpleUploadedFile('estado.pdf', b'%PDF')})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, {'statement': SimpleUploadedFile('estado.csv', self.statement)})
+        self.assertEqual(response.json()['summary']['matched'], 2)
+        self.assertEqual(response.json()['orphans'][0]['reference'], '99999999')
+        self.assertNotIn('applied', response.json())
+        self.assertFalse(Payment.objects.filter(status='COMPLETED').exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'statement': SimpleUploadedFile('estado.csv', self.statement),
+                                              'apply': 'true'})
+        self.assertEqual(response.json()['applied']['validated'], 2)
+        self.assertEqual(Payment.objects.filter(status='COMPLETED').count(), 2)
+
+    def test_command(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f'{directory.name}/estado.csv'
+        with open(path, 'wb') as statement:
+            statement.write(self.statement)
+
+        out = io.StringIO()
+        call_command('reconcile_statement', path, '--json', stdout=out)
+        self.assertEqual(json.JSONDecoder().raw_decode(out.getvalue())[0]['summary']['orphans'], 1)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_statement', path, '--apply', stdout=io.StringIO())
+
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_statement', path, '--apply', '--admin', 'admin', stdout=out)
+        self.assertIn('2 pago(s) aprobados', out.getvalue())
+        self.assertEqual(Payment.objects.filter(status='COMPLETED').count(), 2)
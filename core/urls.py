@@ -4,6 +4,22 @@ from . import views
 urlpatterns = [
     path('courts/', views.get_courts),
     path('courts/<int:court_id>/availability/', views.check_court_availability),
+    path('courts/availability/matrix/', views.availability_matrix),
+    path('courts/next-available/', views.next_available_slots),
+    path('courts/availability/stream/', views.availability_stream),
     path('reservations/', views.create_reservation),
+    path('reservations/series/', views.create_reservation_series),
+    path('holds/', views.create_slot_hold),
+    path('holds/<str:token>/', views.release_slot_hold),
     path('payments/', views.process_payment),
+    path('payments/webhook/', views.StripeWebhookView.as_view()),
+    path('payments/pending/', views.PendingPaymentsView.as_view()),
+    path('payments/pending/claim/', views.ClaimPaymentsView.as_view()),
+    path('payments/pending/release/', views.ReleasePaymentClaimsView.as_view()),
+    path('payments/validate/', views.BatchValidatePaymentsView.as_view()),
+    path('payments/reconcile/', views.ReconcileStatementView.as_view()),
+    path('notifications/', views.NotificationViewSet.as_view({'get': 'list'})),
+    path('notifications/unread-count/', views.NotificationViewSet.as_view({'get': 'unread_count'})),
+    path('notifications/mark-all-read/', views.NotificationViewSet.as_view({'post': 'mark_all_read'})),
+    path('metrics/', views.metrics),
 ]
\ No newline at end of file
@@ -1,3 +1,7 @@
+import asyncio
+import hashlib
+import json
+import logging
 from django.shortcuts import render
 from rest_framework import viewsets
 from .models import Court, Membership, Reservation, Payment, UserProfile, Notification
@@ -6,26 +10,79 @@ from .serializers import (
     MembershipSerializer,
     ReservationSerializer,
     PaymentSerializer,
+    PaymentBatchValidationSerializer,
+    PaymentQueueSerializer,
+    StatementReconciliationSerializer,
     UserProfileSerializer,
     NotificationSerializer,
-    PaymentIntentSerializer
+    PaymentIntentSerializer,
+    ReservationSeriesSerializer
 )
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.conf import settings
+from django.db import transaction
+from django.core.exceptions import ValidationError as DjangoValidationError
 import stripe
-from .services import PaymentService, PaymentNotificationService
+from .services import (
+    PaymentService,
+    PaymentNotificationService,
+    PaymentValidationQueue,
+    PaymentValidationService,
+    ReservationSeriesService,
+    SlotHoldService,
+    StripeEventService,
+    WhatsAppRateLimiter
+)
+from .exceptions import SlotHoldError, SlotHoldUnavailable, StatementError
+from .reconciliation import apply_matches, iter_statement, reconcile
+from .tasks import notify_admins_pending_payment
+from .events import broadcaster, publish_availability_changes
+from .catalog import court_catalog
+from .inbox import unread_count
+from .permissions import HasMetricsToken
 from rest_framework.permissions import IsAdminUser
 from rest_framework.renderers import TemplateHTMLRenderer, JSONRenderer
 from django.urls import reverse
-from django.http import HttpResponseRedirect
-from datetime import datetime, timedelta
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.utils import timezone
-from rest_framework.decorators import api_view
-from rest_framework.permissions import IsAuthenticated
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from django.shortcuts import redirect
-from django.shortcuts import get_object_or_404
+from .availability import (
+    CELL_MINUTES,
+    cache_stats,
+    cell_label,
+    cell_to_time,
+    day_occupancy,
+    day_versions,
+    encode_free_cells,
+    find_next_slots,
+    load_occupancy,
+    time_to_cell
+)
+
+logger = logging.getLogger(__name__)
+
+# Cache-Control de las respuestas con ETag: el listado de canchas puede
+# servirse un minuto sin revalidar; la disponibilidad se guarda pero se
+# revalida siempre (un 304 no transfiere el cuerpo)
+COURTS_CACHE_CONTROL = {'public': True, 'max_age': 60}
+AVAILABILITY_CACHE_CONTROL = {'public': True, 'no_cache': True}
+
+MATRIX_DEFAULT_DAYS = 7
+MATRIX_MAX_DAYS = 31
+NEXT_SLOTS_DEFAULT_DAYS = 30
+NEXT_SLOTS_MAX_DAYS = 60
+STREAM_MAX_SUBSCRIPTIONS = 31
+STREAM_HEARTBEAT_SECONDS = 25
+STREAM_MAX_SECONDS = 300
+STREAM_RETRY_MS = 2000
 
 class CourtViewSet(viewsets.ModelViewSet):
     queryset = Court.objects.all()
@@ -50,11 +107,22 @@ class UserProfileViewSet(viewsets.ModelViewSet):
 class NotificationViewSet(viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
+    permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
         # Filtrar notificaciones por usuario actual
         return Notification.objects.filter(user=self.request.user)
 
+    @action(detail=False, methods=['get'], url_path='unread-count')
+    def unread_count(self, request):
+        # Contador en Redis: no depende del tamaño de la bandeja
+        return Response({'unread': unread_count(request.user.id)})
+
+    @action(detail=False, methods=['post'], url_path='mark-all-read')
+    def mark_all_read(self, request):
+        updated = Notification.objects.mark_all_read(request.user)
+        return Response({'updated': updated, 'unread': 0})
+
 class CreatePaymentIntentView(APIView):
     renderer_classes = [TemplateHTMLRenderer, JSONRenderer]
     template_name = 'payments/create_payment.html'
@@ -77,15 +145,8 @@ class CreatePaymentIntentView(APIView):
             reservation_id = request.data.get('reservation_id')
             reservation = Reservation.objects.get(id=reservation_id)
             
-            # Crear el PaymentIntent en Stripe
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            intent = stripe.PaymentIntent.create(
-                amount=int(reservation.total_amount * 100),  # Convertir a centavos
-                currency='usd',
-                metadata={
-                    'reservation_id': reservation.id
-                }
-            )
+            # Crear el PaymentIntent en Stripe (queda en caché para la página de pago)
+            intent = PaymentService().create_payment_intent(reservation)
             
             # Guardar el pago en la base de datos
             Payment.objects.create(
@@ -108,36 +169,39 @@ class CreatePaymentIntentView(APIView):
             return Response({'error': str(e)}, status=400)
 
 class StripeWebhookView(APIView):
+    # Stripe no envía sesión ni token CSRF: la autenticidad la da la firma
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
     def post(self, request):
         payload = request.body
-        sig_header = request.META['HTTP_STRIPE_SIGNATURE']
+        sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
 
         try:
-            event = stripe.Webhook.construct_event(
+            stripe.Webhook.construct_event(
                 payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
             )
-            
-            if event.type == 'payment_intent.succeeded':
-                payment_intent = event.data.object
-                payment = Payment.objects.get(
-                    stripe_payment_intent_id=payment_intent.id
-                )
-                payment.status = 'COMPLETED'
-                payment.save()
-                
-                # Actualizar estado de la reserva
-                reservation = payment.reservation
-                reservation.status = 'CONFIRMED'
-                reservation.save()
-                
-            return Response({'status': 'success'})
-            
-        except Exception as e:
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
             return Response(
                 {'error': str(e)}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        # Solo se guarda el evento; el pago y la reserva los actualiza
+        # tasks.process_stripe_events, así la respuesta no depende de la base
+        # de datos más allá de un INSERT
+        with transaction.atomic():
+            StripeEventService.ingest(json.loads(payload))
+        return Response({'status': 'success'})
+
+def _notify_admins(payment_id):
+    # Corre tras el commit: si el broker no responde el pago ya está guardado,
+    # así que solo se registra el fallo en lugar de devolver un error
+    try:
+        notify_admins_pending_payment.delay(payment_id)
+    except Exception as e:
+        logger.warning(f"No se pudo encolar el aviso a administradores del pago {payment_id}: {str(e)}")
+
 class MobilePaymentView(APIView):
     serializer_class = PaymentSerializer
 
@@ -150,12 +214,13 @@ class MobilePaymentView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            payment = serializer.save(status='PENDING_VALIDATION')
-            
-            # Notificar a los administradores
-            notification_service = PaymentNotificationService()
-            notification_service.notify_admin_pending_validation(payment)
-            notification_service.notify_payment_status(payment)
+            with transaction.atomic():
+                payment = serializer.save(status='PENDING_VALIDATION')
+                
+                # Notificar a los administradores en segundo plano
+                transaction.on_commit(lambda: _notify_admins(payment.id))
+                notification_service = PaymentNotificationService()
+                notification_service.notify_payment_status(payment)
             
             return Response({
                 'id': payment.id,
@@ -178,20 +243,21 @@ class ValidatePaymentView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            if action == 'approve':
-                payment.status = 'COMPLETED'
-                payment.received_by = request.user
-                payment.reservation.status = 'CONFIRMED'
-                payment.reservation.save()
-            else:
-                payment.status = 'FAILED'
-            
-            payment.validation_notes = request.data.get('notes', '')
-            payment.save()
-            
-            # Notificar al usuario del resultado
-            notification_service = PaymentNotificationService()
-            notification_service.notify_payment_status(payment)
+            with transaction.atomic():
+                if action == 'approve':
+                    payment.status = 'COMPLETED'
+                    payment.received_by = request.user
+                    payment.reservation.status = 'CONFIRMED'
+                    payment.reservation.save(update_fields=['status', 'updated_at'])
+                else:
+                    payment.status = 'FAILED'
+                
+                payment.validation_notes = request.data.get('notes', '')
+                payment.save()
+                
+                # Notificar al usuario del resultado
+                notification_service = PaymentNotificationService()
+                notification_service.notify_payment_status(payment)
             
             return Response({
                 'message': f'Pago {payment.id} {"aprobado" if action == "approve" else "rechazado"}',
@@ -204,14 +270,114 @@ class ValidatePaymentView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+def _queue_limit(request, name='limit'):
+    value = request.query_params.get(name) if request.method == 'GET' else request.data.get(name)
+    return int(value) if value else None
+
+class BatchValidatePaymentsView(APIView):
+    """
+    Aprueba o rechaza varios pagos en una transacción:
+    {"items": [{"payment_id": 1, "action": "approve", "notes": ""}, ...]}.
+    Responde con un resultado por elemento.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        serializer = PaymentBatchValidationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        results = PaymentValidationService(request.user).validate(serializer.validated_data['items'])
+        return Response({
+            'results': results,
+            'validated': sum(1 for result in results if result['ok']),
+            'errors': sum(1 for result in results if not result['ok'])
+        })
+
+class ReconcileStatementView(APIView):
+    """
+    Concilia un estado de cuenta (CSV u OFX, multipart 'statement') con los
+    pagos pendientes. Devuelve los matches, las líneas ambiguas y las
+    huérfanas; con apply=true aprueba además los matches.
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        serializer = StatementReconciliationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        statement = data['statement']
+        errors = []
+        try:
+            lines = iter_statement(
+                statement, name=statement.name, format=data.get('format'),
+                date_format=data.get('date_format'), errors=errors
+            )
+            result = reconcile(lines, errors=errors)
+        except StatementError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = result.as_dict()
+        if data['apply']:
+            applied = apply_matches(result, request.user)
+            response['applied'] = {
+                'results': applied,
+                'validated': sum(1 for item in applied if item['ok']),
+                'errors': sum(1 for item in applied if not item['ok'])
+            }
+        return Response(response)
+
 class PendingPaymentsView(APIView):
+    """
+    Cola de validación de pagos, por páginas: ?cursor=<next_cursor>&limit=N.
+    Con ?available=1 omite los pagos que otro administrador tiene tomados.
+    """
+    permission_classes = [IsAdminUser]
+
     def get(self, request):
-        pending_payments = Payment.objects.filter(
-            status__in=['PENDING', 'PENDING_VALIDATION'],
-            payment_type__in=['PAGOMOVIL', 'ZELLE']  # Agregamos ZELLE
-        )
-        serializer = PaymentSerializer(pending_payments, many=True)
-        return Response(serializer.data)
+        try:
+            payments, next_cursor = PaymentValidationQueue(request.user).page(
+                cursor=request.query_params.get('cursor'),
+                limit=_queue_limit(request),
+                available_only=request.query_params.get('available') in ('1', 'true')
+            )
+        except (TypeError, ValueError, DjangoValidationError):
+            return Response(
+                {'error': 'Parámetros de paginación inválidos'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({
+            'results': PaymentQueueSerializer(payments, many=True).data,
+            'next_cursor': next_cursor
+        })
+
+class ClaimPaymentsView(APIView):
+    """Toma un lote de pagos de la cola para validarlos: {"limit": N}"""
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        try:
+            limit = _queue_limit(request)
+        except (TypeError, ValueError):
+            return Response({'error': 'limit debe ser un número'}, status=status.HTTP_400_BAD_REQUEST)
+        payments, expires_at = PaymentValidationQueue(request.user).claim(limit)
+        return Response({
+            'results': PaymentQueueSerializer(payments, many=True).data,
+            'claim_expires_at': expires_at
+        })
+
+class ReleasePaymentClaimsView(APIView):
+    """Devuelve a la cola los pagos tomados: {"payment_ids": [...]} o todos si se omite"""
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        payment_ids = request.data.get('payment_ids')
+        if payment_ids is not None and not isinstance(payment_ids, list):
+            return Response({'error': 'payment_ids debe ser una lista'}, status=status.HTTP_400_BAD_REQUEST)
+        released = PaymentValidationQueue(request.user).release(payment_ids)
+        return Response({'released': released})
 
 class PaymentHistoryView(APIView):
     def get(self, request):
@@ -313,9 +479,8 @@ class ZellePaymentView(APIView):
         if serializer.is_valid():
             payment = serializer.save()
             
-            # Notificar a los administradores
-            notification_service = PaymentNotificationService()
-            notification_service.notify_admin_pending_validation(payment)
+            # Notificar a los administradores en segundo plano
+            transaction.on_commit(lambda: _notify_admins(payment.id))
             
             # Redirigir con mensaje de éxito
             return HttpResponseRedirect(
@@ -345,44 +510,37 @@ class CourtAvailabilityView(APIView):
                 else:
                     selected_date = timezone.now().date()
                     
-                reservations = Reservation.objects.filter(
-                    court_id=court_id,
-                    date=selected_date,
-                    status__in=['PENDING', 'CONFIRMED']
-                ).values('start_time', 'end_time')
-                
-                court = Court.objects.get(id=court_id)
-                opening_time = datetime.strptime(str(court.opening_time), '%H:%M:%S').time()
-                closing_time = datetime.strptime(str(court.closing_time), '%H:%M:%S').time()
-                
-                current_time = opening_time
-                available_slots = []
-                
-                while current_time < closing_time:
-                    slot_end = (datetime.combine(selected_date, current_time) + timedelta(hours=1)).time()
-                    
-                    is_available = True
-                    for reservation in reservations:
-                        if (current_time >= reservation['start_time'] and 
-                            current_time < reservation['end_time']) or (
-                            slot_end > reservation['start_time'] and 
-                            slot_end <= reservation['end_time']):
-                            is_available = False
-                            break
-                    
-                    if is_available:
-                        available_slots.append({
-                            'start_time': current_time.strftime('%H:%M'),
-                            'end_time': slot_end.strftime('%H:%M')
-                        })
-                    
-                    current_time = slot_end
-                
-                return Response({
+                court = court_catalog.get(court_id)
+                if court is None:
+                    raise Court.DoesNotExist
+                span = _parse_time_span(request)
+
+                etag, last_modified = _availability_validators(court, selected_date, request)
+                not_modified = _not_modified(request, etag)
+                if not_modified is not None:
+                    return _with_validators(not_modified, etag, last_modified, AVAILABILITY_CACHE_CONTROL)
+
+                occupancy = _day_availability(court.id, selected_date, request)
+
+                available_slots = [
+                    {
+                        'start_time': cell_label(start),
+                        'end_time': cell_label(end)
+                    }
+                    for start, end in occupancy.free_slots(court.opening_time, court.closing_time)
+                ]
+
+                data = {
                     'court_id': court_id,
                     'date': selected_date,
                     'available_slots': available_slots
-                })
+                }
+
+                # Consulta puntual: ¿el intervalo start_time-end_time choca con alguna reserva?
+                if span:
+                    data['conflict'] = occupancy.conflicts(*span)
+
+                return _with_validators(Response(data), etag, last_modified, AVAILABILITY_CACHE_CONTROL)
                 
             except Court.DoesNotExist:
                 return Response(
@@ -391,13 +549,13 @@ class CourtAvailabilityView(APIView):
                 )
             except ValueError:
                 return Response(
-                    {'error': 'Formato de fecha inválido. Use YYYY-MM-DD'}, 
+                    {'error': 'Formato inválido. Use YYYY-MM-DD para la fecha y HH:MM para las horas'}, 
                     status=400
                 )
         
         # Si es una petición normal, mostrar el template
         return Response({
-            'courts': Court.objects.filter(is_active=True),
+            'courts': court_catalog.active(),
             'today': timezone.now().date()
         })
 
@@ -412,7 +570,9 @@ class CreateReservationView(APIView):
         end_time = request.query_params.get('end_time')
         
         try:
-            court = Court.objects.get(id=court_id)
+            court = court_catalog.get(court_id)
+            if court is None:
+                raise Court.DoesNotExist
             total_amount = float(court.price_per_hour)
             
             context = {
@@ -422,13 +582,34 @@ class CreateReservationView(APIView):
                 'end_time': end_time,
                 'total_amount': total_amount
             }
+
+            # Retener el slot mientras el usuario confirma, con las mismas
+            # validaciones que el endpoint de retenciones
+            if request.user.is_authenticated and court.is_active:
+                try:
+                    token, _, error = _acquire_slot_hold(
+                        court,
+                        datetime.strptime(date, '%Y-%m-%d').date(),
+                        datetime.strptime(start_time, '%H:%M').time(),
+                        datetime.strptime(end_time, '%H:%M').time(),
+                        request.user.id
+                    )
+                    if error:
+                        context['error'] = error[0]
+                    else:
+                        context['hold_token'] = token
+                except (TypeError, ValueError):
+                    context['error'] = 'Fecha u horario inválido'
+
             return Response(context)
         except Court.DoesNotExist:
             return Response({'error': 'Cancha no encontrada'}, status=404)
 
     def post(self, request):
         try:
-            court = Court.objects.get(id=request.POST.get('court'))
+            court = court_catalog.get(request.POST.get('court'))
+            if court is None:
+                raise Court.DoesNotExist
             serializer = ReservationSerializer(data={
                 'court': court.id,
                 'date': request.POST.get('date'),
@@ -436,7 +617,8 @@ class CreateReservationView(APIView):
                 'end_time': request.POST.get('end_time'),
                 'user': request.user.id,
                 'status': 'PENDING',
-                'total_amount': float(court.price_per_hour)
+                'total_amount': float(court.price_per_hour),
+                'hold_token': request.POST.get('hold_token', '')
             })
             
             if serializer.is_valid():
@@ -449,20 +631,18 @@ class CreateReservationView(APIView):
 class ProcessPaymentView(APIView):
     def get(self, request, payment_intent_id):
         try:
-            # Mantenemos la lógica existente
-            stripe.api_key = settings.STRIPE_SECRET_KEY
-            intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-            
             # Obtener la reserva
             payment = Payment.objects.filter(
                 stripe_payment_intent_id=payment_intent_id
-            ).first()
+            ).select_related('reservation__court').first()
             
             if not payment:
                 return Response({
                     'error': 'Pago no encontrado'
                 }, status=404)
-                
+
+            # client_secret desde la caché; solo se consulta a Stripe si falta
+            intent = PaymentService().get_intent_details(payment_intent_id)
             reservation = payment.reservation
             
             # Devolver datos en formato JSON
@@ -475,7 +655,8 @@ class ProcessPaymentView(APIView):
                     'total_amount': float(reservation.total_amount)
                 },
                 'payment': {
-                    'client_secret': intent.client_secret,
+                    'client_secret': intent['client_secret'],
+                    'status': intent['status'],
                     'stripe_public_key': settings.STRIPE_PUBLIC_KEY,
                     'payment_intent_id': payment_intent_id
                 },
@@ -552,25 +733,340 @@ class ConfirmPaymentView(APIView):
 
 @api_view(['GET'])
 def get_courts(request):
-    courts = Court.objects.all()
-    serializer = CourtSerializer(courts, many=True)
-    return Response(serializer.data)
+    # La versión del catálogo basta para el ETag: no hace falta serializar.
+    # Versión y JSON salen del mismo estado del catálogo
+    version, body = court_catalog.snapshot()
+    etag = _make_etag('courts', version) if version is not None else None
+    last_modified = version // 1000 if version is not None else None
+
+    response = _not_modified(request, etag)
+    if response is None:
+        # JSON ya serializado en el catálogo de canchas
+        response = HttpResponse(body, content_type='application/json')
+    return _with_validators(response, etag, last_modified, COURTS_CACHE_CONTROL)
 
 @api_view(['GET'])
 def check_court_availability(request, court_id):
-    date = request.query_params.get('date')
-    court = get_object_or_404(Court, id=court_id)
-    
-    # Obtener reservas existentes para esa fecha
-    existing_bookings = Reservation.objects.filter(
-        court=court,
-        date=date
+    date_str = request.query_params.get('date')
+    court = court_catalog.get(court_id)
+    if court is None:
+        raise Http404
+
+    try:
+        date = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else timezone.now().date()
+        span = _parse_time_span(request)
+    except ValueError:
+        return Response(
+            {'error': 'Formato inválido. Use YYYY-MM-DD para la fecha y HH:MM para las horas'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    etag, last_modified = _availability_validators(court, date, request)
+    not_modified = _not_modified(request, etag)
+    if not_modified is not None:
+        return _with_validators(not_modified, etag, last_modified, AVAILABILITY_CACHE_CONTROL)
+
+    # Ocupación del día como bitmap, incluyendo las reservas temporales vigentes
+    occupancy = _day_availability(court.id, date, request)
+
+    if span:
+        response = Response({
+            'court_id': court.id,
+            'date': date,
+            'start_time': span[0].strftime('%H:%M'),
+            'end_time': span[1].strftime('%H:%M'),
+            'available': not occupancy.conflicts(*span)
+        })
+    else:
+        # Generar todos los slots disponibles
+        response = Response(generate_available_slots(court, occupancy))
+
+    return _with_validators(response, etag, last_modified, AVAILABILITY_CACHE_CONTROL)
+
+@api_view(['GET'])
+def availability_matrix(request):
+    """
+    Matriz de disponibilidad cancha × fecha × slot en una sola petición.
+
+    Parámetros: courts=1,2,3 (por defecto todas las activas), start=YYYY-MM-DD
+    (por defecto hoy) y days=N (por defecto 7). Cada día se devuelve como un
+    bitstring de celdas de `cell_minutes` desde la apertura de la cancha:
+    '1' libre, '0' ocupada; null si la cancha no abre ese día.
+    """
+    try:
+        start_str = request.query_params.get('start')
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date() if start_str else timezone.now().date()
+        days = int(request.query_params.get('days', MATRIX_DEFAULT_DAYS))
+        courts_param = request.query_params.get('courts')
+        court_ids = [int(c) for c in courts_param.split(',') if c] if courts_param else None
+    except ValueError:
+        return Response(
+            {'error': 'Parámetros inválidos. Use start=YYYY-MM-DD, days=N y courts=1,2,3'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    if not 1 <= days <= MATRIX_MAX_DAYS:
+        return Response(
+            {'error': f'El rango debe estar entre 1 y {MATRIX_MAX_DAYS} días'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    courts = court_catalog.active(court_ids)
+
+    dates = [start_date + timedelta(days=i) for i in range(days)]
+    open_days = [
+        (court.id, date)
+        for court in courts
+        for date in dates
+        if court.opens_on(date)
+    ]
+    occupancy = SlotHoldService().apply_to(
+        load_occupancy(open_days),
+        request.query_params.get('hold')
     )
-    
-    # Generar todos los slots disponibles
-    available_slots = generate_available_slots(existing_bookings)
-    
-    return Response(available_slots)
+
+    matrix = []
+    for court in courts:
+        court_days = []
+        for date in dates:
+            day = occupancy.get((court.id, date))
+            if day is None:
+                court_days.append(None)
+                continue
+            court_days.append(encode_free_cells(day, court.opening_time, court.closing_time))
+
+        matrix.append({
+            'id': court.id,
+            'name': court.name,
+            'opening_time': court.opening_time.strftime('%H:%M'),
+            'closing_time': court.closing_time.strftime('%H:%M'),
+            'days': court_days
+        })
+
+    return Response({
+        'start': start_date,
+        'days': days,
+        'cell_minutes': CELL_MINUTES,
+        'courts': matrix
+    })
+
+@api_view(['GET'])
+def next_available_slots(request):
+    """
+    Primeros slots libres en cualquier cancha activa.
+
+    Parámetros: duration (minutos, por defecto 90), after=HH:MM (hora mínima
+    de inicio cada día), from=YYYY-MM-DD (por defecto hoy), days (horizonte,
+    por defecto 30), limit (por defecto 5) y courts=1,2,3 opcional.
+    """
+    try:
+        params = request.query_params
+        duration = int(params.get('duration', 90))
+        limit = int(params.get('limit', 5))
+        days = int(params.get('days', NEXT_SLOTS_DEFAULT_DAYS))
+        after_str = params.get('after')
+        after_time = datetime.strptime(after_str, '%H:%M').time() if after_str else None
+        from_str = params.get('from')
+        today = timezone.localdate()
+        start_date = datetime.strptime(from_str, '%Y-%m-%d').date() if from_str else today
+        courts_param = params.get('courts')
+        court_ids = [int(c) for c in courts_param.split(',') if c] if courts_param else None
+    except ValueError:
+        return Response(
+            {'error': 'Parámetros inválidos. Use duration, limit y days numéricos, after=HH:MM y from=YYYY-MM-DD'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    if not (CELL_MINUTES <= duration <= 24 * 60 and 1 <= limit <= 50 and 1 <= days <= NEXT_SLOTS_MAX_DAYS):
+        return Response(
+            {'error': f'Use duration entre {CELL_MINUTES} y 1440, limit entre 1 y 50 y days entre 1 y {NEXT_SLOTS_MAX_DAYS}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    courts = court_catalog.active(court_ids)
+
+    holds = SlotHoldService()
+    slots = find_next_slots(
+        courts,
+        max(start_date, today),
+        days,
+        duration,
+        limit,
+        after_time=after_time,
+        not_before=timezone.localtime(),
+        occupancy_filter=lambda occupancy: holds.apply_to(occupancy, params.get('hold'))
+    )
+    return Response({'duration': duration, 'slots': slots})
+
+async def availability_stream(request):
+    """
+    Server-Sent Events con el estado de los días suscritos:
+    ?subscribe=<court_id>:<YYYY-MM-DD>,... (máximo STREAM_MAX_SUBSCRIPTIONS).
+
+    Envía primero el estado actual de cada día y luego un evento "slots" cada
+    vez que cambia. Requiere servir la aplicación por ASGI (config.asgi): por
+    WSGI (runserver incluido) Django consume el generador entero antes de
+    enviar nada, así que se responde 501 y el cliente se queda con la
+    consulta normal de disponibilidad.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {'error': 'El stream de disponibilidad requiere servir la aplicación por ASGI'},
+            status=status.HTTP_501_NOT_IMPLEMENTED
+        )
+
+    try:
+        pairs = []
+        for item in request.GET.get('subscribe', '').split(','):
+            if item:
+                court_id, date_str = item.split(':')
+                pairs.append((int(court_id), datetime.strptime(date_str, '%Y-%m-%d').date()))
+    except ValueError:
+        return JsonResponse(
+            {'error': 'Use subscribe=<cancha>:<YYYY-MM-DD>,...'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    pairs = list(dict.fromkeys(pairs))
+    if not 1 <= len(pairs) <= STREAM_MAX_SUBSCRIPTIONS:
+        return JsonResponse(
+            {'error': f'Suscríbase a entre 1 y {STREAM_MAX_SUBSCRIPTIONS} días'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    def format_event(state):
+        return f"event: slots\ndata: {json.dumps(state)}\n\n"
+
+    async def stream():
+        queue = broadcaster.subscribe(pairs)
+        loop = asyncio.get_running_loop()
+        # Django 4.2 no detecta la desconexión del cliente en respuestas en
+        # streaming: se cierra cada STREAM_MAX_SECONDS y EventSource reconecta
+        deadline = loop.time() + STREAM_MAX_SECONDS
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            for pair in pairs:
+                yield format_event(await broadcaster.snapshot(pair))
+            while loop.time() < deadline:
+                try:
+                    state = await asyncio.wait_for(queue.get(), timeout=STREAM_HEARTBEAT_SECONDS)
+                    yield format_event(state)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+        finally:
+            broadcaster.unsubscribe(queue, pairs)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_slot_hold(request):
+    """
+    Retiene un slot unos minutos (SLOT_HOLD_TTL) mientras el usuario completa
+    la reserva. Cada usuario puede retener a la vez SLOT_HOLD_MAX_PER_USER
+    intervalos de hasta SLOT_HOLD_MAX_MINUTES dentro del horario de la cancha.
+    """
+    court = court_catalog.get(request.data.get('court'))
+    if court is None or not court.is_active:
+        raise Http404
+    try:
+        date = datetime.strptime(request.data.get('date', ''), '%Y-%m-%d').date()
+        start_time = datetime.strptime(request.data.get('start_time', ''), '%H:%M').time()
+        end_time = datetime.strptime(request.data.get('end_time', ''), '%H:%M').time()
+    except (TypeError, ValueError):
+        return Response(
+            {'error': 'Formato inválido. Use YYYY-MM-DD para la fecha y HH:MM para las horas'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    token, expires_ms, error = _acquire_slot_hold(court, date, start_time, end_time, request.user.id)
+    if error:
+        message, error_status = error
+        return Response({'error': message}, status=error_status)
+
+    return Response({
+        'token': token,
+        'expires_at': datetime.fromtimestamp(expires_ms / 1000, tz=dt_timezone.utc),
+        'ttl': settings.SLOT_HOLD_TTL
+    }, status=status.HTTP_201_CREATED)
+
+def _acquire_slot_hold(court, date, start_time, end_time, user_id):
+    """
+    Valida el intervalo y lo retiene para user_id. Devuelve
+    (token, expira_en_ms, None) o (None, None, (mensaje, status)).
+    """
+    error = _hold_span_error(court, date, start_time, end_time)
+    if error:
+        return None, None, (error, status.HTTP_400_BAD_REQUEST)
+
+    if day_occupancy(court.id, date).conflicts(start_time, end_time):
+        return None, None, ('Ya existe una reserva para este horario', status.HTTP_409_CONFLICT)
+
+    try:
+        token, expires_ms = SlotHoldService().acquire(court.id, date, start_time, end_time, user_id)
+    except SlotHoldUnavailable as e:
+        return None, None, (str(e), status.HTTP_503_SERVICE_UNAVAILABLE)
+    except SlotHoldError as e:
+        return None, None, (str(e), status.HTTP_409_CONFLICT)
+    publish_availability_changes([(court.id, date)])
+    return token, expires_ms, None
+
+def _hold_span_error(court, date, start_time, end_time):
+    """Motivo por el que no se puede retener el intervalo, o None"""
+    now = timezone.localtime()
+    if end_time <= start_time:
+        return 'La hora de fin debe ser posterior a la hora de inicio'
+    if date < now.date() or date == now.date() and start_time < now.time():
+        return 'No se pueden retener horarios pasados'
+    available, message = court.is_available(date, start_time)
+    if not available:
+        return message
+    if end_time > court.closing_time:
+        return 'La reserva termina después del cierre de la cancha'
+    minutes = (end_time.hour * 60 + end_time.minute) - (start_time.hour * 60 + start_time.minute)
+    if minutes > settings.SLOT_HOLD_MAX_MINUTES:
+        return f'No se pueden retener más de {settings.SLOT_HOLD_MAX_MINUTES} minutos'
+    return None
+
+@api_view(['DELETE'])
+@permission_classes([IsAuthenticated])
+def release_slot_hold(request, token):
+    holds = SlotHoldService()
+    try:
+        if holds.owner(token) != request.user.id:
+            raise Http404
+        if holds.release(token):
+            publish_availability_changes([holds.parse_token(token)])
+    except SlotHoldUnavailable as e:
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except SlotHoldError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([HasMetricsToken])
+def metrics(request):
+    """Contadores operativos en formato de texto de Prometheus"""
+    lines = []
+    for stat, value in cache_stats().items():
+        name = f'arenaspadel_availability_cache_{stat}_total'
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+
+    limiter = WhatsAppRateLimiter.stats()
+    for name, value in [
+        ('arenaspadel_whatsapp_ratelimit_acquired_total', limiter['acquired']),
+        ('arenaspadel_whatsapp_ratelimit_waits_total', limiter['waits']),
+        ('arenaspadel_whatsapp_ratelimit_wait_seconds_total', limiter['wait_ms'] / 1000),
+        ('arenaspadel_whatsapp_ratelimit_rejections_total', limiter['rejections']),
+    ]:
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
 
 @api_view(['POST'])
 def create_reservation(request):
@@ -580,6 +1076,45 @@ def create_reservation(request):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def create_reservation_series(request):
+    """
+    Reserva el mismo horario cada semana (o cada interval_weeks) a partir de
+    start_date. Con skip_conflicts=false no se crea nada si alguna fecha choca.
+    Solo administradores: las series (academias, ligas) se reservan a nombre
+    de otro usuario.
+    """
+    serializer = ReservationSeriesSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    data = serializer.validated_data
+    service = ReservationSeriesService(
+        court=data['court'],
+        user=data['user'],
+        start_time=data['start_time'],
+        end_time=data['end_time'],
+        dates=serializer.dates()
+    )
+    try:
+        reservations, conflicts = service.book(skip_conflicts=data['skip_conflicts'])
+    except DjangoValidationError as e:
+        return Response({'error': e.messages}, status=status.HTTP_409_CONFLICT)
+
+    body = {
+        'series_id': reservations[0].series_id if reservations else None,
+        'created': [{'id': r.id, 'date': r.date} for r in reservations],
+        'conflicts': [
+            {'date': date, 'reason': reason}
+            for date, reason in sorted(conflicts.items())
+        ]
+    }
+    return Response(
+        body,
+        status=status.HTTP_201_CREATED if reservations else status.HTTP_409_CONFLICT
+    )
+
 @api_view(['POST'])
 def process_payment(request):
     payment_serializer = PaymentSerializer(data=request.data)
@@ -588,30 +1123,85 @@ def process_payment(request):
         return Response(payment_serializer.data, status=status.HTTP_201_CREATED)
     return Response(payment_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-def generate_available_slots(existing_bookings):
+def generate_available_slots(court, occupancy):
     """
-    Genera los slots disponibles para un día, considerando las reservas existentes
+    Genera los slots de una hora del día dentro del horario de la cancha,
+    marcando como no disponibles los que chocan con el bitmap de ocupación
     """
-    # Horario de operación (7am a 11pm)
-    OPENING_HOUR = 7
-    CLOSING_HOUR = 23
-    
-    # Crear lista de todos los slots posibles
+    free_starts = {
+        start for start, _ in occupancy.free_slots(court.opening_time, court.closing_time)
+    }
+    opening_cell = time_to_cell(court.opening_time)
+    closing_cell = time_to_cell(court.closing_time)
+    slot_cells = 60 // CELL_MINUTES
+
     all_slots = []
-    for hour in range(OPENING_HOUR, CLOSING_HOUR):
-        slot = {
-            'hour': hour,
-            'time': f"{hour:02d}:00",
-            'available': True
-        }
-        all_slots.append(slot)
-    
-    # Marcar slots ocupados
-    for booking in existing_bookings:
-        booking_hour = booking.time.hour
-        for slot in all_slots:
-            if slot['hour'] == booking_hour:
-                slot['available'] = False
-                break
-    
+    for start in range(opening_cell, closing_cell - slot_cells + 1, slot_cells):
+        all_slots.append({
+            'hour': cell_to_time(start).hour,
+            'time': cell_label(start),
+            'available': start in free_starts
+        })
+
     return all_slots
+
+def _day_availability(court_id, date, request):
+    """Ocupación del día más las reservas temporales de otros usuarios (?hold=<token> excluye la propia)"""
+    pair = (int(court_id), date)
+    occupancy = SlotHoldService().apply_to(
+        {pair: day_occupancy(*pair)},
+        request.query_params.get('hold')
+    )
+    return occupancy[pair]
+
+def _make_etag(*parts):
+    return '"%s"' % hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+def _availability_validators(court, date, request):
+    """
+    ETag y Last-Modified (segundos) de la disponibilidad de un día sin calcular
+    el cuerpo: versión de la cancha, versión del día y retenciones vigentes.
+    Las retenciones caducan sin cambiar ninguna versión, así que con
+    retenciones activas solo se usa el ETag. (None, None) si Redis no responde.
+    """
+    pair = (court.id, date)
+    try:
+        court_version, day_version = day_versions([pair])[pair]
+        held = SlotHoldService().held_masks([pair], request.query_params.get('hold'))[pair]
+    except Exception as e:
+        logger.warning(f"No se pudieron calcular los validadores de disponibilidad: {str(e)}")
+        return None, None
+
+    etag = _make_etag('availability', pair, court_version, day_version, held)
+    last_modified = None if held else max(court_version, day_version) // 1000
+    return etag, last_modified
+
+def _not_modified(request, etag):
+    """
+    304 si If-None-Match coincide con el ETag. Last-Modified se envía pero no
+    se usa para responder 304: tiene resolución de segundos y dos cambios en
+    el mismo segundo darían por vigente una copia vieja.
+    """
+    return get_conditional_response(request, etag=etag)
+
+def _with_validators(response, etag, last_modified, cache_control):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, **cache_control)
+    # Las mismas URLs sirven JSON o la API navegable (HTML) según Accept
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+def _parse_time_span(request):
+    """Lee start_time/end_time (HH:MM) de la query; None si no se enviaron"""
+    start_str = request.query_params.get('start_time')
+    end_str = request.query_params.get('end_time')
+    if not (start_str and end_str):
+        return None
+    start_time = datetime.strptime(start_str, '%H:%M').time()
+    end_time = datetime.strptime(end_str, '%H:%M').time()
+    if end_time <= start_time:
+        raise ValueError('La hora de fin debe ser posterior a la hora de inicio')
+    return start_time, end_time